@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import hashlib
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import eventlet
+
+from syncthang.bep import messages
+from syncthang.bep import protocol
+from syncthang import assembly
+
+
+def make_blocks(count, size):
+    blocks = []
+
+    for _ in range(count):
+        data = os.urandom(size)
+        blocks.append((data, hashlib.sha256(data).digest()))
+
+    return blocks
+
+
+def make_files(prefix, files, size, pool):
+    fileinfos = []
+
+    for index in range(files):
+        fileinfo = messages.FileInfo('%s/%06d' % (prefix, index), 0o644,
+                                     int(time.time()), {1: 1})
+        datas = []
+        remaining = size
+
+        while remaining > 0:
+            data, sha = random.choice(pool)
+            data = data[:remaining]
+
+            if len(data) != len(pool[0][0]):
+                sha = hashlib.sha256(data).digest()
+
+            fileinfo.add_block(len(data), sha)
+            datas.append(data)
+            remaining = remaining - len(data)
+
+        fileinfos.append((fileinfo, datas))
+
+    return fileinfos
+
+
+def naive(root, fileinfo, datas):
+    path = os.path.join(root, fileinfo.name)
+    temp_path = assembly.temp_path(path)
+
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    with open(temp_path, 'wb') as f:
+        offset = 0
+
+        for index, data in enumerate(datas):
+            if hashlib.sha256(data).digest() != fileinfo.blocks.sha(index):
+                raise ValueError('Block %s does not match' % index)
+
+            f.seek(offset)
+            f.write(data)
+            offset = offset + len(data)
+
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.rename(temp_path, path)
+
+
+def assembled(assembler, fileinfo, datas):
+    partial = assembler.open(fileinfo)
+    order = list(range(len(datas)))
+    random.shuffle(order)
+
+    for index in order:
+        partial.write(index, datas[index])
+
+    assembler.commit(partial)
+
+
+def bench(name, func, fileinfos, concurrency, *args):
+    pool = eventlet.GreenPool(concurrency)
+    total = sum(fileinfo.blocks.total_size for fileinfo, _ in fileinfos)
+
+    start = time.time()
+    for fileinfo, datas in fileinfos:
+        pool.spawn_n(func, *(args + (fileinfo, datas)))
+    pool.waitall()
+
+    if args and isinstance(args[0], assembly.Assembler):
+        args[0].flush()
+
+    elapsed = time.time() - start
+    print('  %-10s %6s files in %7.2fs (%8.1f files/s, %7.1f MB/s)' % (
+        name + ':', len(fileinfos), elapsed, len(fileinfos) / elapsed,
+        total / elapsed / (1024 * 1024)))
+
+
+def run(title, root, fileinfos, args):
+    print('%s:' % title)
+    naive_root = os.path.join(root, 'naive')
+    assembled_root = os.path.join(root, 'assembled')
+
+    bench('naive', naive, fileinfos, args.concurrency, naive_root)
+    bench('assembled', assembled, fileinfos, args.concurrency,
+          assembly.Assembler(assembled_root))
+
+    shutil.rmtree(naive_root)
+    shutil.rmtree(assembled_root)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare naive and batched assembly of pulled files')
+    parser.add_argument('--directory', default=None,
+                        help='where to write, defaults to a temporary '
+                             'directory')
+    parser.add_argument('--small-files', type=int, default=5000)
+    parser.add_argument('--small-size', type=int, default=4096)
+    parser.add_argument('--large-files', type=int, default=2)
+    parser.add_argument('--large-size', type=int, default=2 * 1024 ** 3)
+    parser.add_argument('--concurrency', type=int, default=64)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    root = tempfile.mkdtemp(prefix='syncthang-assembly-',
+                            dir=args.directory)
+
+    try:
+        pool = make_blocks(64, protocol.BLOCK_SIZE)
+
+        if args.small_files:
+            run('%s x %s byte files' % (args.small_files, args.small_size),
+                root, make_files('small', args.small_files,
+                                 args.small_size, pool), args)
+
+        if args.large_files:
+            run('%s x %s MiB files' % (args.large_files,
+                                       args.large_size // 1024 ** 2),
+                root, make_files('large', args.large_files,
+                                 args.large_size, pool), args)
+
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
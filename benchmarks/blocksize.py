@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from syncthang.bep import messages
+from syncthang.bep import protocol
+from syncthang import fs
+
+
+CHUNK = 1024 * 1024
+
+# NOTE(jkoelker) Each block costs its size, the digest length and the
+#                digest in the XDR encoded Index.
+BLOCK_OVERHEAD = 4 + 4 + messages.SHA_SIZE
+
+
+def write_file(path, size):
+    chunk = os.urandom(CHUNK)
+
+    with open(path, 'wb') as f:
+        remaining = size
+
+        while remaining > 0:
+            f.write(chunk[:remaining])
+            remaining = remaining - CHUNK
+
+
+def index_size(name, blocks):
+    fileinfo = messages.FileInfo(name, 0o644, 0, {1: 1}, 1, blocks)
+    return len(messages.Index(b'default', [fileinfo]).pack())
+
+
+def _human(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB', 'TiB'):
+        if size < 1024:
+            return '%.1f %s' % (size, unit)
+
+        size = size / 1024.0
+
+    return '%.1f PiB' % size
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare fixed 128 KiB blocks with scaled block sizes')
+    parser.add_argument('--directory', default=None)
+    parser.add_argument('--size', type=int, default=1024 ** 3)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    directory = tempfile.mkdtemp(prefix='syncthang-blocksize-',
+                                 dir=args.directory)
+    path = os.path.join(directory, 'large')
+
+    try:
+        write_file(path, args.size)
+        print('%s file:' % _human(args.size))
+
+        for name, large_blocks in (('128 KiB', False), ('scaled', True)):
+            start = time.time()
+            blocks = fs.hash_path(path, large_blocks)
+            elapsed = time.time() - start
+
+            print('  %-8s %s blocks of %s, index %s, hashed in %.2fs '
+                  '(%.1f MB/s)' % (
+                      name + ':', len(blocks), _human(blocks.block_size),
+                      _human(index_size(b'large', blocks)), elapsed,
+                      args.size / elapsed / (1024 * 1024)))
+
+    finally:
+        shutil.rmtree(directory)
+
+    print('index size per file:')
+    for size in (1024 ** 2, 1024 ** 3, 100 * 1024 ** 3, 1024 ** 4):
+        fixed = -(-size // protocol.BLOCK_SIZE)
+        scaled = -(-size // protocol.block_size(size, True))
+        print('  %-10s %8s blocks %10s   scaled: %6s blocks %10s' % (
+            _human(size) + ':', fixed, _human(fixed * BLOCK_OVERHEAD),
+            scaled, _human(scaled * BLOCK_OVERHEAD)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import hashlib
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import eventlet
+
+from syncthang.bep import messages
+from syncthang.bep import protocol
+from syncthang import blockstore
+from syncthang import model
+
+from . import peer
+
+
+class Model(peer.Model):
+    # NOTE(jkoelker) Serve requests from the block store, not zeros.
+    request = model.Model.request
+    request_blocking = model.Model.request_blocking
+
+
+def make_file(name, datas):
+    fileinfo = messages.FileInfo(name, 0o644, int(time.time()), {1: 1})
+
+    for data in datas:
+        fileinfo.add_block(len(data), hashlib.sha256(data).digest())
+
+    return fileinfo
+
+
+def disk_usage(path):
+    total = 0
+
+    for dirpath, _, files in os.walk(path):
+        for name in files:
+            total = total + os.stat(os.path.join(dirpath, name)).st_blocks
+
+    return total * 512
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Store folders sharing most of their files in the block '
+                    'store and serve requests from it')
+    parser.add_argument('--directory', default=None)
+    parser.add_argument('--folders', type=int, default=20)
+    parser.add_argument('--shared', type=int, default=50,
+                        help='files every folder has')
+    parser.add_argument('--unique', type=int, default=5,
+                        help='files only one folder has')
+    parser.add_argument('--blocks', type=int, default=4,
+                        help='blocks per file')
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    root = tempfile.mkdtemp(prefix='syncthang-blockstore-',
+                            dir=args.directory)
+
+    def blocks():
+        return [os.urandom(protocol.BLOCK_SIZE) for _ in range(args.blocks)]
+
+    try:
+        store = blockstore.BlockStore(root)
+        master = Model(peer.CLIENT_NAME, peer.CLIENT_VERSION,
+                       block_store=store)
+
+        shared = [(b'lib/%04d' % i, blocks()) for i in range(args.shared)]
+        logical = 0
+        start = time.time()
+
+        for folder in range(args.folders):
+            files = shared + [(b'own/%04d' % i, blocks())
+                              for i in range(args.unique)]
+            fileinfos = []
+
+            for name, datas in files:
+                for data in datas:
+                    store.put(data)
+
+                fileinfos.append(make_file(name, datas))
+                logical = logical + sum(len(data) for data in datas)
+
+            master.apply_index(b'', b'folder%d' % folder, fileinfos, 0)
+
+        print('%s folders, %s MiB of files stored as %s MiB in %.2fs' % (
+            args.folders, logical // 1024 ** 2,
+            disk_usage(root) // 1024 ** 2, time.time() - start))
+
+        names = [b'lib/%04d' % i for i in range(args.shared)]
+        requests = [(b'folder%d' % random.randrange(args.folders),
+                     random.choice(names),
+                     random.randrange(args.blocks) * protocol.BLOCK_SIZE)
+                    for _ in range(args.requests)]
+        pool = eventlet.GreenPool(args.concurrency)
+
+        def request(item):
+            folder, name, offset = item
+            return len(master.request(folder, name, offset,
+                                      protocol.BLOCK_SIZE, None, 0))
+
+        start = time.time()
+        served = sum(pool.imap(request, requests))
+        elapsed = time.time() - start
+        print('  %s requests in %.2fs (%.0f/s, %.1f MB/s)' % (
+            args.requests, elapsed, args.requests / elapsed,
+            served / elapsed / (1024 * 1024)))
+
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import hashlib
+import logging
+import os
+import resource
+import shutil
+import signal
+import sys
+import tempfile
+import time
+
+import eventlet
+
+from syncthang.bep import messages
+from syncthang.bep import protocol
+from syncthang import server
+
+from . import peer
+
+
+LOG = logging.getLogger(__name__)
+
+FOLDER = b'default'
+
+
+def _serve(address, cert_file, key_file, device_id):
+    ctx = server.context(cert_file, key_file)
+    sock = server.listen(address, ctx)
+    server.serve(sock, device_id, peer.model_factory(), peer.gate())
+
+
+def rss(pid='self'):
+    # NOTE(jkoelker) Returns the (current, peak) resident set size in KiB,
+    #                or None where /proc is not available.
+    values = {}
+
+    try:
+        with open('/proc/%s/status' % pid) as f:
+            for line in f:
+                name, _, value = line.partition(':')
+
+                if name in ('VmRSS', 'VmHWM'):
+                    values[name] = int(value.split()[0])
+
+    except EnvironmentError:
+        return None
+
+    return values.get('VmRSS'), values.get('VmHWM')
+
+
+def make_index(files, blocks):
+    # NOTE(jkoelker) Every peer sends the same Index, so pack it once and
+    #                keep the clients' cost out of the measurement.
+    fileinfos = []
+
+    for index in range(files):
+        name = 'bench/file-%06d' % index
+        fileinfo = messages.FileInfo(name.encode('utf-8'), 0o644,
+                                     int(time.time()), {1: index + 1})
+
+        for block in range(blocks):
+            sha = hashlib.sha256(('%s:%s' % (name, block)).encode('utf-8'))
+            fileinfo.add_block(protocol.BLOCK_SIZE, sha.digest())
+
+        fileinfos.append(fileinfo)
+
+    msg = messages.Index(FOLDER, fileinfos)
+    return messages.Packed(messages.INDEX, msg.pack())
+
+
+def _connect(remote, results):
+    start = time.time()
+    remote.connect()
+    remote.cluster_config()
+    results['connect'].append(time.time() - start)
+
+
+def _index(remote, index, results):
+    # NOTE(jkoelker) Messages are handled in order, so the Pong marks the
+    #                point where the master has applied the Index.
+    start = time.time()
+    remote.send(messages.Packed(messages.INDEX, index.payload))
+    remote.ping()
+    results['index'].append(time.time() - start)
+
+
+def _burst(remote, requests, size, results):
+    sent = {}
+
+    for index in range(requests):
+        msg = messages.Request(FOLDER, b'bench', index * size, size)
+        remote.send(msg)
+        sent[msg.msg_id] = time.time()
+
+    while sent:
+        msg = remote.wait_for(messages.RESPONSE)
+        results['request'].append(time.time() - sent.pop(msg.msg_id))
+        results['bytes'] = results['bytes'] + len(msg.data)
+
+
+def _ping(remote, pings, results):
+    for _ in range(pings):
+        results['ping'].append(remote.ping())
+
+
+def _guarded(func, remote, args, results):
+    try:
+        func(remote, *(args + (results, )))
+
+    except Exception:
+        if not results['errors']:
+            LOG.exception('%s failed, counting further errors quietly',
+                          func.__name__)
+
+        results['errors'] = results['errors'] + 1
+
+
+def _spawn_all(pool, func, remotes, results, *args):
+    start = time.time()
+
+    for remote in remotes:
+        pool.spawn_n(_guarded, func, remote, args, results)
+
+    pool.waitall()
+    return time.time() - start
+
+
+def _report(name, count, elapsed, samples, unit='ops', extra=''):
+    print('%-15s %8s in %6.2fs %10.1f %s/s%s' % (
+        name + ':', count, elapsed, count / elapsed, unit, extra))
+    print('%-15s p50 %.2fms p99 %.2fms' % (
+        '', peer.percentile(samples, 0.5) * 1000,
+        peer.percentile(samples, 0.99) * 1000))
+
+
+def _report_rss(name, values):
+    if values is None:
+        print('%-15s unavailable' % (name + ':'))
+        return
+
+    print('%-15s %.1f MiB (peak %.1f MiB)' % (
+        name + ':', values[0] / 1024.0, values[1] / 1024.0))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Drive a loopback master through a full BEP session')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=22004)
+    parser.add_argument('--peers', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--files', type=int, default=1000)
+    parser.add_argument('--blocks', type=int, default=8,
+                        help='blocks per file in the Index')
+    parser.add_argument('--requests', type=int, default=32,
+                        help='Requests per burst, at most 4096')
+    parser.add_argument('--request-size', type=int,
+                        default=protocol.BLOCK_SIZE)
+    parser.add_argument('--pings', type=int, default=20)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    address = (args.host, args.port)
+    directory = tempfile.mkdtemp(prefix='syncthang-e2e-')
+
+    try:
+        cert, key = peer.make_cert()
+        cert_file, key_file = peer.write_cert(directory, 'master', cert, key)
+        device_id = server.cert_to_device_id(cert)
+        client_key = peer.make_key()
+        clients = [peer.make_cert(client_key) for _ in range(args.peers)]
+        index = make_index(args.files, args.blocks)
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                _serve(address, cert_file, key_file, device_id)
+
+            finally:
+                os._exit(0)
+
+        time.sleep(1)
+
+        results = {'connect': [], 'index': [], 'request': [], 'ping': [],
+                   'bytes': 0, 'errors': 0}
+        rss_idle = rss(pid)
+        pool = eventlet.GreenPool(args.concurrency)
+        remotes = [peer.Peer(address, client_cert, client_key)
+                   for client_cert, client_key in clients]
+
+        try:
+            elapsed = {}
+            elapsed['connect'] = _spawn_all(pool, _connect, remotes, results)
+            elapsed['index'] = _spawn_all(pool, _index, remotes, results,
+                                          index)
+            elapsed['request'] = _spawn_all(pool, _burst, remotes, results,
+                                            args.requests, args.request_size)
+            elapsed['ping'] = _spawn_all(pool, _ping, remotes, results,
+                                         args.pings)
+            rss_loaded = rss(pid)
+
+        finally:
+            for remote in remotes:
+                remote.close()
+
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+
+    finally:
+        shutil.rmtree(directory)
+
+    print('peers:          %s (%s errors)' % (args.peers, results['errors']))
+    print('index:          %s files x %s blocks, %.1f KiB' % (
+        args.files, args.blocks, len(index.payload) / 1024.0))
+
+    _report('cluster config', len(results['connect']), elapsed['connect'],
+            results['connect'], 'conn')
+    _report('index', len(results['index']) * args.files, elapsed['index'],
+            results['index'], 'files')
+    _report('request', len(results['request']), elapsed['request'],
+            results['request'], 'req',
+            ' (%.1f MB/s)' % (results['bytes'] / elapsed['request'] /
+                              (1024 * 1024)))
+    _report('ping', len(results['ping']), elapsed['ping'], results['ping'])
+
+    _report_rss('master idle', rss_idle)
+    _report_rss('master loaded', rss_loaded)
+    print('%-15s %.1f MiB' % (
+        'peers peak:', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss /
+        1024.0))
+
+    # NOTE(jkoelker) Numbers from a run with errors are not comparable.
+    return 1 if results['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
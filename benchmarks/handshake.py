@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+
+import eventlet
+
+from syncthang.bep import messages
+from syncthang import server
+
+from . import peer
+
+
+LOG = logging.getLogger(__name__)
+
+RETRIES = 10
+RETRY_DELAY = 0.01
+
+
+def _serve(address, cert_file, key_file, device_id, session_cache):
+    ctx = server.context(cert_file, key_file, session_cache=session_cache)
+    sock = server.listen(address, ctx)
+    server.serve(sock, device_id, peer.model_factory(), peer.gate())
+
+
+def _handshake(remote, session, results):
+    # NOTE(jkoelker) A reconnect can beat the master to noticing the last
+    #                connection closed, it is then turned away as a
+    #                duplicate before any ClusterConfig. Try again shortly.
+    for attempt in range(RETRIES):
+        start = time.time()
+
+        try:
+            remote.connect(session)
+            # NOTE(jkoelker) TLS 1.3 tickets arrive after the handshake,
+            #                so wait for the ClusterConfig before saving it.
+            remote.wait_for(messages.CLUSTER_CONFIG)
+            return time.time() - start
+
+        except EOFError:
+            if attempt == RETRIES - 1:
+                raise
+
+            remote.close()
+            results['retries'] = results['retries'] + 1
+            eventlet.sleep(RETRY_DELAY)
+
+
+def _client(remote, connects, resume, results):
+    session = None
+
+    for _ in range(connects):
+        try:
+            results['handshake'].append(_handshake(remote, session, results))
+
+            if resume:
+                session = remote.session()
+
+        except Exception:
+            if not results['errors']:
+                LOG.exception('Handshake failed, counting further errors '
+                              'quietly')
+
+            results['errors'] = results['errors'] + 1
+
+        finally:
+            remote.close()
+
+
+def bench(name, address, cert_file, key_file, device_id, clients, args,
+          session_cache, resume):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            _serve(address, cert_file, key_file, device_id, session_cache)
+
+        finally:
+            os._exit(0)
+
+    time.sleep(1)
+
+    results = {'handshake': [], 'errors': 0, 'retries': 0}
+    pool = eventlet.GreenPool(args.concurrency)
+    remotes = [peer.Peer(address, cert, key) for cert, key in clients]
+
+    start = time.time()
+    try:
+        for remote in remotes:
+            pool.spawn_n(_client, remote, args.connects, resume, results)
+
+        pool.waitall()
+
+    finally:
+        elapsed = time.time() - start
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+
+    samples = results['handshake']
+    print('%s:' % name)
+    print('  handshakes:  %s in %.2fs (%.1f/s, %s errors, %s retried)' % (
+        len(samples), elapsed, len(samples) / elapsed, results['errors'],
+        results['retries']))
+    print('  latency:     p50 %.2fms p99 %.2fms' % (
+        peer.percentile(samples, 0.5) * 1000,
+        peer.percentile(samples, 0.99) * 1000))
+    return results['errors']
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure TLS handshakes with and without resumption')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=22003)
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--connects', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=100)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    address = (args.host, args.port)
+    directory = tempfile.mkdtemp(prefix='syncthang-handshake-')
+
+    try:
+        cert, key = peer.make_cert()
+        cert_file, key_file = peer.write_cert(directory, 'master', cert, key)
+        device_id = server.cert_to_device_id(cert)
+        client_key = peer.make_key()
+        clients = [peer.make_cert(client_key) for _ in range(args.clients)]
+
+        errors = bench('full handshake', address, cert_file, key_file,
+                       device_id, clients, args, session_cache=False,
+                       resume=False)
+        errors = errors + bench('resumed', address, cert_file, key_file,
+                                device_id, clients, args, session_cache=True,
+                                resume=True)
+
+    finally:
+        shutil.rmtree(directory)
+
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
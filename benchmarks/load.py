@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+
+import eventlet
+
+from syncthang import server
+from syncthang import workers
+
+from . import peer
+
+
+LOG = logging.getLogger(__name__)
+
+
+def _serve(address, cert_file, key_file, device_id, processes):
+    ctx = server.context(cert_file, key_file)
+    workers.run(address, ctx, device_id, peer.model_factory, processes,
+                peer.gate())
+
+
+def _session(remote, pings, results):
+    start = time.time()
+    remote.connect()
+    remote.cluster_config()
+    results['connect'].append(time.time() - start)
+
+    for _ in range(pings):
+        results['ping'].append(remote.ping())
+
+
+def _client(address, cert, key, pings, timeout, results):
+    remote = peer.Peer(address, cert, key)
+
+    try:
+        with eventlet.Timeout(timeout):
+            _session(remote, pings, results)
+
+    except (Exception, eventlet.Timeout):
+        if not results['errors']:
+            LOG.exception('Session failed, counting further errors quietly')
+
+        results['errors'] = results['errors'] + 1
+
+    finally:
+        remote.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Drive a multi-process master with simulated peers')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=22001)
+    parser.add_argument('--workers', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--clients', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=500)
+    parser.add_argument('--pings', type=int, default=10)
+    parser.add_argument('--timeout', type=float, default=60.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    address = (args.host, args.port)
+    directory = tempfile.mkdtemp(prefix='syncthang-load-')
+
+    try:
+        cert, key = peer.make_cert()
+        cert_file, key_file = peer.write_cert(directory, 'master', cert, key)
+        device_id = server.cert_to_device_id(cert)
+
+        print('Generating %s client certificates' % args.clients)
+        client_key = peer.make_key()
+        clients = [peer.make_cert(client_key) for _ in range(args.clients)]
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                _serve(address, cert_file, key_file, device_id, args.workers)
+
+            finally:
+                os._exit(0)
+
+        time.sleep(1)
+
+        results = {'connect': [], 'ping': [], 'errors': 0}
+        pool = eventlet.GreenPool(args.concurrency)
+
+        start = time.time()
+        for client_cert, client_key in clients:
+            pool.spawn_n(_client, address, client_cert, client_key,
+                         args.pings, args.timeout, results)
+        pool.waitall()
+        elapsed = time.time() - start
+
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+
+    finally:
+        shutil.rmtree(directory)
+
+    print('workers:        %s' % args.workers)
+    print('clients:        %s (%s errors)' % (args.clients, results['errors']))
+    print('elapsed:        %.2fs' % elapsed)
+    print('connections/s:  %.1f' % (len(results['connect']) / elapsed))
+    print('pings/s:        %.1f' % (len(results['ping']) / elapsed))
+
+    for name in ('connect', 'ping'):
+        samples = results[name]
+        print('%-15s p50 %.2fms p99 %.2fms' % (
+            name + ':',
+            peer.percentile(samples, 0.5) * 1000,
+            peer.percentile(samples, 0.99) * 1000))
+
+    return 1 if results['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import hashlib
+import logging
+import random
+import time
+
+from syncthang.bep import messages
+from syncthang import merkle
+
+
+def make_files(count, width):
+    sha = hashlib.sha256(b'').digest()
+    files = []
+
+    for i in range(count):
+        name = 'd%03d/d%03d/f%08d' % (i % width, (i // width) % width, i)
+        fileinfo = messages.FileInfo(name, 0o644, 1, {1: 1}, i + 1)
+        fileinfo.add_block(0, sha)
+        files.append(fileinfo)
+
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare two replicas by walking every file and by '
+                    'their directory digests')
+    parser.add_argument('--files', type=int, default=1000000)
+    parser.add_argument('--width', type=int, default=100)
+    parser.add_argument('--changes', type=int, default=10)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    files = make_files(args.files, args.width)
+
+    start = time.time()
+    left = merkle.Tree(files)
+    left.digest
+    print('%s files, tree built in %.2fs' % (args.files, time.time() - start))
+
+    right = merkle.Tree(files)
+    right.digest
+    changed = random.sample(files, args.changes)
+
+    start = time.time()
+    for fileinfo in changed:
+        fileinfo.version = {1: 2}
+        right.update(fileinfo)
+    right.digest
+    print('  %s updates rehashed in %.2f ms' % (
+        args.changes, (time.time() - start) * 1000))
+
+    start = time.time()
+    digests = dict((f.name, merkle.file_digest(f)) for f in files)
+    found = [name for name, digest in sorted(digests.items())
+             if left.get(name) != digest]
+    print('  every file:   %5s differ, %8.2f ms' % (
+        len(found), (time.time() - start) * 1000))
+
+    start = time.time()
+    found = list(merkle.diff(left, right))
+    print('  digests:      %5s differ, %8.2f ms' % (
+        len(found), (time.time() - start) * 1000))
+
+
+if __name__ == '__main__':
+    main()
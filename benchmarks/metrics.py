@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import hashlib
+import logging
+
+from syncthang.bep import messages
+from syncthang.bep import protocol
+from syncthang import metrics
+
+from . import peer
+
+
+DEVICE_ID = b'\x01' * 32
+
+
+class TimedObserver(metrics.Observer):
+    # NOTE(jkoelker) The run to run noise of a whole run is larger than the
+    #                cost of the metrics, so time the observer calls within
+    #                the run instead. The timer calls are counted too, so
+    #                this overstates the cost a little.
+    def __init__(self, device_id=None):
+        super(TimedObserver, self).__init__(device_id)
+        self.elapsed = 0.0
+        self.calls = 0
+
+    def _timed(self, func, *args):
+        start = metrics.clock()
+        func(self, *args)
+        self.elapsed = self.elapsed + metrics.clock() - start
+        self.calls = self.calls + 1
+
+    def frame(self, *args):
+        self._timed(metrics.Observer.frame, *args)
+
+    def compression(self, *args):
+        self._timed(metrics.Observer.compression, *args)
+
+    def handled(self, *args):
+        self._timed(metrics.Observer.handled, *args)
+
+    def responded(self, *args):
+        self._timed(metrics.Observer.responded, *args)
+
+    def paused(self, *args):
+        self._timed(metrics.Observer.paused, *args)
+
+
+class Socket(object):
+    # NOTE(jkoelker) Hands out the frames a peer would have sent and drops
+    #                what the device sends back.
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.offset = 0
+        self.sent = 0
+
+    def recv(self, size):
+        chunk = self.data[self.offset:self.offset + size].tobytes()
+        self.offset = self.offset + len(chunk)
+        return chunk
+
+    def sendall(self, data):
+        self.sent = self.sent + len(data)
+
+    def shutdown(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def make_stream(count, size, files):
+    fileinfos = []
+
+    for index in range(files):
+        fileinfo = messages.FileInfo(('file%d' % index).encode(), 0o644, 0,
+                                     messages.Vector({1: 1}))
+        fileinfo.add_block(size, hashlib.sha256(str(index).encode()).digest())
+        fileinfos.append(fileinfo)
+
+    frames = [messages.ClusterConfig(b'peer', b'0.1.0')]
+
+    for index in range(count):
+        if index % 100 == 0:
+            frames.append(messages.IndexUpdate(b'default', fileinfos))
+
+        elif index % 10 == 0:
+            frames.append(messages.Ping())
+
+        else:
+            frames.append(messages.Request(b'default', b'bench',
+                                           index * size, size))
+
+    chunks = []
+    for msg_id, msg in enumerate(frames):
+        chunks.append(messages.encode(messages.Frame.from_message(msg),
+                                      msg_id, None))
+
+    return b''.join(chunks), len(frames)
+
+
+def run(stream):
+    observer = TimedObserver(DEVICE_ID)
+    device = protocol.RemoteDevice(DEVICE_ID, Socket(stream),
+                                   peer.model_factory(), observer=observer)
+    start = metrics.clock()
+    device.start()
+    return metrics.clock() - start, observer
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure the cost of metrics on a device handling a '
+                    'stream of frames')
+    parser.add_argument('--frames', type=int, default=50000)
+    parser.add_argument('--size', type=int, default=4096,
+                        help='bytes per request, small ones make the per '
+                             'frame cost stand out')
+    parser.add_argument('--files', type=int, default=100,
+                        help='files per index update')
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    stream, count = make_stream(args.frames, args.size, args.files)
+    print('%s frames in, %s byte requests' % (count, args.size))
+
+    for _ in range(args.runs):
+        elapsed, observer = run(stream)
+        print('  %.3fs (%.1f us/frame), %s observer calls took %.3fs '
+              '(%.2f us each), %.2f%% of the run' % (
+                  elapsed, elapsed / count * 1e6, observer.calls,
+                  observer.elapsed, observer.elapsed / observer.calls * 1e6,
+                  observer.elapsed / elapsed * 100))
+
+
+if __name__ == '__main__':
+    main()
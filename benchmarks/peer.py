@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+import os
+import random
+import time
+
+from eventlet.green.OpenSSL import crypto
+from eventlet.green.OpenSSL import SSL
+import eventlet
+
+from syncthang.bep import messages
+from syncthang.bep import protocol
+from syncthang import admission
+from syncthang import model
+from syncthang import server
+
+
+CLIENT_NAME = b'syncthang-bench'
+CLIENT_VERSION = b'0.1.0'
+
+_BLOCK = b'\0' * protocol.BLOCK_SIZE
+
+
+def make_key(bits=2048):
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, bits)
+    return key
+
+
+def make_cert(key=None, common_name='syncthing'):
+    # NOTE(jkoelker) The device id only depends on the certificate, so
+    #                simulated peers may share a key to keep setup fast.
+    if key is None:
+        key = make_key()
+
+    cert = crypto.X509()
+    cert.get_subject().CN = common_name
+    cert.set_serial_number(random.getrandbits(63))
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(10 * 365 * 24 * 60 * 60)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(key, 'sha256')
+    return cert, key
+
+
+def write_cert(directory, name, cert, key):
+    cert_file = os.path.join(directory, name + '.crt')
+    key_file = os.path.join(directory, name + '.key')
+
+    with open(cert_file, 'wb') as f:
+        f.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+
+    with open(key_file, 'wb') as f:
+        f.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+
+    return cert_file, key_file
+
+
+class Model(model.Model):
+    # NOTE(jkoelker) The benchmarks run without a configured database, so
+    #                every device is sent an empty ClusterConfig.
+    def cluster_config(self, device_id):
+        payload = self._cluster_configs.get(None)
+
+        if payload is None:
+            msg = messages.ClusterConfig(self.client_name,
+                                         self.client_version)
+            payload = self._cluster_configs[None] = msg.pack()
+
+        return messages.Packed(messages.CLUSTER_CONFIG, payload)
+
+    def update_cluster_config(self, device_id, name, version, folders,
+                              options):
+        pass
+
+    def request(self, folder, name, offset, size, sha, flags):
+        if size == len(_BLOCK):
+            return _BLOCK
+
+        return b'\0' * size
+
+    # NOTE(jkoelker) Nothing here touches eventlet, so aio can use it too.
+    request_blocking = request
+
+
+def model_factory():
+    return Model(CLIENT_NAME, CLIENT_VERSION)
+
+
+def gate():
+    # NOTE(jkoelker) Every simulated peer connects from loopback, so lift
+    #                the accept rate limits that would otherwise apply.
+    unlimited = 10 ** 9
+    return admission.Admission(accept_rate=unlimited,
+                               accept_burst=unlimited,
+                               ip_accept_rate=unlimited,
+                               ip_accept_burst=unlimited,
+                               max_pending=unlimited)
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+
+    samples = sorted(samples)
+    index = min(len(samples) - 1, int(round(fraction * (len(samples) - 1))))
+    return samples[index]
+
+
+class Peer(object):
+    def __init__(self, address, cert, key, name=CLIENT_NAME):
+        self.address = address
+        self.name = name
+        self.device_id = server.cert_to_device_id(cert)
+
+        self.ctx = SSL.Context(SSL.SSLv23_METHOD)
+        self.ctx.use_certificate(cert)
+        self.ctx.use_privatekey(key)
+        self.ctx.set_verify(SSL.VERIFY_PEER, server._verify)
+
+        self.sock = None
+        self.conn = None
+
+    def connect(self, session=None):
+        sock = eventlet.connect(self.address)
+        self.sock = SSL.Connection(self.ctx, sock)
+        self.sock.set_connect_state()
+
+        if session is not None:
+            self.sock.set_session(session)
+
+        self.sock.do_handshake()
+        self.conn = messages.Connection(self.sock, compress=False)
+
+    def session(self):
+        return self.sock.get_session()
+
+    def close(self):
+        if self.sock is not None:
+            # NOTE(jkoelker) Sessions from connections that are not shut
+            #                down cleanly are not resumable.
+            try:
+                self.sock.shutdown()
+
+            except (SSL.Error, EnvironmentError):
+                pass
+
+            self.sock.close()
+
+        self.sock = None
+        self.conn = None
+
+    def send(self, msg):
+        self.conn.send(msg)
+
+    def wait_for(self, msg_type, msg_id=None):
+        for msg in self.conn:
+            if msg._MESSAGE_TYPE != msg_type:
+                continue
+
+            if msg_id is None or msg.msg_id == msg_id:
+                return msg
+
+        raise EOFError('Connection closed while waiting for %s' % msg_type)
+
+    def cluster_config(self, folders=None):
+        self.send(messages.ClusterConfig(self.name, CLIENT_VERSION, folders))
+        return self.wait_for(messages.CLUSTER_CONFIG)
+
+    def index(self, folder, files, update=False):
+        cls = messages.IndexUpdate if update else messages.Index
+        self.send(cls(folder, files))
+
+    def ping(self):
+        start = time.time()
+        msg = messages.Ping()
+        self.send(msg)
+        self.wait_for(messages.PONG, msg.msg_id)
+        return time.time() - start
+
+    def request(self, folder, name, offset, size):
+        start = time.time()
+        msg = messages.Request(folder, name, offset, size)
+        self.send(msg)
+        response = self.wait_for(messages.RESPONSE, msg.msg_id)
+        return time.time() - start, response
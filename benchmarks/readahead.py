@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import eventlet
+
+from syncthang.bep import messages
+from syncthang.bep import protocol
+from syncthang import blockstore
+from syncthang import fs
+
+
+def read_syscalls():
+    # NOTE(jkoelker) Linux only, the read calls this process has made.
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('syscr:'):
+                    return int(line.split()[1])
+
+    except IOError:
+        pass
+
+    return 0
+
+
+def make_store(root, files, blocks):
+    store = blockstore.BlockStore(root)
+    fileinfos = []
+
+    for index in range(files):
+        fileinfo = messages.FileInfo('large/%04d' % index, 0o644, 1, {1: 1})
+
+        for _ in range(blocks):
+            data = os.urandom(protocol.BLOCK_SIZE)
+            fileinfo.add_block(len(data), hashlib.sha256(data).digest())
+            store.put(data)
+
+        store.add_file('default', fileinfo)
+        fileinfos.append(fileinfo)
+
+    return fileinfos
+
+
+def evict(store, fileinfos):
+    for fileinfo in fileinfos:
+        for index in range(len(fileinfo.blocks)):
+            fd = os.open(store.path(fileinfo.blocks.sha(index)), os.O_RDONLY)
+
+            try:
+                fs.advise(fd, 'POSIX_FADV_DONTNEED')
+
+            finally:
+                os.close(fd)
+
+
+def pull(store, fileinfo):
+    # NOTE(jkoelker) Like a peer, one request after the other in order.
+    for index in range(len(fileinfo.blocks)):
+        store.read('default', fileinfo.name, fileinfo.blocks.offset(index),
+                   fileinfo.blocks.size(index), fileinfo.blocks.sha(index))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Pull large files from the block store with and without '
+                    'readahead')
+    parser.add_argument('--directory', default=None)
+    parser.add_argument('--files', type=int, default=8,
+                        help='files pulled at once, one per peer')
+    parser.add_argument('--blocks', type=int, default=256,
+                        help='blocks per file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    root = tempfile.mkdtemp(prefix='syncthang-readahead-',
+                            dir=args.directory)
+
+    try:
+        fileinfos = make_store(root, args.files, args.blocks)
+        total = sum(f.blocks.total_size for f in fileinfos)
+        requests = args.files * args.blocks
+        print('%s peers each pulling %s MiB in %s requests' % (
+            args.files, args.blocks * protocol.BLOCK_SIZE // 1024 ** 2,
+            args.blocks))
+
+        for name, size, handles in (('plain', 0, 1),
+                                    ('readahead', None, None)):
+            store = blockstore.BlockStore(root)
+
+            if size is not None:
+                store.readahead.size = size
+                store.handles.size = handles
+
+            for fileinfo in fileinfos:
+                store.add_file('default', fileinfo)
+
+            evict(store, fileinfos)
+            pool = eventlet.GreenPool()
+            calls = read_syscalls()
+            start = time.time()
+
+            for fileinfo in fileinfos:
+                pool.spawn_n(pull, store, fileinfo)
+            pool.waitall()
+
+            elapsed = time.time() - start
+            calls = read_syscalls() - calls
+            print('  %-10s %6.2fs (%7.1f MB/s), %6s read calls, %5s loads '
+                  'for %s requests' % (
+                      name + ':', elapsed, total / elapsed / 1024 ** 2, calls,
+                      store.readahead.misses, requests))
+            store.close()
+
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+import time
+
+import eventlet
+
+from syncthang.bep import capture
+from syncthang.bep import protocol
+from syncthang import metrics
+from syncthang import profiler
+
+from . import peer
+
+
+LOCAL_DEVICE_ID = b'\xff' * capture.DEVICE_ID_SIZE
+
+
+def replay(model, path, speed):
+    reader = capture.Reader(path)
+    sock = capture.ReplaySocket(reader, speed)
+
+    try:
+        device = protocol.RemoteDevice(
+            reader.device_id, sock, model, local_device_id=LOCAL_DEVICE_ID,
+            observer=metrics.observer(reader.device_id))
+        model.devices[reader.device_id] = device
+        device.start()
+
+    finally:
+        model.release_device(reader.device_id)
+        reader.close()
+
+    return sock
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replay captured BEP traffic into a model, every '
+                    'capture as its own device')
+    parser.add_argument('captures', nargs='+')
+    parser.add_argument('--speed', type=float, default=None,
+                        help='replay at this multiple of the captured pace, '
+                             'as fast as possible by default')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--profile', default=None,
+                        help='write collapsed stacks of the replay here')
+    parser.add_argument('--metrics', action='store_true',
+                        help='print the metrics after the replay')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.metrics:
+        metrics.enable()
+
+    if args.profile:
+        profiler.PROFILER.start()
+
+    for run in range(args.repeat):
+        model = peer.model_factory()
+        pool = eventlet.GreenPool()
+
+        start = time.time()
+        sockets = list(pool.imap(lambda path: replay(model, path,
+                                                     args.speed),
+                                 args.captures))
+        elapsed = time.time() - start
+
+        frames = sum(sock.frames for sock in sockets)
+        received = sum(sock.received for sock in sockets)
+        sent = sum(sock.sent for sock in sockets)
+        print('run %s: %s captures, %s frames in %.3fs (%.0f frames/s, '
+              '%.1f MB/s in, %.1f MB/s out)' % (
+                  run + 1, len(sockets), frames, elapsed, frames / elapsed,
+                  received / elapsed / (1024 * 1024),
+                  sent / elapsed / (1024 * 1024)))
+
+    if args.profile:
+        profiler.PROFILER.stop()
+        profiler.PROFILER.write(args.profile)
+        print('collapsed stacks written to %s' % args.profile)
+
+    if args.metrics:
+        print(metrics.REGISTRY.render())
+
+
+if __name__ == '__main__':
+    main()
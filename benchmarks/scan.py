@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import eventlet
+from eventlet import queue
+
+from syncthang import fs
+from syncthang import model
+from syncthang import scanner
+
+
+LOCAL_DEVICE_ID = b'\x01' * 32
+
+
+def make_folder(root, name, files, size):
+    folder = os.path.join(root, name)
+    os.makedirs(folder)
+    paths = []
+
+    for index in range(files):
+        path = os.path.join(folder, '%06d' % index)
+        write(path, size)
+        paths.append(path)
+
+    # NOTE(jkoelker) Listing order rarely matches the on disk order.
+    random.shuffle(paths)
+    return folder, paths
+
+
+def write(path, size):
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def evict(folders):
+    for _, paths in folders:
+        for path in paths:
+            fd = os.open(path, os.O_RDONLY)
+
+            try:
+                fs.advise(fd, 'POSIX_FADV_DONTNEED')
+
+            finally:
+                os.close(fd)
+
+
+def fifo(folders, concurrency, change, delay):
+    # NOTE(jkoelker) What scanning looks like without the scheduler: every
+    #                file goes through one first in first out queue, so a
+    #                change waits for the rescans queued before it.
+    jobs = queue.LightQueue()
+    changed = {}
+
+    def _worker():
+        while True:
+            path = jobs.get()
+
+            if path is None:
+                break
+
+            fs.hash_file(path)
+
+            if path == change:
+                changed['done'] = time.time()
+
+    workers = [eventlet.spawn(_worker)
+               for _ in range(concurrency * len(folders))]
+
+    for _, paths in folders:
+        for path in paths:
+            jobs.put(path)
+
+    eventlet.sleep(delay)
+    write(change, 1024)
+    changed['start'] = time.time()
+    jobs.put(change)
+
+    for _ in workers:
+        jobs.put(None)
+
+    for worker in workers:
+        worker.wait()
+
+    return changed['done'] - changed['start']
+
+
+def scheduled(folders, concurrency, change, delay):
+    dev = os.stat(folders[0][0]).st_dev
+    model_ = model.Model(b'syncthang-bench', b'0.1.0',
+                         local_device_id=LOCAL_DEVICE_ID)
+    model_.scanner = scanner.Scheduler(concurrency={dev: concurrency})
+    pool = eventlet.GreenPool()
+
+    for index, (folder, _) in enumerate(folders):
+        ident = ('folder%s' % index).encode('utf-8')
+        model_.add_folder(ident, path=folder)
+        pool.spawn_n(model_.scan, ident)
+
+    eventlet.sleep(delay)
+    write(change, 1024)
+    start = time.time()
+    model_.scan(b'folder0', [os.path.basename(change)], scanner.CHANGE)
+    elapsed = time.time() - start
+    pool.waitall()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Rescan several folders on one disk at once and time '
+                    'hashing a file that changes meanwhile, through a '
+                    'plain queue and through Model.scan and its scheduler')
+    parser.add_argument('--directory', default=None)
+    parser.add_argument('--folders', type=int, default=2)
+    parser.add_argument('--files', type=int, default=300)
+    parser.add_argument('--size', type=int, default=1024 * 1024)
+    parser.add_argument('--concurrency', type=int, default=2,
+                        help='hashes at once per folder for the queue, '
+                             'per disk for the scheduler')
+    parser.add_argument('--delay', type=float, default=0.2,
+                        help='seconds into the rescan the file changes')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    root = tempfile.mkdtemp(prefix='syncthang-scan-', dir=args.directory)
+
+    if not hasattr(os, 'posix_fadvise'):
+        print('No posix_fadvise, the page cache is warm for every run')
+
+    try:
+        folders = [make_folder(root, 'folder%s' % i, args.files, args.size)
+                   for i in range(args.folders)]
+        total = args.folders * args.files * args.size
+        dev = os.stat(root).st_dev
+        print('%s folders x %s files of %s KiB, device %s:%s would get %s' % (
+            args.folders, args.files, args.size // 1024, os.major(dev),
+            os.minor(dev), scanner.device_concurrency(dev)))
+
+        for name, func, concurrency in (
+                ('queue', fifo, args.concurrency),
+                ('scheduled', scheduled,
+                 args.concurrency * args.folders)):
+            change = os.path.join(folders[0][0], 'changed')
+            evict(folders)
+            start = time.time()
+            latency = func(folders, concurrency, change, args.delay)
+            elapsed = time.time() - start
+            os.unlink(change)
+            print('  %-10s %7.2fs (%6.1f MB/s), change hashed in %.3fs' % (
+                name + ':', elapsed, total / elapsed / (1024 * 1024),
+                latency))
+
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from syncthang.bep import messages
+from syncthang import snapshot
+
+
+BATCH = 1000
+
+
+def _name(index):
+    return ('dir%04d/file%08d' % (index % 1000, index)).encode('utf-8')
+
+
+def fill(store, folder, files):
+    for start in range(0, files, BATCH):
+        store.update(folder, [
+            messages.FileInfo(_name(i), 0o644, int(time.time()), {1: i + 1},
+                              i + 1)
+            for i in range(start, min(start + BATCH, files))])
+
+
+def lookups(store, folder, files, count):
+    names = [_name(i)
+             for i in random.sample(range(files), min(count, files))]
+
+    start = time.time()
+    for name in names:
+        if store.get(folder, name) is None:
+            raise ValueError('%s is missing' % name)
+
+    return (time.time() - start) / len(names)
+
+
+def opened(path):
+    start = time.time()
+    store = snapshot.IndexStore(path)
+    return store, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare startup from a journal and from a snapshot')
+    parser.add_argument('--directory', default=None)
+    parser.add_argument('--files', type=int, default=1000000)
+    parser.add_argument('--lookups', type=int, default=10000)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    path = tempfile.mkdtemp(prefix='syncthang-snapshot-', dir=args.directory)
+    folder = b'default'
+
+    try:
+        store = snapshot.IndexStore(path)
+        store.add_member(folder, b'\x00' * 32)
+
+        start = time.time()
+        fill(store, folder, args.files)
+        print('%s files journaled in %.2fs (%s MiB)' % (
+            args.files, time.time() - start, store.journal_size // 1024 ** 2))
+        store.close()
+
+        store, elapsed = opened(path)
+        print('  journal replay:  started in %8.3fs, lookup %6.1f us' % (
+            elapsed, lookups(store, folder, args.files, args.lookups) * 1e6))
+
+        start = time.time()
+        store.compact()
+        print('  compacted in %.2fs (%s MiB)' % (
+            time.time() - start,
+            os.path.getsize(os.path.join(path, snapshot.SNAPSHOT_NAME)) //
+            1024 ** 2))
+        store.close()
+
+        store, elapsed = opened(path)
+        print('  snapshot:        started in %8.3fs, lookup %6.1f us' % (
+            elapsed, lookups(store, folder, args.files, args.lookups) * 1e6))
+        store.close()
+
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+
+import eventlet
+
+from syncthang.bep import protocol
+from syncthang import server
+
+from . import peer
+
+
+LOG = logging.getLogger(__name__)
+
+
+def _serve(address, cert_file, key_file, device_id, transport):
+    ctx = server.context(cert_file, key_file)
+    server.run(address, ctx, device_id, peer.model_factory(), transport,
+               peer.gate())
+
+
+def _connect(remote, results):
+    start = time.time()
+    remote.connect()
+    remote.cluster_config()
+    results['connect'].append(time.time() - start)
+
+
+def _pull(remote, requests, results):
+    for index in range(requests):
+        elapsed, response = remote.request(b'default', b'bench',
+                                           index * protocol.BLOCK_SIZE,
+                                           protocol.BLOCK_SIZE)
+        results['request'].append(elapsed)
+        results['bytes'] = results['bytes'] + len(response.data)
+
+
+def _guarded(func, remote, args, results):
+    try:
+        func(remote, *(args + (results, )))
+
+    except Exception:
+        if not results['errors']:
+            LOG.exception('%s failed, counting further errors quietly',
+                          func.__name__)
+
+        results['errors'] = results['errors'] + 1
+
+
+def _spawn_all(pool, func, remotes, results, *args):
+    start = time.time()
+
+    for remote in remotes:
+        pool.spawn_n(_guarded, func, remote, args, results)
+
+    pool.waitall()
+    return time.time() - start
+
+
+def bench(transport, address, cert_file, key_file, device_id, clients, args):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            _serve(address, cert_file, key_file, device_id, transport)
+
+        finally:
+            os._exit(0)
+
+    time.sleep(1)
+
+    results = {'connect': [], 'request': [], 'bytes': 0, 'errors': 0}
+    pool = eventlet.GreenPool(args.concurrency)
+    remotes = [peer.Peer(address, cert, key) for cert, key in clients]
+
+    try:
+        connect_time = _spawn_all(pool, _connect, remotes, results)
+        pull_time = _spawn_all(pool, _pull, remotes, results, args.requests)
+
+    finally:
+        for remote in remotes:
+            remote.close()
+
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+
+    print('%s:' % transport)
+    print('  connections:   %s in %.2fs (%.1f/s, %s errors)' % (
+        len(results['connect']), connect_time,
+        len(results['connect']) / connect_time, results['errors']))
+    print('  connect:       p50 %.2fms p99 %.2fms' % (
+        peer.percentile(results['connect'], 0.5) * 1000,
+        peer.percentile(results['connect'], 0.99) * 1000))
+    print('  blocks:        %s in %.2fs (%.1f/s, %.1f MB/s)' % (
+        len(results['request']), pull_time,
+        len(results['request']) / pull_time,
+        results['bytes'] / pull_time / (1024 * 1024)))
+    print('  request:       p50 %.2fms p99 %.2fms' % (
+        peer.percentile(results['request'], 0.5) * 1000,
+        peer.percentile(results['request'], 0.99) * 1000))
+    return results['errors']
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare the eventlet and asyncio transports')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=22002)
+    parser.add_argument('--clients', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=500)
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--transport', action='append',
+                        choices=server.TRANSPORTS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    address = (args.host, args.port)
+    directory = tempfile.mkdtemp(prefix='syncthang-transport-')
+
+    try:
+        cert, key = peer.make_cert()
+        cert_file, key_file = peer.write_cert(directory, 'master', cert, key)
+        device_id = server.cert_to_device_id(cert)
+        client_key = peer.make_key()
+        clients = [peer.make_cert(client_key) for _ in range(args.clients)]
+
+        errors = 0
+
+        for transport in args.transport or server.TRANSPORTS:
+            errors = errors + bench(transport, address, cert_file, key_file,
+                                    device_id, clients, args)
+
+    finally:
+        shutil.rmtree(directory)
+
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
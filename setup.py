@@ -14,6 +14,9 @@ install_requires = ['eventlet',
 if sys.version_info < (3, 3):
     install_requires.append('contextlib2')
 
+if sys.version_info < (3, 4):
+    install_requires.append('trollius')
+
 
 setuptools.setup(
     name="syncthang",
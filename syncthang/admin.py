@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+import binascii
+import logging
+
+import eventlet
+from eventlet import wsgi
+import six
+from six.moves.urllib import parse
+
+from . import merkle
+from . import metrics
+from . import profiler
+
+
+LOG = logging.getLogger(__name__)
+ADDRESS = ('127.0.0.1', 22080)
+PROFILE_SECONDS = 10
+MAX_PROFILE_SECONDS = 300
+
+_ROUTES = {}
+
+
+def route(path):
+    def _inner(func):
+        _ROUTES[path] = func
+        return func
+    return _inner
+
+
+@route('/metrics')
+def _metrics(environ):
+    return ('200 OK', 'text/plain; version=0.0.4',
+            metrics.REGISTRY.render())
+
+
+@route('/profile')
+def _profile(environ):
+    query = parse.parse_qs(environ.get('QUERY_STRING', ''))
+
+    try:
+        seconds = float(query.get('seconds', [PROFILE_SECONDS])[0])
+
+    except ValueError:
+        return '400 Bad Request', 'text/plain', 'Invalid seconds\n'
+
+    if profiler.PROFILER.running:
+        return '409 Conflict', 'text/plain', 'Already profiling\n'
+
+    profiler.PROFILER.start()
+
+    try:
+        eventlet.sleep(min(max(seconds, 0), MAX_PROFILE_SECONDS))
+
+    finally:
+        profiler.PROFILER.stop()
+
+    return '200 OK', 'text/plain', profiler.PROFILER.collapsed()
+
+
+@route('/tree')
+def _tree(environ):
+    # NOTE(jkoelker) The digest of a folder directory followed by those of
+    #                its children, in sha256sum format. Replicas match when
+    #                the digests of the folder root do, and walking down
+    #                where they differ finds the files that do not.
+    model = environ.get('syncthang.model')
+    query = parse.parse_qs(environ.get('QUERY_STRING', ''))
+    folder = query.get('folder', [None])[0]
+    path = query.get('path', [''])[0].strip(merkle.SEPARATOR)
+
+    if model is None:
+        return '404 Not Found', 'text/plain', 'No model\n'
+
+    # NOTE(jkoelker) Folder ids are bytes, as in BEP.
+    if isinstance(folder, six.text_type):
+        folder = folder.encode('utf-8')
+
+    tree = model.trees.get(folder) if folder is not None else None
+    directory = tree.directory(path) if tree is not None else None
+
+    if directory is None:
+        return '404 Not Found', 'text/plain', 'Not Found\n'
+
+    lines = ['%s  %s/' % (binascii.hexlify(directory.digest).decode(),
+                          path)]
+
+    for kind, name, digest in directory.children():
+        name = merkle.SEPARATOR.join(filter(None, (path, name)))
+
+        if kind == merkle.DIRECTORY:
+            name = name + merkle.SEPARATOR
+
+        lines.append('%s  %s' % (binascii.hexlify(digest).decode(), name))
+
+    return '200 OK', 'text/plain', '\n'.join(lines) + '\n'
+
+
+def application(environ, start_response):
+    handler = _ROUTES.get(environ.get('PATH_INFO'))
+
+    if handler is None:
+        status, content_type, body = ('404 Not Found', 'text/plain',
+                                      'Not Found\n')
+
+    else:
+        status, content_type, body = handler(environ)
+
+    if not isinstance(body, bytes):
+        body = body.encode('utf-8')
+
+    start_response(status, [('Content-Type', content_type),
+                            ('Content-Length', str(len(body)))])
+    return [body]
+
+
+def serve(address=ADDRESS, model=None):
+    # NOTE(jkoelker) Only ever bind this to a local address, it exposes
+    #                operational controls without authentication.
+    def _application(environ, start_response):
+        environ['syncthang.model'] = model
+        return application(environ, start_response)
+
+    metrics.enable()
+    sock = eventlet.listen(address)
+    LOG.info('Admin endpoint listening on %s', address)
+    return eventlet.spawn(wsgi.server, sock, _application, log=LOG,
+                          log_output=False)
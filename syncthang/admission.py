@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import logging
+import time
+
+from . import metrics
+
+
+LOG = logging.getLogger(__name__)
+
+MAX_DEVICES = 10000
+ACCEPT_RATE = 200.0
+ACCEPT_BURST = 400
+IP_ACCEPT_RATE = 2.0
+IP_ACCEPT_BURST = 20
+MAX_PENDING = 512
+HANDSHAKE_TIMEOUT = 10.0
+IP_CACHE_SIZE = 16 * 1024
+
+
+class TokenBucket(object):
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def consume(self, now):
+        tokens = min(self.burst,
+                     self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if tokens < 1:
+            self.tokens = tokens
+            return False
+
+        self.tokens = tokens - 1
+        return True
+
+
+class Admission(object):
+    # NOTE(jkoelker) Connections are checked twice. accept runs before the
+    #                TLS handshake, so a reconnect storm is turned away
+    #                before it costs a green thread or any crypto. admit
+    #                runs once the device id is known and before anything
+    #                is allocated for the device.
+    def __init__(self, max_devices=MAX_DEVICES, accept_rate=ACCEPT_RATE,
+                 accept_burst=ACCEPT_BURST, ip_accept_rate=IP_ACCEPT_RATE,
+                 ip_accept_burst=IP_ACCEPT_BURST, max_pending=MAX_PENDING,
+                 handshake_timeout=HANDSHAKE_TIMEOUT, clock=time.time):
+        self.max_devices = max_devices
+        self.ip_accept_rate = ip_accept_rate
+        self.ip_accept_burst = ip_accept_burst
+        self.max_pending = max_pending
+        self.handshake_timeout = handshake_timeout
+        self.clock = clock
+
+        self.pending = 0
+
+        self._bucket = TokenBucket(accept_rate, accept_burst, clock())
+        self._ip_buckets = collections.OrderedDict()
+
+    def _reject(self, reason, peer):
+        LOG.debug('Rejecting connection from %s: %s', peer, reason)
+
+        if metrics.ENABLED:
+            metrics.REJECTED.inc(1, (reason, ))
+
+        return False
+
+    def _ip_bucket(self, host, now):
+        bucket = self._ip_buckets.pop(host, None)
+
+        if bucket is None:
+            bucket = TokenBucket(self.ip_accept_rate, self.ip_accept_burst,
+                                 now)
+
+            if len(self._ip_buckets) >= IP_CACHE_SIZE:
+                self._ip_buckets.popitem(last=False)
+
+        self._ip_buckets[host] = bucket
+        return bucket
+
+    def accept(self, addr):
+        host = addr[0] if addr else None
+        now = self.clock()
+
+        if self.pending >= self.max_pending:
+            return self._reject('pending', host)
+
+        if not self._ip_bucket(host, now).consume(now):
+            return self._reject('ip_rate', host)
+
+        if not self._bucket.consume(now):
+            return self._reject('rate', host)
+
+        self.pending = self.pending + 1
+        return True
+
+    def handshaken(self):
+        self.pending = self.pending - 1
+
+    def admit(self, model, device_id):
+        if device_id in model.devices:
+            return self._reject('duplicate', device_id)
+
+        if len(model.devices) >= self.max_devices:
+            return self._reject('devices', device_id)
+
+        return True
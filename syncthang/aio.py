@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import functools
+import logging
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+from OpenSSL import SSL
+
+from .bep import messages
+from .bep import protocol
+from . import admission
+from . import fs
+from . import metrics
+from . import server
+
+
+LOG = logging.getLogger(__name__)
+READ_SIZE = 64 * 1024
+
+
+class TLS(object):
+    # NOTE(jkoelker) asyncio's ssl support can not accept the self-signed
+    #                client certificates devices present, so drive a
+    #                pyOpenSSL connection over memory BIOs instead.
+    def __init__(self, ctx, transport):
+        self.transport = transport
+        self.conn = SSL.Connection(ctx, None)
+        self.conn.set_accept_state()
+        self.handshaken = False
+
+    def feed(self, data):
+        self.conn.bio_write(data)
+        chunks = []
+
+        if not self.handshaken:
+            try:
+                self.conn.do_handshake()
+                self.handshaken = True
+
+            except SSL.WantReadError:
+                pass
+
+        if self.handshaken:
+            while True:
+                try:
+                    chunks.append(self.conn.recv(READ_SIZE))
+
+                except SSL.WantReadError:
+                    break
+
+                except SSL.ZeroReturnError:
+                    break
+
+        self.flush()
+        return b''.join(chunks)
+
+    def write(self, data):
+        view = memoryview(data)
+
+        while view:
+            sent = self.conn.send(view[:READ_SIZE].tobytes())
+            view = view[sent:]
+            self.flush()
+
+    def flush(self):
+        while True:
+            try:
+                data = self.conn.bio_read(READ_SIZE)
+
+            except SSL.WantReadError:
+                break
+
+            if not data:
+                break
+
+            self.transport.write(data)
+
+    def close(self):
+        try:
+            self.conn.shutdown()
+            self.flush()
+
+        except SSL.Error:
+            pass
+
+
+class AsyncRemoteDevice(protocol.Device, asyncio.Protocol):
+    def __init__(self, local_device_id, ctx, model, compress=None,
+                 executor=None, loop=None, gate=None):
+        super(AsyncRemoteDevice, self).__init__(
+            None, model, compress, local_device_id=local_device_id)
+
+        if loop is None:
+            loop = asyncio.get_event_loop()
+
+        if gate is None:
+            gate = admission.Admission()
+
+        self.ctx = ctx
+        self.gate = gate
+        self.loop = loop
+        self.executor = executor
+
+        self.transport = None
+        self.tls = None
+        self.msg_ids = messages.msg_ids()
+        self.last_recv = datetime.datetime.now()
+        self.last_send = datetime.datetime.now()
+
+        self._buf = bytearray()
+        self._started = False
+        self._paused = False
+        self._health_interval = protocol.PING_IDLE_TIME.total_seconds() / 2
+        self._health_timer = None
+        self._handshake_timer = None
+
+        # NOTE(jkoelker) Handlers run inline here, apart from Requests which
+        #                go to the executor. Weigh those by the size of the
+        #                Response they will produce.
+        self.flow = protocol.FlowControl(self._pause_reading,
+                                         self._resume_reading)
+
+    def connection_made(self, transport):
+        if not self.gate.accept(transport.get_extra_info('peername')):
+            transport.close()
+            return
+
+        self.transport = transport
+        self.tls = TLS(self.ctx, transport)
+        self._handshake_timer = self.loop.call_later(
+            self.gate.handshake_timeout, self._handshake_timeout)
+
+    def _handshake_done(self):
+        if self._handshake_timer is None:
+            return
+
+        self._handshake_timer.cancel()
+        self._handshake_timer = None
+        self.gate.handshaken()
+
+    def _handshake_timeout(self):
+        LOG.info('TLS handshake with %s timed out',
+                 self.transport.get_extra_info('peername'))
+        self._handshake_done()
+        self.stop()
+
+    def connection_lost(self, exc):
+        self._handshake_done()
+
+        if self._health_timer is not None:
+            self._health_timer.cancel()
+
+        self.unsubscribe()
+        self._requests.clear()
+
+        if self.observer is not None:
+            self.observer.close()
+
+        if self._started:
+            self.model.release_device(self.device_id)
+
+    def notify_update(self):
+        self.loop.call_soon(self.send_index_update)
+
+    def pause_writing(self):
+        self._paused = True
+
+    def resume_writing(self):
+        self._paused = False
+        self.send_index_update()
+
+    def data_received(self, data):
+        if self.transport is None:
+            return
+
+        try:
+            data = self.tls.feed(data)
+
+        except SSL.Error:
+            LOG.exception('TLS error')
+            return self.transport.close()
+
+        if not self.tls.handshaken:
+            return
+
+        if not self._started:
+            self._handshake_done()
+
+            if not self._start():
+                return
+
+        if not data:
+            return
+
+        self.last_recv = datetime.datetime.now()
+        buf = self._buf
+        buf.extend(data)
+
+        offset = 0
+        while len(buf) - offset >= messages.HEADER_SIZE:
+            header = messages.unpack_header(buf, offset)
+            length = header[-1]
+            end = offset + messages.HEADER_SIZE + length
+
+            if len(buf) < end:
+                break
+
+            payload = None
+            if length > 0:
+                payload = bytes(buf[offset + messages.HEADER_SIZE:end])
+
+            size = end - offset
+            offset = end
+
+            try:
+                msg = messages.decode(header[0], header[1], header[2],
+                                      header[3], payload, self.observer)
+
+            except Exception:
+                LOG.exception('Error decoding message from %s', self.name)
+                return self.stop()
+
+            if msg is not None:
+                self.dispatch(msg, size)
+
+        del buf[:offset]
+
+    def _start(self):
+        cert = self.tls.conn.get_peer_certificate()
+        self.device_id = server.cert_to_device_id(cert)
+
+        if self.device_id == self.local_device_id:
+            LOG.info('Connected to myself (%s) - should not happen',
+                     self.device_id)
+            self.stop()
+            return False
+
+        if not self.gate.admit(self.model, self.device_id):
+            LOG.info('Not admitting device (%s)', self.device_id)
+            self.stop()
+            return False
+
+        if not self.model.claim_device(self.device_id):
+            LOG.info('Connected to already connected device (%s)',
+                     self.device_id)
+            self.stop()
+            return False
+
+        self.observer = metrics.observer(self.device_id)
+        self.flow.observer = self.observer
+
+        self._started = True
+        self.model.devices[self.device_id] = self
+        self.send(self.model.cluster_config(self.device_id))
+        self._health_timer = self.loop.call_later(self._health_interval,
+                                                  self.healthcheck)
+        return True
+
+    def send(self, msg):
+        msg_id = msg.msg_id
+
+        if msg_id is None:
+            msg_id = next(self.msg_ids)
+            msg.msg_id = msg_id
+
+        self._write(messages.Frame.from_message(msg), msg_id)
+
+    def send_frame(self, frame):
+        self._write(frame, next(self.msg_ids))
+
+    def _write(self, frame, msg_id):
+        compress = messages.should_compress(self.compress, frame.msg_type)
+        self.tls.write(messages.encode(frame, msg_id, compress,
+                                       self.observer))
+        self.last_send = datetime.datetime.now()
+
+    def send_index_update(self):
+        # NOTE(jkoelker) While the transport is over its high-water mark,
+        #                leave updates queued in the subscriptions. They
+        #                coalesce into a catch-up if the peer falls behind.
+        if self._paused or self.transport is None:
+            return
+
+        super(AsyncRemoteDevice, self).send_index_update()
+
+    def stop(self):
+        if self.observer is not None:
+            self.observer.close()
+
+        if self.transport is None:
+            return
+
+        self.tls.close()
+        self.transport.close()
+        self.transport = None
+
+    def healthcheck(self):
+        now = datetime.datetime.now()
+
+        if (now - self.last_recv >= protocol.PING_IDLE_TIME and
+                now - self.last_send >= protocol.PING_IDLE_TIME):
+            self.send(messages.Ping())
+
+        self._health_timer = self.loop.call_later(self._health_interval,
+                                                  self.healthcheck)
+
+    def _pause_reading(self):
+        if self.transport is not None:
+            self.transport.pause_reading()
+
+    def _resume_reading(self):
+        if self.transport is not None:
+            self.transport.resume_reading()
+
+    def request(self, msg):
+        # NOTE(jkoelker) The executor's threads are not eventlet's, so they
+        #                must not go through tpool.
+        self.flow.add(msg.size)
+        future = self.loop.run_in_executor(self.executor,
+                                           self.model.request_blocking,
+                                           msg.folder, msg.name, msg.offset,
+                                           msg.size, msg.sha, msg.flags)
+        future.add_done_callback(functools.partial(self._respond, msg))
+
+    def _respond(self, msg, future):
+        self.flow.done(msg.size)
+
+        if self.transport is None:
+            return
+
+        data = b''
+        code = messages.Response.NO_ERROR
+
+        try:
+            data = future.result()
+
+        except Exception:
+            LOG.exception('Request from %s failed', self.name)
+            code = messages.Response.ERROR
+
+        self.send(messages.Response(data, code, msg_id=msg.msg_id))
+
+
+def _hashed(start, future):
+    if not future.cancelled() and future.exception() is None:
+        metrics.hashed(future.result().total_size, metrics.clock() - start)
+
+
+def hash_file(file_path, executor=None, loop=None, large_blocks=False):
+    if loop is None:
+        loop = asyncio.get_event_loop()
+
+    future = loop.run_in_executor(executor, fs.hash_path, file_path,
+                                  large_blocks)
+
+    if metrics.ENABLED:
+        future.add_done_callback(functools.partial(_hashed, metrics.clock()))
+
+    return future
+
+
+def serve(address, ctx, device_id, model, executor=None, loop=None,
+          gate=None):
+    if loop is None:
+        loop = asyncio.get_event_loop()
+
+    if gate is None:
+        gate = admission.Admission()
+
+    factory = functools.partial(AsyncRemoteDevice, device_id, ctx, model,
+                                executor=executor, loop=loop, gate=gate)
+    server = loop.run_until_complete(
+        loop.create_server(factory, address[0], address[1]))
+
+    try:
+        loop.run_forever()
+
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
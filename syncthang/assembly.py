@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import logging
+import os
+
+import eventlet
+from eventlet import patcher
+from eventlet import semaphore
+from eventlet import tpool
+import six
+
+
+LOG = logging.getLogger(__name__)
+
+TEMP_PREFIX = '.syncthing.'
+TEMP_SUFFIX = '.tmp'
+COMMIT_BATCH = 256
+COMMIT_DELAY = 0.1
+COMMIT_CONCURRENCY = 16
+INLINE_WRITE_SIZE = 16 * 1024
+
+_threading = patcher.original('threading')
+_datasync = getattr(os, 'fdatasync', os.fsync)
+
+
+def temp_path(path):
+    dirname, basename = os.path.split(path)
+    return os.path.join(dirname, TEMP_PREFIX + basename + TEMP_SUFFIX)
+
+
+def _preallocate(fd, size):
+    # NOTE(jkoelker) Reserve the extents up front so out of order writes
+    #                neither fragment the file nor fail with ENOSPC half
+    #                way through. Without posix_fallocate (py2) the file
+    #                is only extended, sparse.
+    if size <= 0:
+        return
+
+    fallocate = getattr(os, 'posix_fallocate', None)
+
+    if fallocate is not None:
+        try:
+            return fallocate(fd, 0, size)
+
+        except OSError as e:
+            LOG.debug('posix_fallocate failed (%s), truncating instead', e)
+
+    os.ftruncate(fd, size)
+
+
+class PartialFile(object):
+    # NOTE(jkoelker) write runs in tpool threads, possibly several at once
+    #                for the same file, so it only uses the fd positionally.
+    def __init__(self, path, fileinfo):
+        self.path = path
+        self.temp_path = temp_path(path)
+        self.fileinfo = fileinfo
+
+        blocks = fileinfo.blocks
+        self.offsets = []
+        offset = 0
+
+        for size in blocks.sizes:
+            self.offsets.append(offset)
+            offset = offset + size
+
+        self.size = offset
+        self.missing = set(i for i in range(len(blocks)) if blocks.size(i))
+
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        self.fd = os.open(self.temp_path,
+                          os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+
+        try:
+            _preallocate(self.fd, self.size)
+
+        except Exception:
+            self.abort()
+            raise
+
+        if not hasattr(os, 'pwrite'):
+            self._lock = _threading.Lock()
+
+    @property
+    def complete(self):
+        return not self.missing
+
+    def _pwrite(self, data, offset):
+        if hasattr(os, 'pwrite'):
+            return os.pwrite(self.fd, data, offset)
+
+        with self._lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            return os.write(self.fd, data)
+
+    def _write(self, index, data):
+        blocks = self.fileinfo.blocks
+
+        if len(data) != blocks.size(index):
+            raise ValueError('Block %s of %s is %s bytes, expected %s' % (
+                index, self.fileinfo.name, len(data), blocks.size(index)))
+
+        if hashlib.sha256(data).digest() != blocks.sha(index):
+            raise ValueError('Block %s of %s does not match its hash' % (
+                index, self.fileinfo.name))
+
+        offset = self.offsets[index]
+        view = memoryview(data)
+
+        while view:
+            written = self._pwrite(view, offset)
+            view = view[written:]
+            offset = offset + written
+
+    def _copy(self, path, found):
+        # NOTE(jkoelker) The old file may have changed since it was matched,
+        #                so copied blocks are verified like pulled ones.
+        blocks = self.fileinfo.blocks
+        copied = []
+
+        with open(path, 'rb') as stream:
+            for index, offset in sorted(found.items(), key=lambda i: i[1]):
+                stream.seek(offset)
+
+                try:
+                    self._write(index, stream.read(blocks.size(index)))
+
+                except ValueError as e:
+                    LOG.debug('Not reusing block: %s', e)
+                    continue
+
+                copied.append(index)
+
+        return copied
+
+    def write(self, index, data):
+        # NOTE(jkoelker) hashlib and the write both release the GIL, so
+        #                blocks for many files verify and land in parallel.
+        #                Small blocks are cheaper to do than to hand off.
+        if len(data) <= INLINE_WRITE_SIZE:
+            self._write(index, data)
+
+        else:
+            tpool.execute(self._write, index, data)
+
+        self.missing.discard(index)
+
+    def _finish(self):
+        fileinfo = self.fileinfo
+
+        if not fileinfo.no_permissions:
+            os.fchmod(self.fd, fileinfo.mode or 0o644)
+
+        _datasync(self.fd)
+        os.close(self.fd)
+        self.fd = None
+
+        os.utime(self.temp_path, (fileinfo.modified, fileinfo.modified))
+
+    def abort(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+        try:
+            os.unlink(self.temp_path)
+
+        except OSError:
+            pass
+
+
+def match(path, blocks, wanted):
+    # NOTE(jkoelker) Returns {block index: offset in path} for the wanted
+    #                blocks the file at path already has on the same block
+    #                boundaries. That catches appends and in place edits but
+    #                not insertions, which would need weak hashes BEP v0
+    #                does not carry.
+    length = blocks.block_size
+    shas = {}
+
+    for index in wanted:
+        shas.setdefault(blocks.sha(index), []).append(index)
+
+    found = {}
+    offset = 0
+
+    with open(path, 'rb') as stream:
+        while shas:
+            data = stream.read(length)
+
+            if not data:
+                break
+
+            for index in shas.pop(hashlib.sha256(data).digest(), ()):
+                found[index] = offset
+
+            offset = offset + len(data)
+
+    return found
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+
+    try:
+        os.fsync(fd)
+
+    finally:
+        os.close(fd)
+
+
+class Assembler(object):
+    # NOTE(jkoelker) Completed files are committed in batches: their data
+    #                is synced concurrently, which lets the filesystem
+    #                group the journal commits, then they are all renamed
+    #                into place and each directory is synced once.
+    def __init__(self, root, batch=COMMIT_BATCH, delay=COMMIT_DELAY,
+                 concurrency=COMMIT_CONCURRENCY):
+        self.root = root
+        self.batch = batch
+        self.delay = delay
+
+        self._pool = eventlet.GreenPool(concurrency)
+        self._pending = []
+        self._timer = None
+        self._flushing = semaphore.Semaphore(1)
+
+    def path(self, fileinfo):
+        # NOTE(jkoelker) Resolve symlinks on both sides, a link inside the
+        #                folder must not lead the write out of it.
+        root = os.path.realpath(self.root)
+        name = fileinfo.name
+
+        if (isinstance(root, six.text_type) and
+                isinstance(name, six.binary_type)):
+            name = name.decode('utf-8')
+
+        path = os.path.realpath(os.path.join(root, name))
+
+        if not path.startswith(root + os.sep):
+            raise ValueError('%s is outside of %s' % (fileinfo.name, root))
+
+        return path
+
+    def _open(self, fileinfo):
+        return PartialFile(self.path(fileinfo), fileinfo)
+
+    def open(self, fileinfo):
+        # NOTE(jkoelker) Preallocating can write out the whole file where
+        #                the filesystem has no fallocate, keep it off the
+        #                hub.
+        return tpool.execute(self._open, fileinfo)
+
+    def reuse(self, partial, path=None):
+        # NOTE(jkoelker) Copy the blocks an older version of the file (or
+        #                any local file) already has, so only the rest need
+        #                to be pulled.
+        if path is None:
+            path = partial.path
+
+        if not partial.missing or not os.path.isfile(path):
+            return 0
+
+        blocks = partial.fileinfo.blocks
+        found = tpool.execute(match, path, blocks, sorted(partial.missing))
+
+        if not found:
+            return 0
+
+        copied = tpool.execute(partial._copy, path, found)
+        partial.missing.difference_update(copied)
+        return len(copied)
+
+    def commit(self, partial, callback=None):
+        if not partial.complete:
+            raise ValueError('%s is missing %s blocks' % (
+                partial.fileinfo.name, len(partial.missing)))
+
+        self._pending.append((partial, callback))
+
+        if len(self._pending) >= self.batch:
+            return self.flush()
+
+        if self._timer is None:
+            self._timer = eventlet.spawn_after(self.delay, self.flush)
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        pending, self._pending = self._pending, []
+
+        # NOTE(jkoelker) Batches commit one at a time, so once flush returns
+        #                everything committed before the call is durable.
+        with self._flushing:
+            if pending:
+                self._flush(pending)
+
+    def _flush(self, pending):
+        def _finish(item):
+            partial, callback = item
+
+            try:
+                tpool.execute(partial._finish)
+                return item, None
+
+            except Exception as e:
+                LOG.exception('Failed to sync %s', partial.temp_path)
+                partial.abort()
+                return item, e
+
+        directories = set()
+        done = []
+
+        for item, error in self._pool.imap(_finish, pending):
+            if error is None:
+                partial = item[0]
+
+                # NOTE(jkoelker) One failed rename must not keep the rest
+                #                of the batch from their callbacks.
+                try:
+                    os.rename(partial.temp_path, partial.path)
+                    directories.add(os.path.dirname(partial.path))
+
+                except Exception as e:
+                    LOG.exception('Failed to rename %s', partial.temp_path)
+                    partial.abort()
+                    error = e
+
+            done.append((item, error))
+
+        for directory in directories:
+            tpool.execute(_fsync_dir, directory)
+
+        for (partial, callback), error in done:
+            if callback is not None:
+                callback(partial.fileinfo, error)
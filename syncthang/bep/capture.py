@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import struct
+import time
+
+import eventlet
+
+
+LOG = logging.getLogger(__name__)
+
+MAGIC = b'BEPCAP01'
+DEVICE_ID_SIZE = 32
+
+INBOUND = 0
+OUTBOUND = 1
+
+# NOTE(jkoelker) A capture is the magic and the remote device id, then
+#                one record per frame: when it was read or written, which
+#                way it went and the frame exactly as it was on the wire,
+#                header included and still compressed.
+_HEADER = struct.Struct('!8s%ss' % DEVICE_ID_SIZE)
+_RECORD = struct.Struct('!dBI')
+
+
+class Capture(object):
+    def __init__(self, path, device_id=b'', clock=time.time):
+        self.path = path
+        self.clock = clock
+        self.frames = 0
+
+        self._file = open(path, 'wb')
+        self._file.write(_HEADER.pack(MAGIC, device_id))
+
+    def record(self, direction, data):
+        self._file.write(_RECORD.pack(self.clock(), direction, len(data)))
+        self._file.write(data)
+        self.frames = self.frames + 1
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+
+class Reader(object):
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+
+        magic, self.device_id = _HEADER.unpack(
+            self._file.read(_HEADER.size))
+
+        if magic != MAGIC:
+            self.close()
+            raise ValueError('%s is not a BEP capture' % path)
+
+    def __iter__(self):
+        while True:
+            header = self._file.read(_RECORD.size)
+
+            if len(header) < _RECORD.size:
+                break
+
+            timestamp, direction, size = _RECORD.unpack(header)
+            data = self._file.read(size)
+
+            if len(data) < size:
+                LOG.warning('%s ends with a partial frame', self.path)
+                break
+
+            yield timestamp, direction, data
+
+    def close(self):
+        self._file.close()
+
+
+class ReplaySocket(object):
+    # NOTE(jkoelker) Stands in for the device's socket: recv returns the
+    #                captured inbound frames and sendall throws away what
+    #                we answer. With a speed the frames arrive at the pace
+    #                they were captured at (2.0 is twice as fast), without
+    #                one as fast as they are read.
+    def __init__(self, reader, speed=None, clock=time.time):
+        self.reader = reader
+        self.speed = speed
+        self.clock = clock
+
+        self.frames = 0
+        self.received = 0
+        self.sent = 0
+        self.closed = False
+
+        self._frames = (data for _, direction, data in self._paced()
+                        if direction == INBOUND)
+        self._buffer = b''
+
+    def _paced(self):
+        start = None
+
+        for timestamp, direction, data in self.reader:
+            if self.speed and direction == INBOUND:
+                if start is None:
+                    start = (timestamp, self.clock())
+
+                delay = ((timestamp - start[0]) / self.speed -
+                         (self.clock() - start[1]))
+
+                if delay > 0:
+                    eventlet.sleep(delay)
+
+            yield timestamp, direction, data
+
+    def recv(self, size):
+        if not self._buffer:
+            self._buffer = next(self._frames, b'')
+            self.frames = self.frames + bool(self._buffer)
+
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self.received = self.received + len(data)
+        return data
+
+    def sendall(self, data):
+        self.sent = self.sent + len(data)
+
+    def shutdown(self):
+        pass
+
+    def close(self):
+        self.closed = True
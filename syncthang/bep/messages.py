@@ -1,8 +1,8 @@
 # -*- coding: utf-8 -*-
 
+import array
 import base64
 import datetime
-import hashlib
 import logging
 import struct
 import xdrlib
@@ -11,6 +11,7 @@ import lz4
 import six
 
 from . import baluhn
+from . import capture
 
 
 LOG = logging.getLogger(__name__)
@@ -24,15 +25,31 @@ PONG = 5
 INDEX_UPDATE = 6
 CLOSE = 7
 
+MESSAGE_NAMES = {
+    CLUSTER_CONFIG: 'cluster_config',
+    INDEX: 'index',
+    REQUEST: 'request',
+    RESPONSE: 'response',
+    PING: 'ping',
+    PONG: 'pong',
+    INDEX_UPDATE: 'index_update',
+    CLOSE: 'close',
+}
+
 COMPRESSION_THREASHOLD = 128
 
+SHA_SIZE = 32
+
 _HEADER = struct.Struct('!II')
 _SHORT = struct.Struct('!I')
+_BLOCK = struct.Struct('!II%ss' % SHA_SIZE)
+
+HEADER_SIZE = _HEADER.size
 
 _MESSAGE_TYPES = {}
 
 
-_b32alphabet = base64._b32tab
+_b32alphabet = getattr(base64, '_b32tab', None)
 if not _b32alphabet:
     _b32alphabet = base64._b32alphabet
 
@@ -65,11 +82,6 @@ def format_device_id_from_bytes(device_bytes):
     return '-'.join(chunks)
 
 
-def device_id_from_cert(cert_bytes):
-    sha = hashlib.sha256(cert_bytes).digest()
-    return sha[:32]
-
-
 def register(cls_type):
     def _inner(subcls):
         _MESSAGE_TYPES[cls_type] = subcls
@@ -79,9 +91,9 @@ def register(cls_type):
 
 
 def pack_options(packer, options):
-    packer.pack_array(options.items(),
-                      lambda key, value: (packer.pack_string(key),
-                                          packer.pack_string(value)))
+    packer.pack_array(list(options.items()),
+                      lambda item: (packer.pack_string(item[0]),
+                                    packer.pack_string(item[1])))
 
 
 def unpack_options(unpacker):
@@ -97,6 +109,8 @@ def msg_ids(next_id=0):
 
 
 class FlagMixin(object):
+    __slots__ = ()
+
     def _set_value(self, value, mask):
         if value:
             self.flags = self.flags | mask
@@ -107,11 +121,72 @@ class FlagMixin(object):
         return self.flags & mask != 0
 
 
+def unpack_header(buf, offset=0):
+    header, length = _HEADER.unpack_from(buf, offset)
+
+    version = header >> 28 & 0xf
+    msg_id = header >> 16 & 0xfff
+    msg_type = header >> 8 & 0xff
+    compression = header & 1 == 1
+
+    return version, msg_id, msg_type, compression, length
+
+
+def decode(version, msg_id, msg_type, compression, buf, observer=None):
+    # NOTE(jkoelker) observer, see metrics.Observer, is told about every
+    #                frame when metrics are enabled.
+    if observer is not None:
+        observer.frame('in', msg_type, HEADER_SIZE + len(buf or b''))
+
+    if version != 0:
+        return None
+
+    subcls = _MESSAGE_TYPES.get(msg_type)
+
+    if not subcls:
+        return None
+
+    if buf and compression:
+        compressed_size = len(buf)
+        buf = lz4.uncompress(buf)
+
+        if observer is not None:
+            observer.compression('in', compressed_size, len(buf))
+
+    return subcls.unpack(msg_id, buf)
+
+
+def encode(frame, msg_id, compress, observer=None):
+    version = (0 & 0xf) << 28
+    msg_type = (frame.msg_type & 0xff) << 8
+    compression, msg = frame.body(compress)
+
+    if observer is not None:
+        observer.frame('out', frame.msg_type, HEADER_SIZE + len(msg))
+
+        if compression:
+            observer.compression('out', len(msg), len(frame.payload))
+
+    header = version + ((msg_id & 0xfff) << 16) + msg_type + compression
+    return _HEADER.pack(header, len(msg)) + msg
+
+
+def should_compress(compress, msg_type):
+    if compress:
+        return True
+
+    return compress is False and msg_type != RESPONSE
+
+
 class Connection(six.Iterator):
-    def __init__(self, sock, compress=None):
+    def __init__(self, sock, compress=None, capture=None, observer=None):
         self.sock = sock
         self.compress = compress
+        self.capture = capture
+        self.observer = observer
         self.msg_ids = msg_ids()
+        self.eof = False
+        self.last_size = 0
         self.last_recv = datetime.datetime.now()
         self.last_send = datetime.datetime.now()
 
@@ -119,81 +194,117 @@ class Connection(six.Iterator):
         return self
 
     def __next__(self):
-        if not self.sock:
+        # NOTE(jkoelker) Only reading stops at the end of the stream, frames
+        #                already read may still need to be answered.
+        if self.eof or not self.sock:
             raise StopIteration()
 
         try:
-            msg = self.get_message()
+            msg = self.get()
 
             while msg is None:
                 msg = self.get()
 
             return msg
 
+        except EOFError:
+            LOG.debug('Connection closed by peer')
+            self.eof = True
+            raise StopIteration()
+
         except Exception:
             LOG.exception('Error getting message')
-            self.sock = None
+            self.eof = True
             raise StopIteration()
 
-    def get(self):
-        buf = self.sock.recv(8)
-        header, length = _HEADER.unpack_from(buf)
+    def _recv(self, size):
+        chunks = []
 
-        version = header >> 28 & 0xf
-        msg_id = header >> 16 & 0xff
-        msg_type = header >> 8 & 0xff
-        compression = header & 1 == 1
+        while size > 0:
+            data = self.sock.recv(size)
 
-        if version != 0:
-            return None
+            if not data:
+                raise EOFError('Connection closed by peer')
 
-        subcls = _MESSAGE_TYPES.get(msg_type)
+            chunks.append(data)
+            size = size - len(data)
 
-        if not subcls:
-            return None
+        return b''.join(chunks)
+
+    def get(self):
+        header = self._recv(HEADER_SIZE)
+        version, msg_id, msg_type, compression, length = unpack_header(header)
 
         buf = None
         if length > 0:
-            buf = self.sock.recv(length)
+            buf = self._recv(length)
 
-            if compression:
-                buf = lz4.uncompress(buf)
+        if self.capture is not None:
+            self.capture.record(capture.INBOUND, header + (buf or b''))
 
+        self.last_size = HEADER_SIZE + length
         self.last_recv = datetime.datetime.now()
-        return subcls.unpack(msg_id, buf)
+        return decode(version, msg_id, msg_type, compression, buf,
+                      self.observer)
 
     def send(self, message):
-        version = (0 & 0xf) << 28
         msg_id = message.msg_id
 
-        if not msg_id:
+        if msg_id is None:
             msg_id = next(self.msg_ids)
-            message.msg_ig = msg_id
-
-        msg_id = (msg_id & 0xfff) << 16
-        msg_type = (message._MESSAGE_TYPE & 0xff) << 8
+            message.msg_id = msg_id
 
-        compress = False
-        compression = 0
+        self.send_frame(Frame.from_message(message), msg_id)
 
-        if self.compress:
-            compress = True
-
-        elif self.compress is False and message._MESSAGE_TYPE != RESPONSE:
-            compress = True
+    def send_frame(self, frame, msg_id=None):
+        if msg_id is None:
+            msg_id = next(self.msg_ids)
 
-        msg = message.pack()
+        compress = should_compress(self.compress, frame.msg_type)
+        data = encode(frame, msg_id, compress, self.observer)
 
-        if compress and len(msg) >= COMPRESSION_THREASHOLD:
-            compression = 1
-            msg = lz4.compress(msg)
+        if self.capture is not None:
+            self.capture.record(capture.OUTBOUND, data)
 
-        header = version + msg_id + msg_type + compression
-        data = _HEADER.pack(header, len(msg)) + msg
         self.sock.sendall(data)
         self.last_send = datetime.datetime.now()
 
 
+class Frame(object):
+    # NOTE(jkoelker) An immutable encoded message body. The compressed form
+    #                is computed at most once, so a single Frame can be
+    #                shared by every connection it is sent to.
+    __slots__ = ('msg_type', 'payload', '_compressed')
+
+    def __init__(self, msg_type, payload):
+        self.msg_type = msg_type
+        self.payload = payload
+        self._compressed = None
+
+    @classmethod
+    def from_message(cls, message):
+        return cls(message._MESSAGE_TYPE, message.pack())
+
+    def body(self, compress):
+        if not compress or len(self.payload) < COMPRESSION_THREASHOLD:
+            return 0, self.payload
+
+        if self._compressed is None:
+            self._compressed = lz4.compress(self.payload)
+
+        return 1, self._compressed
+
+
+class Packed(object):
+    def __init__(self, msg_type, payload, msg_id=None):
+        self._MESSAGE_TYPE = msg_type
+        self.payload = payload
+        self.msg_id = msg_id
+
+    def pack(self):
+        return self.payload
+
+
 class Folder(FlagMixin):
     def __init__(self, ident, devices=None, flags=0, options=None):
         if options is None:
@@ -246,7 +357,7 @@ class Device(FlagMixin):
 
     @property
     def short(self):
-        (short_ident, ) = _SHORT.unpack_from(buffer(self.ident))
+        (short_ident, ) = _SHORT.unpack_from(self.ident)
         return short_ident
 
     @classmethod
@@ -327,6 +438,9 @@ class ClusterConfig(object):
 
 
 class FileInfo(FlagMixin):
+    __slots__ = ('name', 'flags', 'modified', 'version', 'local_version',
+                 '_blocks')
+
     DELETED = 1 << 12
     INVALID = 1 << 13
     DIRECTORY = 1 << 14
@@ -338,9 +452,6 @@ class FileInfo(FlagMixin):
 
     def __init__(self, name, flags, modified, version, local_version=0,
                  blocks=None):
-        if blocks is None:
-            blocks = []
-
         self.name = name
         self.flags = flags
         self.modified = modified
@@ -358,7 +469,7 @@ class FileInfo(FlagMixin):
         modified = unpacker.unpack_uhyper()
         version = Vector.unpack(unpacker)
         local_version = unpacker.unpack_uhyper()
-        blocks = unpacker.unpack_array(lambda: BlockInfo.unpack(unpacker))
+        blocks = BlockList.unpack(unpacker)
 
         return cls(name, flags, modified, version, local_version, blocks)
 
@@ -368,10 +479,25 @@ class FileInfo(FlagMixin):
         packer.pack_uhyper(self.modified)
         Vector(self.version).pack(packer)
         packer.pack_uhyper(self.local_version)
-        packer.pack_array(self.blocks, lambda block: block.pack(packer))
+        self._blocks.pack(packer)
+
+    @property
+    def blocks(self):
+        return self._blocks
+
+    @blocks.setter
+    def blocks(self, blocks):
+        if not isinstance(blocks, BlockList):
+            blocks = BlockList(blocks)
+
+        self._blocks = blocks
 
     def add_block(self, size, sha):
-        self.blocks.append(BlockInfo(size, sha))
+        self._blocks.add(size, sha)
+
+    @property
+    def block_size(self):
+        return self._blocks.block_size
 
     @property
     def deleted(self):
@@ -423,11 +549,11 @@ class FileInfo(FlagMixin):
 
     @property
     def mode(self):
-        return self.flags & 0777
+        return self.flags & 0o777
 
     @mode.setter
     def mode(self, value):
-        self.flags = self.flags | (value & 0777)
+        self.flags = self.flags | (value & 0o777)
 
 
 class Vector(dict):
@@ -439,9 +565,9 @@ class Vector(dict):
         return cls(counters)
 
     def pack(self, packer):
-        packer.pack_array(self.items(),
-                          lambda ident, value: (packer.pack_uhyper(ident),
-                                                packer.pack_uhyper(value)))
+        packer.pack_array(list(self.items()),
+                          lambda item: (packer.pack_uhyper(item[0]),
+                                        packer.pack_uhyper(item[1])))
 
     def add(self, ident, value):
         if ident in self and value <= self[ident]:
@@ -470,6 +596,8 @@ class Vector(dict):
 
 
 class BlockInfo(object):
+    __slots__ = ('size', 'sha')
+
     def __init__(self, size, sha):
         self.size = size
         self.sha = sha
@@ -486,6 +614,139 @@ class BlockInfo(object):
         packer.pack_opaque(self.sha)
 
 
+class BlockList(object):
+    # NOTE(jkoelker) Store the blocks of a file as one contiguous buffer of
+    #                digests and a packed array of sizes. BlockInfo objects
+    #                are only created as views when a block is accessed.
+    __slots__ = ('_shas', '_sizes')
+
+    def __init__(self, blocks=None):
+        self._shas = bytearray()
+        self._sizes = array.array('I')
+
+        if blocks:
+            self.extend(blocks)
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def __iter__(self):
+        for index in six.moves.range(len(self._sizes)):
+            yield self._view(index)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            blocks = BlockList()
+            for i in six.moves.range(*index.indices(len(self))):
+                blocks.add(self._sizes[i], self.sha(i))
+            return blocks
+
+        if index < 0:
+            index = index + len(self)
+
+        if not 0 <= index < len(self):
+            raise IndexError('block index out of range')
+
+        return self._view(index)
+
+    def __eq__(self, other):
+        if not isinstance(other, BlockList):
+            return NotImplemented
+
+        return self._sizes == other._sizes and self._shas == other._shas
+
+    def __ne__(self, other):
+        if not isinstance(other, BlockList):
+            return NotImplemented
+
+        return not self == other
+
+    def _view(self, index):
+        return BlockInfo(self._sizes[index], self.sha(index))
+
+    def sha(self, index):
+        start = index * SHA_SIZE
+        return bytes(self._shas[start:start + SHA_SIZE])
+
+    def size(self, index):
+        return self._sizes[index]
+
+    @property
+    def shas(self):
+        return memoryview(self._shas)
+
+    @property
+    def sizes(self):
+        return self._sizes
+
+    @property
+    def total_size(self):
+        return sum(self._sizes)
+
+    @property
+    def block_size(self):
+        # NOTE(jkoelker) Block sizes vary per file, but within a file every
+        #                block except the last has the same size, so the first
+        #                one records it.
+        if not self._sizes:
+            return 0
+
+        return self._sizes[0]
+
+    def offset(self, index):
+        return index * self.block_size
+
+    def add(self, size, sha):
+        if len(sha) != SHA_SIZE:
+            raise ValueError('Block digest must be %s bytes' % SHA_SIZE)
+
+        self._sizes.append(size)
+        self._shas.extend(sha)
+
+    def append(self, block):
+        self.add(block.size, block.sha)
+
+    def extend(self, blocks):
+        if isinstance(blocks, BlockList):
+            self._sizes.extend(blocks._sizes)
+            self._shas.extend(blocks._shas)
+            return
+
+        for block in blocks:
+            self.add(block.size, block.sha)
+
+    @classmethod
+    def unpack(cls, unpacker):
+        blocks = cls()
+        count = unpacker.unpack_uint()
+
+        buf = unpacker.get_buffer()
+        position = unpacker.get_position()
+        unpack_block = _BLOCK.unpack_from
+        add_size = blocks._sizes.append
+        add_sha = blocks._shas.extend
+
+        for _ in six.moves.range(count):
+            size, length, sha = unpack_block(buf, position)
+
+            if length != SHA_SIZE:
+                raise ValueError('Block digest must be %s bytes' % SHA_SIZE)
+
+            add_size(size)
+            add_sha(sha)
+            position = position + _BLOCK.size
+
+        unpacker.set_position(position)
+        return blocks
+
+    def pack(self, packer):
+        packer.pack_uint(len(self._sizes))
+
+        for index, size in enumerate(self._sizes):
+            packer.pack_uint(size)
+            packer.pack_opaque(self.sha(index))
+
+
 @register(INDEX)
 class Index(FlagMixin):
     def __init__(self, folder, files, flags=0, options=None, msg_id=None):
@@ -533,7 +794,7 @@ class Request(FlagMixin):
             options = {}
 
         if sha is None:
-            sha = ''
+            sha = b''
 
         self.msg_id = msg_id
         self.folder = folder
@@ -542,6 +803,7 @@ class Request(FlagMixin):
         self.size = size
         self.sha = sha
         self.flags = flags
+        self.options = options
 
     @classmethod
     def unpack(cls, msg_id, buf):
@@ -610,7 +872,7 @@ class PingPong(object):
         return cls(msg_id)
 
     def pack(self):
-        return ''
+        return b''
 
 
 @register(PING)
@@ -618,6 +880,7 @@ class Ping(PingPong):
     pass
 
 
+@register(PONG)
 class Pong(PingPong):
     pass
 
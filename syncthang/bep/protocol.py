@@ -1,9 +1,15 @@
 # -*- coding: utf-8 -*-
 
+import abc
 import datetime
 import logging
+import timeit
 
 import eventlet
+from eventlet import event
+from eventlet import queue
+from eventlet import semaphore
+import six
 
 from . import messages
 
@@ -11,92 +17,178 @@ from . import messages
 LOG = logging.getLogger(__name__)
 PING_IDLE_TIME = datetime.timedelta(seconds=60)
 BLOCK_SIZE = 128 * 1024
+MAX_BLOCK_SIZE = 16 * 1024 * 1024
+DESIRED_BLOCKS = 2000
+SLOW_HANDLER_TIME = 0.5
+INBOUND_HIGH_WATERMARK = 8 * 1024 * 1024
+INBOUND_LOW_WATERMARK = 2 * 1024 * 1024
 
+_clock = timeit.default_timer
 
-class RemoteDevice(object):
-    def __init__(self, device_id, sock, model, compress=None,
-                 response_handler=None):
-        self.device_id = device_id
-        self.sock = sock
-        self.model = model
-        self.response_handler = response_handler
 
-        self.name = None
-        self.version = None
+def block_size(file_size, large_blocks=False):
+    # NOTE(jkoelker) Double the block size until the file fits in about
+    #                DESIRED_BLOCKS blocks. Off by default, peers that assume
+    #                every block is BLOCK_SIZE long can not handle it, see
+    #                model.FolderConfig.
+    size = BLOCK_SIZE
 
-        self.conn = messages.Messages(sock, compress)
+    if not large_blocks:
+        return size
 
-        self._health_interval = PING_IDLE_TIME.total_seconds() / 2
-        self._health_timer = eventlet.spawn_after(self._health_interval,
-                                                  self.healthcheck)
+    while size < MAX_BLOCK_SIZE and file_size > size * DESIRED_BLOCKS:
+        size = size * 2
 
-    def send(self, msg):
-        self.conn.send(msg)
+    return size
 
-    def start(self):
-        self._health_timer.start()
-        self.send(self.model.cluster_config(self.device_id))
 
-        def _wait_for_update():
-            self.model.update.wait()
-            self.send_index_update()
-            eventlet.spawn(_wait_for_update)
+class FlowControl(object):
+    # NOTE(jkoelker) Tracks the bytes of inbound work a device has accepted
+    #                but not finished. Reading stops at the high watermark,
+    #                letting TCP push back on the peer, and starts again
+    #                once the work drains to the low watermark.
+    def __init__(self, pause, resume, high=INBOUND_HIGH_WATERMARK,
+                 low=INBOUND_LOW_WATERMARK, observer=None):
+        self.pause = pause
+        self.resume = resume
+        self.high = high
+        self.low = low
+        self.observer = observer
+
+        self.size = 0
+        self.paused_at = None
 
-        eventlet.spawn(_wait_for_update)
+    @property
+    def paused(self):
+        return self.paused_at is not None
 
-        for msg in self.conn:
-            handler = None
+    def add(self, size):
+        self.size = self.size + size
 
-            if msg._MESSAGE_TYPE == messages.CLUSTER_CONFIG:
-                handler = self.cluster_config
+        if self.paused_at is None and self.size >= self.high:
+            self.paused_at = _clock()
+            self.pause()
 
-            elif msg._MESSAGE_TYPE == messages.INDEX:
-                handler = self.index
+    def done(self, size):
+        self.size = self.size - size
 
-            elif msg._MESSAGE_TYPE == messages.REQUEST:
-                handler = self.request
+        if self.paused_at is not None and self.size <= self.low:
+            if self.observer is not None:
+                self.observer.paused(_clock() - self.paused_at)
 
-            elif msg._MESSAGE_TYPE == messages.RESPONSE:
-                handler = self.response
+            self.paused_at = None
+            self.resume()
 
-            elif msg._MESSAGE_TYPE == messages.PING:
-                handler = self.ping
 
-            elif msg._MESSAGE_TYPE == messages.PONG:
-                handler = self.pong
+@six.add_metaclass(abc.ABCMeta)
+class Device(object):
+    # NOTE(jkoelker) Message handling shared by every transport. Subclasses
+    #                provide send, stop and the plumbing to feed dispatch.
+    #                observer, see metrics.Observer, is only given when
+    #                metrics are enabled.
+    slow_handler_time = SLOW_HANDLER_TIME
 
-            elif msg._MESSAGE_TYPE == messages.INDEX_UPDATE:
-                handler = self.index_update
+    def __init__(self, device_id, model, compress=None,
+                 response_handler=None, local_device_id=None, observer=None):
+        self.device_id = device_id
+        self.local_device_id = local_device_id
+        self.model = model
+        self.compress = compress
+        self.response_handler = response_handler
+        self.observer = observer
+
+        self.name = None
+        self.version = None
 
-            elif msg._MESSAGE_TYPE == messages.CLOSE:
-                handler = self.close
+        self._subscriptions = []
+        self._requests = {}
+        self._handlers = {
+            messages.CLUSTER_CONFIG: self.cluster_config,
+            messages.INDEX: self.index,
+            messages.REQUEST: self.request,
+            messages.RESPONSE: self.response,
+            messages.PING: self.ping,
+            messages.PONG: self.pong,
+            messages.INDEX_UPDATE: self.index_update,
+            messages.CLOSE: self.close,
+        }
+
+    @abc.abstractmethod
+    def send(self, msg):
+        pass
 
-            if handler is not None:
-                handler(msg)
+    @abc.abstractmethod
+    def send_frame(self, frame):
+        pass
 
+    @abc.abstractmethod
     def stop(self):
-        self._health_timer.cancel()
-        self.sock.close()
+        pass
 
-    def healthcheck(self):
-        recv = datetime.datetime.now() - self.conn.last_recv
-        send = datetime.datetime.now() - self.conn.last_send
+    @abc.abstractmethod
+    def notify_update(self):
+        pass
 
-        if recv < PING_IDLE_TIME or send < PING_IDLE_TIME:
+    def dispatch(self, msg, size=None):
+        handler = self._handlers.get(msg._MESSAGE_TYPE)
+
+        if handler is None:
             return
 
-        self.send(messages.Ping())
-        self._health_timer = eventlet.spawn_after(self._health_interval,
-                                                  self.healthcheck)
+        start = _clock()
+
+        try:
+            handler(msg)
+
+        finally:
+            elapsed = _clock() - start
+
+            if self.observer is not None:
+                self.observer.handled(msg._MESSAGE_TYPE, elapsed)
+
+            if elapsed >= self.slow_handler_time:
+                LOG.warning('Slow %s handler for %s: %.3fs, %s bytes',
+                            messages.MESSAGE_NAMES[msg._MESSAGE_TYPE],
+                            self.name or self.device_id, elapsed, size)
+
+    def subscribe(self, versions=None):
+        if versions is None:
+            versions = {}
+
+        for folder in self.model.device_folders(self.device_id):
+            version = self.model.resume_version(self.device_id, folder,
+                                                versions.get(folder, 0))
+            subscription = self.model.fanout.subscribe(folder,
+                                                       self.notify_update,
+                                                       self.device_id,
+                                                       version)
+            self._subscriptions.append(subscription)
+
+    def unsubscribe(self):
+        for subscription in self._subscriptions:
+            subscription.close()
+
+        self._subscriptions = []
 
     def send_index_update(self):
-        pass
+        for subscription in self._subscriptions:
+            frame = subscription.get()
+
+            while frame is not None:
+                self.send_frame(frame)
+                self.model.index_sent(self.device_id, subscription.folder,
+                                      subscription.version)
+                frame = subscription.get()
 
     def send_request(self, folder, name, offset, size, sha=None, flags=0,
-                     options=None):
+                     options=None, msg_id=None):
         msg = messages.Request(folder, name, offset, size, sha, flags,
-                               options)
+                               options, msg_id)
         self.send(msg)
+
+        if self.observer is not None:
+            self._requests[msg.msg_id] = _clock()
+
         return msg.msg_id
 
     def close(self, msg):
@@ -115,6 +207,17 @@ class RemoteDevice(object):
                                          self.version, msg.folders,
                                          msg.options)
 
+        # NOTE(jkoelker) Our entry in each folder says how much of our index
+        #                the device already has, so only send it the rest.
+        versions = {}
+
+        for folder in msg.folders:
+            for device in folder.devices:
+                if device.ident == self.local_device_id:
+                    versions[folder.ident] = device.max_local_version
+
+        self.subscribe(versions)
+
     def index(self, msg):
         self.model.update_index(self.device_id, msg.folder, msg.files,
                                 msg.flags, msg.options)
@@ -130,7 +233,9 @@ class RemoteDevice(object):
         LOG.debug('Device: %s pong revieved', self.name)
 
     def request(self, msg):
-        LOG.debug('Request from %s code: %s', self.name, msg.code)
+        LOG.debug('Request from %s for %s/%s', self.name, msg.folder,
+                  msg.name)
+        data = b''
         code = messages.Response.NO_ERROR
 
         try:
@@ -138,11 +243,155 @@ class RemoteDevice(object):
                                       msg.size, msg.sha, msg.flags)
 
         except Exception:
+            LOG.exception('Request from %s failed', self.name)
             code = messages.Response.ERROR
 
-        self.send(messages.Reponse(data, code, msg_id=msg.msg_id))
+        self.send(messages.Response(data, code, msg_id=msg.msg_id))
 
     def response(self, msg):
         LOG.debug('Response from %s code: %s', self.name, msg.code)
+        start = self._requests.pop(msg.msg_id, None)
+
+        if start is not None and self.observer is not None:
+            self.observer.responded(_clock() - start)
+
         if self.response_handler:
             self.response_handler(msg.msg_id, msg.data, msg.code)
+
+
+class RemoteDevice(Device):
+    def __init__(self, device_id, sock, model, compress=None,
+                 response_handler=None, local_device_id=None, capture=None,
+                 observer=None):
+        super(RemoteDevice, self).__init__(device_id, model, compress,
+                                           response_handler, local_device_id,
+                                           observer)
+        self.sock = sock
+        self.conn = messages.Connection(sock, compress, capture, observer)
+
+        self._updates = semaphore.Semaphore(0)
+        self._sender = None
+
+        self._inbound = queue.LightQueue()
+        self._readable = None
+        self._fetches = {}
+        self._running = True
+        self.flow = FlowControl(self._pause_reading, self._resume_reading,
+                                observer=observer)
+
+        self._health_interval = PING_IDLE_TIME.total_seconds() / 2
+        self._health_timer = eventlet.spawn_after(self._health_interval,
+                                                  self.healthcheck)
+
+    def send(self, msg):
+        self.conn.send(msg)
+
+    def send_frame(self, frame):
+        self.conn.send_frame(frame)
+
+    def notify_update(self):
+        self._updates.release()
+
+    def fetch(self, folder, name, offset, size, sha=None):
+        # NOTE(jkoelker) Waits for the Response, so it must not be called
+        #                from the green thread dispatching them. The msg_id
+        #                is taken up front so the Response can not arrive
+        #                before anybody waits for it.
+        msg_id = next(self.conn.msg_ids)
+        waiter = self._fetches[msg_id] = event.Event()
+        self.send_request(folder, name, offset, size, sha, msg_id=msg_id)
+        data, code = waiter.wait()
+
+        if code != messages.Response.NO_ERROR:
+            raise IOError('%s could not serve %s at %s' % (
+                self.name or self.device_id, name, offset))
+
+        return data
+
+    def response(self, msg):
+        super(RemoteDevice, self).response(msg)
+        waiter = self._fetches.pop(msg.msg_id, None)
+
+        if waiter is not None:
+            waiter.send((msg.data, msg.code))
+
+    def start(self):
+        self.send(self.model.cluster_config(self.device_id))
+
+        def _wait_for_update():
+            while True:
+                self._updates.acquire()
+                self.send_index_update()
+
+        self._sender = eventlet.spawn(_wait_for_update)
+
+        # NOTE(jkoelker) Frames are read and decoded in their own green
+        #                thread while this one handles them, in order.
+        reader = eventlet.spawn(self._read)
+
+        try:
+            while self._running:
+                item = self._inbound.get()
+
+                if item is None:
+                    break
+
+                msg, size = item
+                self.dispatch(msg, size)
+                self.flow.done(size)
+
+        finally:
+            reader.kill()
+            self.stop()
+
+    def _read(self):
+        try:
+            for msg in self.conn:
+                size = self.conn.last_size
+                self._inbound.put((msg, size))
+                self.flow.add(size)
+
+                if self._readable is not None:
+                    self._readable.wait()
+
+        finally:
+            self._inbound.put(None)
+
+    def _pause_reading(self):
+        self._readable = event.Event()
+
+    def _resume_reading(self):
+        readable = self._readable
+        self._readable = None
+        readable.send()
+
+    def stop(self):
+        self._running = False
+        self._health_timer.cancel()
+        self.unsubscribe()
+
+        # NOTE(jkoelker) Requests still unanswered never will be.
+        self._requests.clear()
+        fetches, self._fetches = self._fetches, {}
+
+        for waiter in six.itervalues(fetches):
+            waiter.send_exception(IOError('Connection to %s closed' % (
+                self.name or self.device_id, )))
+
+        if self._sender is not None:
+            self._sender.kill()
+
+        if self.observer is not None:
+            self.observer.close()
+
+        self.sock.close()
+
+    def healthcheck(self):
+        recv = datetime.datetime.now() - self.conn.last_recv
+        send = datetime.datetime.now() - self.conn.last_send
+
+        if recv >= PING_IDLE_TIME and send >= PING_IDLE_TIME:
+            self.send(messages.Ping())
+
+        self._health_timer = eventlet.spawn_after(self._health_interval,
+                                                  self.healthcheck)
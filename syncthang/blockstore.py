@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+
+import binascii
+import errno
+import functools
+import hashlib
+import logging
+import os
+import struct
+import tempfile
+import time
+import xdrlib
+
+import eventlet
+from eventlet import tpool
+import six
+
+try:
+    import plyvel
+except ImportError:
+    plyvel = None
+
+from .bep import messages
+from . import readahead
+
+
+LOG = logging.getLogger(__name__)
+
+TEMP_PREFIX = '.block.'
+GC_INTERVAL = 60.0
+GC_GRACE = 10 * 60.0
+
+_datasync = getattr(os, 'fdatasync', os.fsync)
+
+
+def _write_block(path, data):
+    directory = os.path.dirname(path)
+
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    # NOTE(jkoelker) The same block may be stored by several pulls at once.
+    fd, temp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=directory)
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            _datasync(f.fileno())
+
+        os.rename(temp_path, path)
+
+    except Exception:
+        _remove_blocks([temp_path])
+        raise
+
+
+def _call(func, *args):
+    return func(*args)
+
+
+def _remove_blocks(paths):
+    removed = 0
+
+    for path in paths:
+        try:
+            os.unlink(path)
+            removed = removed + 1
+
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                LOG.warning('Failed to remove block %s: %s', path, e)
+
+    return removed
+
+
+class BlockStore(object):
+    # NOTE(jkoelker) File contents are kept once per distinct block, as a
+    #                file named by its SHA-256, no matter how many folders or
+    #                files share it. Files are their block lists. Each block
+    #                counts the files referencing it, and once that drops to
+    #                zero it is garbage: collect removes it after a grace
+    #                period, in case an index about to arrive needs it again.
+    #                The bookkeeping lives in memory here, LevelDBBlockStore
+    #                keeps it on disk.
+    def __init__(self, root, grace=GC_GRACE, clock=time.time,
+                 readahead_size=readahead.READAHEAD_SIZE,
+                 handles=readahead.MAX_HANDLES):
+        self.root = root
+        self.grace = grace
+        self.clock = clock
+
+        # NOTE(jkoelker) Blocks never change once written, so their fds
+        #                stay open for as long as they are in the pool, or
+        #                until collect removes the block.
+        self.handles = readahead.HandlePool(handles)
+        self.readahead = readahead.Readahead(readahead_size)
+
+        self._refcounts = {}
+        self._files = {}
+        self._garbage = {}
+        self._closed = False
+
+    def path(self, sha):
+        name = binascii.hexlify(sha).decode()
+        return os.path.join(self.root, name[:2], name[2:4], name)
+
+    def has(self, sha):
+        return os.path.exists(self.path(sha))
+
+    def missing(self, blocks):
+        return [i for i in range(len(blocks))
+                if blocks.size(i) and not self.has(blocks.sha(i))]
+
+    def _put(self, data, sha):
+        digest = hashlib.sha256(data).digest()
+
+        if sha is not None and sha != digest:
+            raise ValueError('Block does not match its hash')
+
+        self.put_hashed(data, digest)
+        return digest
+
+    def put(self, data, sha=None):
+        return tpool.execute(self._put, data, sha)
+
+    def put_hashed(self, data, sha):
+        # NOTE(jkoelker) For callers that just hashed data themselves, like
+        #                the scan, from any thread. sha is not checked.
+        path = self.path(sha)
+
+        if not os.path.exists(path):
+            _write_block(path, data)
+
+    def get(self, sha, size):
+        data = tpool.execute(self.handles.read, self.path(sha), 0, size)
+
+        if len(data) != size:
+            raise IOError(errno.EIO, 'Short block read',
+                          binascii.hexlify(sha))
+
+        return data
+
+    def _refcount(self, sha):
+        return self._refcounts.get(sha, 0)
+
+    def _set_refcount(self, sha, count):
+        if count:
+            self._refcounts[sha] = count
+
+        else:
+            self._refcounts.pop(sha, None)
+
+    def _file(self, folder, name):
+        return self._files.get((folder, name))
+
+    def _set_file(self, folder, name, blocks):
+        self._files[(folder, name)] = blocks
+
+    def _delete_file(self, folder, name):
+        self._files.pop((folder, name), None)
+
+    def _add_garbage(self, sha, since):
+        self._garbage[sha] = since
+
+    def _discard_garbage(self, sha):
+        self._garbage.pop(sha, None)
+
+    def _garbage_items(self):
+        return list(self._garbage.items())
+
+    def _reference(self, blocks, delta):
+        for sha in set(blocks.sha(i) for i in range(len(blocks))
+                       if blocks.size(i)):
+            count = self._refcount(sha) + delta
+            self._set_refcount(sha, count)
+
+            if count <= 0:
+                self._add_garbage(sha, self.clock())
+
+            elif delta > 0 and count == delta:
+                self._discard_garbage(sha)
+
+    def add_file(self, folder, fileinfo):
+        old = self._file(folder, fileinfo.name)
+
+        # NOTE(jkoelker) Reference the new blocks before releasing the old
+        #                ones so blocks the versions share never hit zero.
+        self._reference(fileinfo.blocks, 1)
+
+        if old is not None:
+            self._reference(old, -1)
+
+        self._set_file(folder, fileinfo.name, fileinfo.blocks)
+
+    def remove_file(self, folder, name):
+        old = self._file(folder, name)
+
+        if old is not None:
+            self._reference(old, -1)
+            self._delete_file(folder, name)
+
+    def read(self, folder, name, offset, size, sha=None):
+        return self._read(folder, name, offset, size, sha, tpool.execute)
+
+    def read_blocking(self, folder, name, offset, size, sha=None):
+        # NOTE(jkoelker) Reads in the calling thread, for threads that are
+        #                not eventlet's, like the aio executor. The handles
+        #                and readahead are locked, so both paths can share
+        #                them.
+        return self._read(folder, name, offset, size, sha, _call)
+
+    def _read(self, folder, name, offset, size, sha, execute):
+        blocks = self._file(folder, name)
+
+        if blocks is None or not len(blocks):
+            raise IOError(errno.ENOENT, 'No such file', name)
+
+        # NOTE(jkoelker) An empty file is a single block of size 0.
+        if not size or not blocks.block_size:
+            return b''
+
+        index = offset // blocks.block_size
+        start = offset - blocks.offset(index)
+
+        if (index >= len(blocks) or
+                start + size > blocks.size(index) or
+                (sha and start == 0 and sha != blocks.sha(index))):
+            raise ValueError('%s has no block at %s of %s bytes' % (
+                name, offset, size))
+
+        if start == 0 and size == blocks.size(index):
+            data = self.readahead.read((folder, name), blocks, index,
+                                       functools.partial(execute,
+                                                         self._read_blocks))
+
+        else:
+            data = execute(self.handles.read, self.path(blocks.sha(index)),
+                           start, size)
+
+        if len(data) != size:
+            raise IOError(errno.EIO, 'Short block read', name)
+
+        return data
+
+    def _read_blocks(self, blocks, indices):
+        return [self.handles.read(self.path(blocks.sha(i)), 0,
+                                  blocks.size(i))
+                for i in indices]
+
+    def collect(self):
+        now = self.clock()
+        expired = []
+
+        for sha, since in self._garbage_items():
+            if self._refcount(sha) > 0:
+                self._discard_garbage(sha)
+
+            elif now - since >= self.grace:
+                expired.append(sha)
+
+        if not expired:
+            return 0
+
+        paths = [self.path(sha) for sha in expired]
+        removed = tpool.execute(_remove_blocks, paths)
+
+        for path in paths:
+            self.handles.discard(path)
+
+        for sha in expired:
+            # NOTE(jkoelker) Referenced again while the files were removed,
+            #                it has to be pulled again.
+            if self._refcount(sha) > 0:
+                LOG.warning('Block %s was collected while in use',
+                            binascii.hexlify(sha))
+
+            self._discard_garbage(sha)
+
+        LOG.debug('Collected %s of %s garbage blocks', removed, len(expired))
+        return removed
+
+    def maintain(self, interval=GC_INTERVAL):
+        while not self._closed:
+            eventlet.sleep(interval)
+
+            try:
+                self.collect()
+
+            except Exception:
+                LOG.exception('Failed to collect garbage in %s', self.root)
+
+    def close(self):
+        self._closed = True
+        self.handles.close()
+
+
+_COUNT = struct.Struct('!Q')
+_TIME = struct.Struct('!d')
+
+_REFCOUNT = b'r'
+_FILE = b'f'
+_GARBAGE = b'g'
+
+
+def _encode(value):
+    if isinstance(value, six.text_type):
+        return value.encode('utf-8')
+
+    return value
+
+
+def _file_key(folder, name):
+    return _FILE + _encode(folder) + b'\0' + _encode(name)
+
+
+class LevelDBBlockStore(BlockStore):
+    # NOTE(jkoelker) Refcounts, block lists and garbage are read from and
+    #                written to LevelDB as they are used instead of being
+    #                loaded, so startup does not depend on the store's size.
+    #                As with LevelDBVersions each worker needs its own.
+    def __init__(self, root, path, grace=GC_GRACE, clock=time.time):
+        if plyvel is None:
+            raise RuntimeError('plyvel is required to persist the block '
+                               'store')
+
+        super(LevelDBBlockStore, self).__init__(root, grace, clock)
+        self.db = plyvel.DB(path, create_if_missing=True)
+
+    def _refcount(self, sha):
+        value = self.db.get(_REFCOUNT + sha)
+
+        if value is None:
+            return 0
+
+        return _COUNT.unpack(value)[0]
+
+    def _set_refcount(self, sha, count):
+        if count:
+            self.db.put(_REFCOUNT + sha, _COUNT.pack(count))
+
+        else:
+            self.db.delete(_REFCOUNT + sha)
+
+    def _file(self, folder, name):
+        value = self.db.get(_file_key(folder, name))
+
+        if value is None:
+            return None
+
+        return messages.BlockList.unpack(xdrlib.Unpacker(value))
+
+    def _set_file(self, folder, name, blocks):
+        packer = xdrlib.Packer()
+        messages.BlockList(blocks).pack(packer)
+        self.db.put(_file_key(folder, name), packer.get_buffer())
+
+    def _delete_file(self, folder, name):
+        self.db.delete(_file_key(folder, name))
+
+    def _add_garbage(self, sha, since):
+        self.db.put(_GARBAGE + sha, _TIME.pack(since))
+
+    def _discard_garbage(self, sha):
+        self.db.delete(_GARBAGE + sha)
+
+    def _garbage_items(self):
+        return [(key[len(_GARBAGE):], _TIME.unpack(value)[0])
+                for key, value in self.db.iterator(prefix=_GARBAGE)]
+
+    def close(self):
+        super(LevelDBBlockStore, self).close()
+        self.db.close()
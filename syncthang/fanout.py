@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import logging
+
+from .bep import messages
+
+
+LOG = logging.getLogger(__name__)
+
+MAX_PENDING = 32
+HISTORY = 256
+
+
+class Subscription(object):
+    def __init__(self, fanout, folder, notify, device_id=None, version=0,
+                 max_pending=MAX_PENDING):
+        self.fanout = fanout
+        self.folder = folder
+        self.notify = notify
+        self.device_id = device_id
+        self.version = version
+        self.max_pending = max_pending
+
+        self.lagging = False
+        self._pending = collections.deque()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def offer(self, version, frame):
+        if self.lagging:
+            return
+
+        idle = not self._pending
+
+        if len(self._pending) >= self.max_pending:
+            # NOTE(jkoelker) The peer is not draining fast enough. Drop
+            #                what is queued and send it a single coalesced
+            #                delta from the last version it was sent.
+            LOG.debug('Device %s fell behind on folder %s at version %s',
+                      self.device_id, self.folder, self.version)
+            self._pending.clear()
+            self.lagging = True
+
+        else:
+            self._pending.append((version, frame))
+
+        if idle:
+            self.notify()
+
+    def get(self):
+        if self._pending:
+            version, frame = self._pending.popleft()
+            self.version = version
+            return frame
+
+        if self.lagging:
+            self.lagging = False
+            version, frame = self.fanout.catch_up(self.folder, self.version)
+            self.version = version
+            return frame
+
+    def close(self):
+        self.fanout.unsubscribe(self)
+        self._pending.clear()
+
+
+class _Folder(object):
+    def __init__(self):
+        self.version = 0
+        self.subscriptions = set()
+        self.history = collections.deque(maxlen=HISTORY)
+        self.catch_ups = {}
+
+
+class Fanout(object):
+    # NOTE(jkoelker) Each folder delta is packed (and if needed compressed)
+    #                once into a messages.Frame that is shared by every
+    #                subscribed connection's queue.
+    def __init__(self, backfill=None):
+        self.backfill = backfill
+        self._folders = collections.defaultdict(_Folder)
+
+    def subscribe(self, folder, notify, device_id=None, version=None,
+                  max_pending=MAX_PENDING):
+        state = self._folders[folder]
+
+        if version is None:
+            version = state.version
+
+        subscription = Subscription(self, folder, notify, device_id, version,
+                                    max_pending)
+        state.subscriptions.add(subscription)
+
+        if version < state.version:
+            subscription.lagging = True
+            notify()
+
+        return subscription
+
+    def set_version(self, folder, version):
+        # NOTE(jkoelker) Seeds a folder with the version it had before a
+        #                restart, so subscribers behind it catch up through
+        #                the backfill.
+        state = self._folders[folder]
+        state.version = max(state.version, version)
+
+    def unsubscribe(self, subscription):
+        state = self._folders.get(subscription.folder)
+
+        if state is not None:
+            state.subscriptions.discard(subscription)
+
+    def publish(self, folder, files, origin=None):
+        if not files:
+            return
+
+        state = self._folders[folder]
+        versions = [f.local_version for f in files]
+        low, version = min(versions), max(versions)
+        frame = messages.Frame.from_message(messages.IndexUpdate(folder,
+                                                                 files))
+
+        state.version = max(state.version, version)
+        state.history.append((low, version, files))
+        state.catch_ups.clear()
+
+        for subscription in list(state.subscriptions):
+            if origin is not None and subscription.device_id == origin:
+                continue
+
+            subscription.offer(version, frame)
+
+    def catch_up(self, folder, version):
+        state = self._folders[folder]
+        cached = state.catch_ups.get(version)
+
+        if cached is not None:
+            return cached
+
+        files = collections.OrderedDict()
+        complete = True
+
+        if version < state.version and (not state.history or
+                                        state.history[0][0] > version + 1):
+            # NOTE(jkoelker) The history no longer covers the gap, so ask
+            #                the model for everything newer.
+            backfill = None
+
+            if self.backfill is not None:
+                backfill = self.backfill(folder, version)
+
+            if backfill is None:
+                # NOTE(jkoelker) Send what the history has, but leave the
+                #                version where it was so the gap is not
+                #                recorded as sent.
+                LOG.warning('Can not backfill folder %s from version %s '
+                            'to %s', folder, version, state.version)
+                complete = False
+
+            else:
+                for fileinfo in backfill:
+                    files[fileinfo.name] = fileinfo
+
+        for _, delta_version, delta in state.history:
+            if delta_version <= version:
+                continue
+
+            for fileinfo in delta:
+                files.pop(fileinfo.name, None)
+                files[fileinfo.name] = fileinfo
+
+        frame = None
+        if files:
+            frame = messages.Frame.from_message(
+                messages.IndexUpdate(folder, list(files.values())))
+
+        cached = (version, frame)
+
+        if complete:
+            cached = (max(version, state.version), frame)
+
+        state.catch_ups[version] = cached
+        return cached
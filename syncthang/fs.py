@@ -1,53 +1,146 @@
 # -*- coding: utf-8 -*-
 
+import errno
 import hashlib
 import os
+import stat as statlib
 
 from eventlet import tpool
 import walkdir
 
 from .bep import protocol
 from .bep import messages
+from . import assembly
+from . import metrics
 
 
 NOTHING_SHA = hashlib.sha256().digest()
 
+# NOTE(jkoelker) posix_fadvise is only in os on py3.3+, without it the
+#                hints are skipped.
+_fadvise = getattr(os, 'posix_fadvise', None)
+PREFETCH_SIZE = 4 * 1024 * 1024
 
-def _hash_file(stream):
-    blocks = []
-    add_block = blocks.append
 
-    offset = 0
-    data = stream.read(protocol.BLOCK_SIZE)
+def advise(fd, advice, offset=0, length=0):
+    if _fadvise is None:
+        return
+
+    try:
+        _fadvise(fd, offset, length, getattr(os, advice))
+
+    except OSError:
+        pass
+
+
+def _hash_file(stream, block_size=protocol.BLOCK_SIZE, on_block=None):
+    blocks = messages.BlockList()
+    add_block = blocks.add
+
+    data = stream.read(block_size)
 
     while data:
         sha = hashlib.sha256(data).digest()
-        size = len(data)
-        add_block(messages.BlockInfo(sha, size, offset))
+        add_block(len(data), sha)
+
+        if on_block is not None:
+            on_block(data, sha)
 
-        offset = offset + size
-        data = stream.read(protocol.BLOCK_SIZE)
+        data = stream.read(block_size)
 
     if not blocks:
-        add_block(messages.BlockInfo(NOTHING_SHA, 0, 0))
+        add_block(0, NOTHING_SHA)
 
     return blocks
 
 
-def hash_file(file_path):
+def hash_path(file_path, large_blocks=False, drop_cache=False,
+              on_block=None):
+    # NOTE(jkoelker) on_block(data, sha) is called for every block, in the
+    #                calling thread.
     with open(file_path, mode='rb') as stream:
-        return _hash_file(stream)
+        fd = stream.fileno()
+        size = os.fstat(fd).st_size
+        advise(fd, 'POSIX_FADV_SEQUENTIAL')
+
+        blocks = _hash_file(stream, protocol.block_size(size, large_blocks),
+                            on_block)
+
+        if drop_cache:
+            advise(fd, 'POSIX_FADV_DONTNEED')
+
+        return blocks
+
+
+def read_block(file_path, offset, size, sha=None):
+    # NOTE(jkoelker) Serves a block straight from a file, which may have
+    #                changed since it was hashed, so the sha is checked.
+    with open(file_path, mode='rb') as stream:
+        stream.seek(offset)
+        data = stream.read(size)
+
+    if len(data) != size:
+        raise IOError(errno.EIO, 'Short block read', file_path)
+
+    if sha and hashlib.sha256(data).digest() != sha:
+        raise IOError(errno.EIO, 'Block changed on disk', file_path)
+
+    return data
+
+
+def prefetch(file_path, length=PREFETCH_SIZE):
+    # NOTE(jkoelker) Start reading the head of a file we are about to hash
+    #                while the current one is still being hashed.
+    if _fadvise is None:
+        return
+
+    try:
+        fd = os.open(file_path, os.O_RDONLY)
+
+    except OSError:
+        return
+
+    try:
+        advise(fd, 'POSIX_FADV_WILLNEED', 0, length)
+
+    finally:
+        os.close(fd)
+
+
+def hash_file(file_path, large_blocks=False):
+    if not metrics.ENABLED:
+        return tpool.execute(hash_path, file_path, large_blocks)
+
+    start = metrics.clock()
+    blocks = tpool.execute(hash_path, file_path, large_blocks)
+    metrics.hashed(blocks.total_size, metrics.clock() - start)
+    return blocks
 
 
 class Walker(object):
+    # NOTE(jkoelker) Yields the name, relative to path, and lstat of every
+    #                regular file under path. Symlinks are not followed nor
+    #                reported yet, and files being assembled are skipped.
     def __init__(self, path):
         self.path = path
 
     def walk(self):
-        walk_iter = walkdir.filtered_walk(self.path)
+        root = os.path.abspath(self.path)
+        walk_iter = walkdir.filtered_walk(root)
         for dirpath, subdirs, files in walk_iter:
             for fname in files:
-                real_path = os.path.abspath(os.path.join(dirpath, fname))
+                if fname.startswith(assembly.TEMP_PREFIX):
+                    continue
+
+                real_path = os.path.join(dirpath, fname)
+
+                try:
+                    stat = os.lstat(real_path)
+
+                except OSError:
+                    continue
+
+                if not statlib.S_ISREG(stat.st_mode):
+                    continue
 
-                if os.path.islink(real_path):
-                    target = os.readlink(real_path)
+                yield os.path.relpath(real_path, root), stat
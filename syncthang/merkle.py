@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import logging
+import struct
+
+import six
+
+
+LOG = logging.getLogger(__name__)
+
+SEPARATOR = '/'
+
+FILE = b'f'
+DIRECTORY = b'd'
+_LEAF = struct.Struct('!IQ')
+_COUNTER = struct.Struct('!QQ')
+_SIZE = struct.Struct('!I')
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+
+    return value
+
+
+def _split(path):
+    return [part for part in _text(path).split(SEPARATOR) if part]
+
+
+def file_digest(fileinfo):
+    # NOTE(jkoelker) Local versions are our own numbering, two replicas of
+    #                the same file have different ones, so they are left out.
+    digest = hashlib.sha256(_LEAF.pack(fileinfo.flags, fileinfo.modified))
+
+    for counter in sorted(six.iteritems(fileinfo.version)):
+        digest.update(_COUNTER.pack(*counter))
+
+    blocks = fileinfo.blocks
+    digest.update(_SIZE.pack(len(blocks)))
+    digest.update(blocks.shas)
+    return digest.digest()
+
+
+class Directory(object):
+    __slots__ = ('files', 'directories', '_digest')
+
+    def __init__(self):
+        self.files = {}
+        self.directories = {}
+        self._digest = None
+
+    def __len__(self):
+        return len(self.files) + len(self.directories)
+
+    @property
+    def digest(self):
+        # NOTE(jkoelker) Cached until something below changes, so only the
+        #                directories on the changed paths are rehashed.
+        if self._digest is None:
+            digest = hashlib.sha256()
+
+            for kind, name, child in self.children():
+                name = name.encode('utf-8')
+                digest.update(kind)
+                digest.update(_SIZE.pack(len(name)))
+                digest.update(name)
+                digest.update(child)
+
+            self._digest = digest.digest()
+
+        return self._digest
+
+    def children(self):
+        children = [(FILE, name, digest)
+                    for name, digest in six.iteritems(self.files)]
+        children.extend((DIRECTORY, name, directory.digest)
+                        for name, directory in six.iteritems(self.directories))
+        children.sort(key=lambda child: (child[1], child[0]))
+        return children
+
+
+class Tree(object):
+    def __init__(self, fileinfos=()):
+        self.root = Directory()
+
+        for fileinfo in fileinfos:
+            self.update(fileinfo)
+
+    @property
+    def digest(self):
+        return self.root.digest
+
+    def _walk(self, parts, create=False):
+        directory = self.root
+        path = [directory]
+
+        for part in parts:
+            child = directory.directories.get(part)
+
+            if child is None:
+                if not create:
+                    return None
+
+                child = directory.directories[part] = Directory()
+
+            directory = child
+            path.append(directory)
+
+        return path
+
+    def update(self, fileinfo, digest=None):
+        parts = _split(fileinfo.name)
+
+        if not parts:
+            return
+
+        if digest is None:
+            digest = file_digest(fileinfo)
+
+        path = self._walk(parts[:-1], create=True)
+
+        if path[-1].files.get(parts[-1]) == digest:
+            return
+
+        path[-1].files[parts[-1]] = digest
+
+        for directory in path:
+            directory._digest = None
+
+    def remove(self, name):
+        parts = _split(name)
+        path = self._walk(parts[:-1]) if parts else None
+
+        if path is None or path[-1].files.pop(parts[-1], None) is None:
+            return
+
+        for directory in path:
+            directory._digest = None
+
+        # NOTE(jkoelker) Prune directories left empty.
+        for index in range(len(parts) - 1, 0, -1):
+            if path[index]:
+                break
+
+            del path[index - 1].directories[parts[index - 1]]
+
+    def directory(self, path=''):
+        parts = _split(path)
+        walked = self._walk(parts)
+
+        if walked is None:
+            return None
+
+        return walked[-1]
+
+    def get(self, path=''):
+        parts = _split(path)
+
+        if parts:
+            walked = self._walk(parts[:-1])
+
+            if walked is not None and parts[-1] in walked[-1].files:
+                return walked[-1].files[parts[-1]]
+
+        directory = self.directory(path)
+
+        if directory is not None:
+            return directory.digest
+
+
+def _join(path, name):
+    if not path:
+        return name
+
+    return path + SEPARATOR + name
+
+
+def diff(left, right, path=''):
+    # NOTE(jkoelker) Yields the paths of the files that differ between the
+    #                two trees, descending only into directories whose
+    #                digests differ.
+    left = left.directory(path) if isinstance(left, Tree) else left
+    right = right.directory(path) if isinstance(right, Tree) else right
+    left = left if left is not None else Directory()
+    right = right if right is not None else Directory()
+
+    if left.digest == right.digest:
+        return
+
+    for name in sorted(set(left.files) | set(right.files)):
+        if left.files.get(name) != right.files.get(name):
+            yield _join(path, name)
+
+    for name in sorted(set(left.directories) | set(right.directories)):
+        for changed in diff(left.directories.get(name),
+                            right.directories.get(name), _join(path, name)):
+            yield changed
@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+
+import binascii
+import bisect
+import timeit
+
+from .bep import messages
+
+
+# NOTE(jkoelker) Instrumented code checks ENABLED before doing any work, so
+#                a disabled registry costs one attribute lookup per event.
+#                Metrics are only updated from the event loop thread, never
+#                from tpool or executor threads, so they take no locks.
+ENABLED = False
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+RATIO_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+
+clock = timeit.default_timer
+
+
+def enable():
+    global ENABLED
+    ENABLED = True
+
+
+def disable():
+    global ENABLED
+    ENABLED = False
+
+
+def _format_labels(names, values, extra=None):
+    pairs = ['%s="%s"' % (name, str(value).replace('"', '\\"'))
+             for name, value in zip(names, values)]
+
+    if extra is not None:
+        pairs.append('%s="%s"' % extra)
+
+    if not pairs:
+        return ''
+
+    return '{%s}' % ','.join(pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value))
+
+
+class Metric(object):
+    TYPE = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s %s' % (self.name, self.TYPE)]
+
+        for label_values, value in sorted(self._values.items()):
+            lines.extend(self._render_value(label_values, value))
+
+        return lines
+
+    def _render_value(self, label_values, value):
+        return ['%s%s %s' % (self.name,
+                             _format_labels(self.labels, label_values),
+                             _format_value(value))]
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def cell(self, labels=()):
+        # NOTE(jkoelker) The value is kept in a one item list so hot paths
+        #                can hold on to it and add to it in place.
+        cell = self._values.get(labels)
+
+        if cell is None:
+            cell = self._values[labels] = [0]
+
+        return cell
+
+    def inc(self, amount=1, labels=()):
+        self.cell(labels)[0] += amount
+
+    def value(self, labels=()):
+        cell = self._values.get(labels)
+        return cell[0] if cell else 0
+
+    def fold(self, labels, into):
+        # NOTE(jkoelker) Moves a series' count onto another series, so the
+        #                totals keep going up after the series is dropped.
+        cell = self._values.pop(labels, None)
+
+        if cell is not None:
+            self.inc(cell[0], into)
+
+    def _render_value(self, label_values, value):
+        return super(Counter, self)._render_value(label_values, value[0])
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def set(self, value, labels=()):
+        self._values[labels] = value
+
+    def inc(self, amount=1, labels=()):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+    def value(self, labels=()):
+        return self._values.get(labels, 0)
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def cell(self, labels=()):
+        # NOTE(jkoelker) [bucket counts, sum, count], see Counter.cell.
+        state = self._values.get(labels)
+
+        if state is None:
+            state = self._values[labels] = [
+                [0] * (len(self.buckets) + 1), 0.0, 0]
+
+        return state
+
+    def observe(self, value, labels=()):
+        state = self.cell(labels)
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] = state[1] + value
+        state[2] = state[2] + 1
+
+    def count(self, labels=()):
+        state = self._values.get(labels)
+        return state[2] if state else 0
+
+    def _render_value(self, label_values, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+
+        for bound, bucket in zip(self.buckets + (float('inf'), ), counts):
+            cumulative = cumulative + bucket
+            labels = _format_labels(self.labels, label_values,
+                                    ('le', _format_value(bound)))
+            lines.append('%s_bucket%s %s' % (self.name, labels, cumulative))
+
+        labels = _format_labels(self.labels, label_values)
+        lines.append('%s_sum%s %s' % (self.name, labels, _format_value(total)))
+        lines.append('%s_count%s %s' % (self.name, labels, count))
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(),
+                  buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def render(self):
+        lines = []
+
+        for metric in self._metrics:
+            lines.extend(metric.render())
+
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+FRAMES = REGISTRY.counter(
+    'syncthang_bep_frames_total',
+    'BEP frames by device, direction and message type.',
+    ('device', 'direction', 'type'))
+BYTES = REGISTRY.counter(
+    'syncthang_bep_bytes_total',
+    'BEP bytes on the wire, including headers, by device, direction and '
+    'message type.',
+    ('device', 'direction', 'type'))
+COMPRESSION = REGISTRY.histogram(
+    'syncthang_bep_compression_ratio',
+    'Compressed to uncompressed size of LZ4 compressed frames.',
+    ('direction', ), RATIO_BUCKETS)
+READ_PAUSES = REGISTRY.counter(
+    'syncthang_bep_read_pauses_total',
+    'Times a device stopped reading because of queued inbound work.')
+READ_PAUSED = REGISTRY.counter(
+    'syncthang_bep_read_paused_seconds_total',
+    'Time devices spent not reading because of queued inbound work, by '
+    'device.',
+    ('device', ))
+REQUEST_LATENCY = REGISTRY.histogram(
+    'syncthang_bep_request_latency_seconds',
+    'Time from sending a Request to receiving its Response.')
+HANDLER_TIME = REGISTRY.histogram(
+    'syncthang_bep_handler_seconds',
+    'Time spent handling a received message, by message type.',
+    ('type', ))
+REJECTED = REGISTRY.counter(
+    'syncthang_admission_rejected_total',
+    'Connections turned away by admission control, by reason.',
+    ('reason', ))
+HASH_BYTES = REGISTRY.counter(
+    'syncthang_fs_hash_bytes_total',
+    'Bytes read and hashed from disk.')
+HASH_SECONDS = REGISTRY.counter(
+    'syncthang_fs_hash_seconds_total',
+    'Time spent hashing files; divide hash bytes by it for throughput.')
+
+# NOTE(jkoelker) Open observers per device label, a device can briefly have
+#                two connections while the old one is torn down.
+_observers = {}
+
+
+class Observer(object):
+    # NOTE(jkoelker) One per connection, handed to its Connection, Device
+    #                and FlowControl by the transport, so the bep package
+    #                does not depend on this module. Transports only create
+    #                them while metrics are enabled. The cells a message type
+    #                updates are looked up once per connection, after that a
+    #                frame costs a few in place additions. When the last
+    #                connection of a device closes its series are folded
+    #                into the device="" series, so the number of series
+    #                follows the connected devices instead of every device
+    #                ever seen.
+    def __init__(self, device_id=None):
+        self.device = ''
+        self.closed = False
+
+        if device_id:
+            self.device = binascii.hexlify(device_id).decode()
+
+        _observers[self.device] = _observers.get(self.device, 0) + 1
+        self._frames = {'in': {}, 'out': {}}
+        self._handlers = {}
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.closed = True
+        self._frames = {'in': {}, 'out': {}}
+        count = _observers.pop(self.device) - 1
+
+        if count:
+            _observers[self.device] = count
+            return
+
+        if not self.device:
+            return
+
+        for metric in (FRAMES, BYTES):
+            for labels in [labels for labels in metric._values
+                           if labels[0] == self.device]:
+                metric.fold(labels, ('', ) + labels[1:])
+
+        READ_PAUSED.fold((self.device, ), ('', ))
+
+    def _frame_cells(self, direction, msg_type):
+        key = (self.device, direction,
+               messages.MESSAGE_NAMES.get(msg_type, msg_type))
+        cells = (FRAMES.cell(key), BYTES.cell(key))
+        self._frames[direction][msg_type] = cells
+        return cells
+
+    def frame(self, direction, msg_type, wire_size):
+        if self.closed:
+            return
+
+        cells = self._frames[direction].get(msg_type)
+
+        if cells is None:
+            cells = self._frame_cells(direction, msg_type)
+
+        cells[0][0] += 1
+        cells[1][0] += wire_size
+
+    def compression(self, direction, compressed_size, payload_size):
+        if payload_size:
+            COMPRESSION.observe(float(compressed_size) / payload_size,
+                                (direction, ))
+
+    def handled(self, msg_type, seconds, _buckets=HANDLER_TIME.buckets,
+                _bisect=bisect.bisect_left):
+        state = self._handlers.get(msg_type)
+
+        if state is None:
+            state = self._handlers[msg_type] = HANDLER_TIME.cell(
+                (messages.MESSAGE_NAMES[msg_type], ))
+
+        state[0][_bisect(_buckets, seconds)] += 1
+        state[1] += seconds
+        state[2] += 1
+
+    def responded(self, seconds):
+        REQUEST_LATENCY.observe(seconds)
+
+    def paused(self, seconds):
+        READ_PAUSES.inc()
+
+        if not self.closed:
+            READ_PAUSED.inc(seconds, (self.device, ))
+
+
+def observer(device_id=None):
+    if not ENABLED:
+        return None
+
+    return Observer(device_id)
+
+
+def hashed(size, seconds):
+    HASH_BYTES.inc(size)
+    HASH_SECONDS.inc(seconds)
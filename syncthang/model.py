@@ -1,52 +1,583 @@
 # -*- coding: utf-8 -*-
 
 import collections
+import errno
+import logging
+import operator
+import os
 import weakref
 
-from eventlet import event
+import eventlet
+from eventlet import tpool
+import six
 
 from .bep import messages
-from . import db
+from . import fanout
+from . import fs
+from . import merkle
+from . import pull
+from . import scanner
+from . import versions
+
+
+LOG = logging.getLogger(__name__)
+
+RESCAN_INTERVAL = 60.0
+
+
+def _encode(name):
+    if isinstance(name, six.text_type):
+        return name.encode('utf-8')
+
+    return name
+
+
+def _call(func, *args):
+    return func(*args)
+
+
+def _wins(fileinfo, existing):
+    # NOTE(jkoelker) Settles concurrent versions the same way on every
+    #                device: a change beats a delete, then the later
+    #                modification, then the larger version vector.
+    if fileinfo.deleted != existing.deleted:
+        return existing.deleted
+
+    if fileinfo.modified != existing.modified:
+        return fileinfo.modified > existing.modified
+
+    return sorted(fileinfo.version.items()) > sorted(existing.version.items())
+
+
+def _native(name):
+    if six.PY3 and isinstance(name, six.binary_type):
+        return name.decode('utf-8')
+
+    return name
+
+
+class FolderConfig(object):
+    # NOTE(jkoelker) Files are only pulled into folders with a path.
+    #                large_blocks scales the block size of the files hashed
+    #                for the folder with their size. Only turn it on when
+    #                every device sharing the folder handles blocks larger
+    #                than protocol.BLOCK_SIZE. Requests for a folder with a
+    #                path are served from its files, unless store_blocks
+    #                copies its blocks into the block store as they are
+    #                scanned and pulled. That costs the disk space twice
+    #                over, folders without a path always use the store.
+    def __init__(self, ident, devices=(), path=None, large_blocks=False,
+                 store_blocks=False):
+        self.ident = ident
+        self.devices = list(devices)
+        self.path = path
+        self.large_blocks = large_blocks
+        self.store_blocks = store_blocks
 
 
 class Model(object):
-    def __init__(self, client_name, client_version):
+    # NOTE(jkoelker) device_db, the db module or anything with its Device
+    #                model, records the name and version devices announce.
+    #                It is only used when given.
+    def __init__(self, client_name, client_version, version_store=None,
+                 index_store=None, block_store=None, local_device_id=None,
+                 device_db=None):
+        if version_store is None:
+            version_store = versions.Versions()
+
         self.client_name = client_name
-        self.client_versin = client_version
+        self.client_version = client_version
+        self.versions = version_store
+        self.index = index_store
+        self.blocks = block_store
+        self.local_device_id = local_device_id
+        self.device_db = device_db
 
-        self.update = event.Event()
+        self.fanout = fanout.Fanout(self.folder_index)
+        self.puller = pull.Puller(self)
+        self.scanner = scanner.Scheduler()
         self.devices = weakref.WeakValueDictionary()
 
+        # NOTE(jkoelker) Set by workers.Coordinator when running as one of
+        #                several processes sharing the listening socket.
+        self.coordinator = None
+
+        # NOTE(jkoelker) Folders configured locally, see add_folder. Devices
+        #                also join folders by announcing them.
+        self.folders = {}
+
         self._folder_devices = collections.defaultdict(list)
         self._device_folders = collections.defaultdict(list)
+        self._local_versions = collections.defaultdict(int)
+
+        # NOTE(jkoelker) Without an index store the files applied are kept
+        #                here by folder and name for folder_index.
+        self._files = collections.defaultdict(dict)
+
+        # NOTE(jkoelker) Per folder, the (size, mtime) of the files last
+        #                scanned or pulled, by name. Only these are known to
+        #                be on disk, so only these can be found deleted.
+        self._on_disk = collections.defaultdict(dict)
+
+        # NOTE(jkoelker) Per folder directory digests of the files applied,
+        #                see merkle.Tree.
+        self.trees = collections.defaultdict(merkle.Tree)
+
+        # NOTE(jkoelker) Packed ClusterConfig payloads by device id. They only
+        #                change with folder/device membership, so they are
+        #                dropped by config_changed rather than rebuilt for
+        #                every connection.
+        self._cluster_configs = {}
+
+        if index_store is not None:
+            for folder, devices in six.iteritems(index_store.members):
+                for device_id in devices:
+                    self._folder_devices[folder].append(device_id)
+                    self._device_folders[device_id].append(folder)
+
+            self._local_versions.update(index_store.local_versions)
+
+        # NOTE(jkoelker) Devices remember the versions we sent them, so
+        #                numbering must carry on above those even when the
+        #                index itself was not kept.
+        for folder, version in six.iteritems(version_store.sent_versions()):
+            if version > self._local_versions[folder]:
+                self._local_versions[folder] = version
+
+        for folder, version in six.iteritems(self._local_versions):
+            self.fanout.set_version(folder, version)
 
     def cluster_config(self, device_id):
-        folders = db.Device.select(db.Device.folders)
-        folders = folders.where(db.Device.ident == device_id)
-        msg = messages.ClusterConfig(self.client_name,
-                                     self.client_version,
-                                     folders)
-        return msg
+        payload = self._cluster_configs.get(device_id)
+
+        if payload is None:
+            folders = [self._cluster_folder(device_id, folder)
+                       for folder in self.device_folders(device_id)]
+            msg = messages.ClusterConfig(self.client_name,
+                                         self.client_version,
+                                         folders)
+            payload = msg.pack()
+            self._cluster_configs[device_id] = payload
+
+        return messages.Packed(messages.CLUSTER_CONFIG, payload)
+
+    def _cluster_folder(self, device_id, folder):
+        # NOTE(jkoelker) A device only acts on its own entry, which tells it
+        #                how much of its index we already have, so that is
+        #                the only max_local_version filled in. It keeps the
+        #                cached payload valid for everybody else.
+        devices = []
+
+        for member in self._folder_devices[folder]:
+            version = 0
+
+            if member == device_id:
+                version = self.versions.received(device_id, folder)
+
+            devices.append(messages.Device(member, version))
+
+        return messages.Folder(folder, devices)
+
+    def config_changed(self, device_id=None):
+        if device_id is None:
+            self._cluster_configs.clear()
+            return
+
+        self._cluster_configs.pop(device_id, None)
+
+    def claim_device(self, device_id):
+        if device_id in self.devices:
+            return False
+
+        if self.coordinator is None:
+            return True
+
+        return self.coordinator.claim(device_id)
+
+    def release_device(self, device_id):
+        self.devices.pop(device_id, None)
+
+        if self.coordinator is not None:
+            self.coordinator.release(device_id)
+
+    def add_folder(self, folder, devices=(), path=None, large_blocks=False,
+                   store_blocks=False):
+        config = FolderConfig(folder, devices, path, large_blocks,
+                              store_blocks)
+        self.folders[folder] = config
+
+        for device_id in config.devices:
+            self.add_folder_device(folder, device_id)
+
+        return config
+
+    def device_folders(self, device_id):
+        return list(self._device_folders.get(device_id, ()))
+
+    def add_folder_device(self, folder, device_id):
+        if device_id in self._folder_devices[folder]:
+            return
+
+        self._folder_devices[folder].append(device_id)
+        self._device_folders[device_id].append(folder)
+        self._folder_changed(folder)
+
+        if self.index is not None:
+            self.index.add_member(folder, device_id)
+
+    def remove_folder_device(self, folder, device_id):
+        if device_id not in self._folder_devices[folder]:
+            return
+
+        self._folder_changed(folder)
+        self._folder_devices[folder].remove(device_id)
+        self._device_folders[device_id].remove(folder)
+
+        if self.index is not None:
+            self.index.remove_member(folder, device_id)
+
+    def _folder_changed(self, folder):
+        # NOTE(jkoelker) Every member's ClusterConfig lists the devices of
+        #                the folder, so a membership change touches them all.
+        for device_id in self._folder_devices[folder]:
+            self.config_changed(device_id)
 
     def update_cluster_config(self, device_id, name, version, folders,
                               options):
-        device = db.Device.get(db.Device.ident == device_id)
+        # NOTE(jkoelker) The folders a device announces are the ones it
+        #                shares with us. One it no longer announces was
+        #                unshared, unless it is configured for it here.
+        announced = [folder.ident for folder in folders]
+
+        for folder in announced:
+            self.add_folder_device(folder, device_id)
+
+        for folder in self.device_folders(device_id):
+            if folder in announced:
+                continue
+
+            config = self.folders.get(folder)
+
+            if config is not None and device_id in config.devices:
+                continue
+
+            self.remove_folder_device(folder, device_id)
+
+        if self.device_db is None:
+            return
+
+        Device = self.device_db.Device
+        device = Device.get(Device.ident == device_id)
         device.name = name
         device.version = version
         device.save()
 
         if device.introducer:
             # TODO(jkoelker) create new connections to devices
-            pass
+            self.config_changed()
 
     def folder_index(self, folder, min_local_version):
-        pass
+        if self.index is not None:
+            files = self.index.changed(folder, min_local_version)
 
-    def update_index(self, index):
-        pass
+        else:
+            files = [fileinfo
+                     for fileinfo in six.itervalues(self._files[folder])
+                     if fileinfo.local_version > min_local_version]
 
-    def request(folder, name, offset, size, sha, flags):
-        pass
+        return sorted(files, key=operator.attrgetter('local_version'))
+
+    def local_versions(self):
+        return dict(self._local_versions)
+
+    def get_file(self, folder, name):
+        if self.index is not None:
+            return self.index.get(folder, name)
+
+        return self._files[folder].get(name)
+
+    def _announce(self, origin, folder, files):
+        if self.coordinator is not None:
+            # NOTE(jkoelker) The coordinator sequences local versions across
+            #                workers and calls apply_index in each of them.
+            self.coordinator.update_index(origin, folder, files)
+
+        else:
+            self.apply_index(origin, folder, files,
+                             self._local_versions[folder])
+
+    def _newer(self, device_id, folder, files):
+        # NOTE(jkoelker) Only versions newer than the ones in the index are
+        #                taken, a device reconnecting with a stale index must
+        #                not roll files back. Of concurrent versions the one
+        #                _wins picks is taken, and the names it replaced are
+        #                returned as conflicts.
+        newer = []
+        conflicts = set()
+
+        for fileinfo in files:
+            existing = self.get_file(folder, fileinfo.name)
+
+            if existing is None:
+                newer.append(fileinfo)
+                continue
+
+            if fileinfo.version <= existing.version:
+                continue
+
+            if not existing.version < fileinfo.version:
+                if not _wins(fileinfo, existing):
+                    LOG.info('Keeping %s in %s, concurrent with the '
+                             'version from %s', fileinfo.name, folder,
+                             device_id)
+                    continue
+
+                LOG.info('Version of %s in %s from %s conflicts with ours',
+                         fileinfo.name, folder, device_id)
+                conflicts.add(fileinfo.name)
+
+            newer.append(fileinfo)
+
+        return newer, conflicts
+
+    def update_index(self, device_id, folder, files, flags=0, options=None):
+        if not files:
+            return
+
+        # NOTE(jkoelker) apply_index renumbers the files into our own local
+        #                versions, so note the device's first.
+        received = max(fileinfo.local_version for fileinfo in files)
+        files, conflicts = self._newer(device_id, folder, files)
+
+        if files:
+            self._announce(device_id, folder, files)
+
+        self.index_received(device_id, folder, received)
+
+        config = self.folders.get(folder)
+        device = self.devices.get(device_id)
+
+        if (files and config is not None and config.path and
+                device is not None):
+            self.puller.pull(device, folder, files, conflicts)
+
+    def apply_index(self, device_id, folder, files, base_version):
+        version = base_version
+
+        for fileinfo in files:
+            version = version + 1
+            fileinfo.local_version = version
+
+        self._local_versions[folder] = max(self._local_versions[folder],
+                                           version)
+
+        if self.index is not None:
+            self.index.update(folder, files)
+
+        else:
+            known = self._files[folder]
+
+            for fileinfo in files:
+                known[fileinfo.name] = fileinfo
+
+        tree = self.trees[folder]
+        for fileinfo in files:
+            tree.update(fileinfo)
+
+        if self.stores_blocks(folder):
+            for fileinfo in files:
+                if fileinfo.deleted or fileinfo.invalid:
+                    self.blocks.remove_file(folder, fileinfo.name)
+
+                else:
+                    self.blocks.add_file(folder, fileinfo)
+
+        self.fanout.publish(folder, files, origin=device_id)
+
+    def pulled(self, folder, fileinfo):
+        self._on_disk[folder][fileinfo.name] = (fileinfo.blocks.total_size,
+                                                fileinfo.modified)
+
+    def _bump(self, fileinfo):
+        version = messages.Vector()
+
+        if fileinfo is not None:
+            version.update(fileinfo.version)
+
+        short = messages.Device(self.local_device_id).short
+        version[short] = version.get(short, 0) + 1
+        return version
+
+    def _stat_names(self, root, names):
+        found = []
+
+        for name in names:
+            try:
+                stat = os.lstat(os.path.join(root, name))
+
+            except OSError:
+                continue
+
+            found.append((name, stat))
+
+        return found
+
+    def scan(self, folder, names=None, priority=scanner.RESCAN):
+        # NOTE(jkoelker) Hashes the files under the folder's path that
+        #                changed since they were last scanned or pulled and
+        #                announces them, along with the ones that are gone,
+        #                as local changes. names limits it to those files.
+        #                Files with a pull in flight are left alone.
+        config = self.folders.get(folder)
+
+        if config is None or not config.path:
+            raise ValueError('Folder %s has no path to scan' % folder)
+
+        if self.local_device_id is None:
+            raise ValueError('Scanning needs the local device id')
+
+        root = os.path.abspath(config.path)
+
+        if names is None:
+            found = tpool.execute(list, fs.Walker(root).walk())
+
+        else:
+            names = [_native(name) for name in names]
+            found = tpool.execute(self._stat_names, root, names)
+
+        on_disk = self._on_disk[folder]
+        present = set()
+        stats = {}
+        changed = {}
+
+        for name, stat in found:
+            key = _encode(name)
+            state = (stat.st_size, int(stat.st_mtime))
+            present.add(key)
+
+            if (on_disk.get(key) == state or
+                    self.puller.pulling(folder, key)):
+                continue
+
+            fileinfo = self.get_file(folder, key)
+
+            if (fileinfo is not None and not fileinfo.deleted and
+                    (fileinfo.blocks.total_size, fileinfo.modified) == state):
+                on_disk[key] = state
+                continue
+
+            path = os.path.join(root, name)
+            stats[path] = stat
+            changed[path] = (key, state, fileinfo)
+
+        files = []
+
+        on_block = None
+        if self.stores_blocks(folder):
+            on_block = self.blocks.put_hashed
+
+        for path, blocks in self.scanner.scan(list(changed), priority,
+                                              config.large_blocks, stats,
+                                              on_block):
+            key, state, fileinfo = changed[path]
+            on_disk[key] = state
+
+            if (fileinfo is not None and not fileinfo.deleted and
+                    fileinfo.blocks == blocks):
+                continue
+
+            files.append(messages.FileInfo(
+                key, stats[path].st_mode & 0o777, state[1],
+                self._bump(fileinfo), 0, blocks))
+
+        if names is None:
+            gone = set(on_disk) - present
+
+        else:
+            gone = set(_encode(name) for name in names) - present
+
+        for key in gone:
+            on_disk.pop(key, None)
+            fileinfo = self.get_file(folder, key)
+
+            if fileinfo is None or fileinfo.deleted:
+                continue
+
+            files.append(messages.FileInfo(
+                key, fileinfo.flags | messages.FileInfo.DELETED,
+                fileinfo.modified, self._bump(fileinfo)))
+
+        if files:
+            self._announce(None, folder, files)
+
+        return files
+
+    def rescan(self, folder, interval=RESCAN_INTERVAL):
+        # NOTE(jkoelker) Spawn it, like snapshot.IndexStore.maintain.
+        while folder in self.folders:
+            try:
+                self.scan(folder)
+
+            except Exception:
+                LOG.exception('Failed to scan folder %s', folder)
+
+            eventlet.sleep(interval)
+
+    def index_received(self, device_id, folder, version):
+        if version > self.versions.received(device_id, folder):
+            self.versions.set_received(device_id, folder, version)
+            self.config_changed(device_id)
+
+    def index_sent(self, device_id, folder, version):
+        self.versions.set_sent(device_id, folder, version)
+
+    def resume_version(self, device_id, folder, version):
+        # NOTE(jkoelker) version is what the device says it has of our
+        #                index. If it is ahead of what we sent, or of the
+        #                folder itself, our index was reset since and the
+        #                device needs all of it again.
+        sent = self.versions.sent(device_id, folder)
+
+        if version > min(sent, self._local_versions[folder]):
+            LOG.info('Device %s is ahead on folder %s (%s > %s), sending '
+                     'the full index', device_id, folder, version, sent)
+            return 0
+
+        return version
+
+    def stores_blocks(self, folder):
+        if self.blocks is None:
+            return False
+
+        config = self.folders.get(folder)
+        return config is None or not config.path or config.store_blocks
+
+    def _read_file(self, folder, name, offset, size, sha, execute):
+        assembler = self.puller.assembler(folder)
+        fileinfo = self.get_file(folder, name)
+
+        if (assembler is None or fileinfo is None or fileinfo.deleted or
+                fileinfo.invalid):
+            raise IOError(errno.ENOENT, 'No such file', name)
+
+        # NOTE(jkoelker) Assembler.path keeps the name inside the folder.
+        return execute(lambda: fs.read_block(assembler.path(fileinfo),
+                                             offset, size, sha))
+
+    def request(self, folder, name, offset, size, sha, flags):
+        if self.stores_blocks(folder):
+            return self.blocks.read(folder, name, offset, size, sha)
+
+        return self._read_file(folder, name, offset, size, sha,
+                               tpool.execute)
+
+    def request_blocking(self, folder, name, offset, size, sha, flags):
+        # NOTE(jkoelker) request for threads outside eventlet, see
+        #                BlockStore.read_blocking.
+        if self.stores_blocks(folder):
+            return self.blocks.read_blocking(folder, name, offset, size, sha)
+
+        return self._read_file(folder, name, offset, size, sha, _call)
 
     def index_update(self, device_id, folder, files, flags, options):
         pass
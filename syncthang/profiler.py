@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import logging
+import os
+import signal
+import sys
+import tempfile
+import time
+
+from eventlet import patcher
+import six
+
+
+LOG = logging.getLogger(__name__)
+INTERVAL = 0.005
+TOGGLE_SIGNAL = getattr(signal, 'SIGUSR2', None)
+
+# NOTE(jkoelker) eventlet may have monkey patched thread, in which case
+#                get_ident would return the id of the running green thread.
+_thread = patcher.original(six.moves._thread.__name__)
+
+
+def _idle(frame):
+    # NOTE(jkoelker) Idle pool threads park in Condition.wait, counting them
+    #                would bury the threads doing work.
+    code = frame.f_code
+    return (code.co_name == 'wait' and
+            os.path.basename(code.co_filename).startswith('threading.py'))
+
+
+def _label(code):
+    return '%s (%s:%s)' % (code.co_name, os.path.basename(code.co_filename),
+                           code.co_firstlineno)
+
+
+def _stack(frame):
+    stack = []
+
+    while frame is not None:
+        stack.append(frame.f_code)
+        frame = frame.f_back
+
+    stack.reverse()
+    return tuple(stack)
+
+
+class Profiler(object):
+    # NOTE(jkoelker) SIGPROF is delivered to the main thread with the frame
+    #                of whichever green thread is running, so every sample
+    #                is the stack of that green thread, or the hub's when
+    #                none is. Real threads, like the tpool workers hashing
+    #                files, are sampled through sys._current_frames.
+    def __init__(self, interval=INTERVAL):
+        self.interval = interval
+        self.samples = collections.Counter()
+        self.started = None
+        self.stopped = None
+        self._main = None
+
+    @property
+    def running(self):
+        return self.started is not None and self.stopped is None
+
+    def start(self):
+        if self.running:
+            return
+
+        self.samples.clear()
+        self.started = time.time()
+        self.stopped = None
+        self._main = _thread.get_ident()
+
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        LOG.info('Profiling every %sms', self.interval * 1000)
+
+    def stop(self):
+        if not self.running:
+            return
+
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_IGN)
+        self.stopped = time.time()
+        LOG.info('Profiled %.1fs, %s samples', self.stopped - self.started,
+                 sum(self.samples.values()))
+
+    def _sample(self, signum, frame):
+        samples = self.samples
+        samples[('main', ) + _stack(frame)] += 1
+
+        for ident, thread_frame in sys._current_frames().items():
+            if ident != self._main and not _idle(thread_frame):
+                samples[('thread', ) + _stack(thread_frame)] += 1
+
+    def collapsed(self):
+        lines = []
+
+        for stack, count in self.samples.most_common():
+            labels = [stack[0]] + [_label(code) for code in stack[1:]]
+            lines.append('%s %s' % (';'.join(labels), count))
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            f.write(self.collapsed())
+
+        return path
+
+
+PROFILER = Profiler()
+
+
+def toggle(directory=None):
+    if not PROFILER.running:
+        PROFILER.start()
+        return None
+
+    PROFILER.stop()
+
+    if directory is None:
+        directory = tempfile.gettempdir()
+
+    path = os.path.join(directory, 'syncthang-%s-%s.folded' % (
+        os.getpid(), time.strftime('%Y%m%d%H%M%S')))
+    LOG.info('Writing profile to %s', path)
+    return PROFILER.write(path)
+
+
+def install(directory=None, signum=TOGGLE_SIGNAL):
+    # NOTE(jkoelker) `kill -USR2 <pid>` starts sampling, sending it again
+    #                stops it and writes a collapsed stack file suitable for
+    #                flamegraph.pl to the temporary directory.
+    if signum is None:
+        return
+
+    signal.signal(signum, lambda signum, frame: toggle(directory))
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import time
+
+import eventlet
+from eventlet import event
+from eventlet import semaphore
+from eventlet import tpool
+
+from . import assembly
+
+
+LOG = logging.getLogger(__name__)
+
+PULL_CONCURRENCY = 16
+CONFLICT_FORMAT = '%s.sync-conflict-%s%s'
+
+
+def conflict_path(path, now=None):
+    root, ext = os.path.splitext(path)
+    stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(now))
+    return CONFLICT_FORMAT % (root, stamp, ext)
+
+
+def _keep_conflict(path):
+    # NOTE(jkoelker) The copy is picked up by the next scan as a new file.
+    if os.path.lexists(path):
+        os.rename(path, conflict_path(path))
+
+
+class Puller(object):
+    # NOTE(jkoelker) Pulls the files devices announce into the directory of
+    #                folders configured with a path. Blocks an older copy
+    #                already has are reused, the rest are fetched from the
+    #                announcing device and the finished file is committed
+    #                through the folder's assembly.Assembler. Only regular
+    #                files are pulled, and only over devices that can fetch
+    #                (the eventlet transport). A file whose version
+    #                conflicted with ours is kept as a conflict copy first.
+    def __init__(self, model, concurrency=PULL_CONCURRENCY):
+        self.model = model
+
+        self._limit = semaphore.Semaphore(concurrency)
+        self._assemblers = {}
+        self._pulling = {}
+
+    def assembler(self, folder):
+        config = self.model.folders.get(folder)
+
+        if config is None or config.path is None:
+            return None
+
+        assembler = self._assemblers.get(folder)
+
+        if assembler is None:
+            assembler = self._assemblers[folder] = assembly.Assembler(
+                config.path)
+
+        return assembler
+
+    def pulling(self, folder, name):
+        return (folder, name) in self._pulling
+
+    def pull(self, device, folder, files, conflicts=()):
+        if getattr(device, 'fetch', None) is None:
+            LOG.debug('Not pulling %s from %s, it can not fetch', folder,
+                      device.name)
+            return
+
+        for fileinfo in files:
+            if (fileinfo.deleted or fileinfo.invalid or fileinfo.directory or
+                    fileinfo.symlink):
+                continue
+
+            key = (folder, fileinfo.name)
+            item = (device, fileinfo, fileinfo.name in conflicts)
+
+            if key in self._pulling:
+                # NOTE(jkoelker) Picked up once the pull in flight is done,
+                #                they share the temporary file.
+                self._pulling[key] = item
+                continue
+
+            self._pulling[key] = item
+            eventlet.spawn_n(self._run, folder, key)
+
+    def _run(self, folder, key):
+        try:
+            while True:
+                item = self._pulling[key]
+
+                with self._limit:
+                    self._pull(folder, *item)
+
+                if self._pulling[key] is item:
+                    break
+
+        finally:
+            del self._pulling[key]
+
+    def _current(self, path, fileinfo):
+        try:
+            stat = os.stat(path)
+
+        except OSError:
+            return False
+
+        return (stat.st_size == fileinfo.blocks.total_size and
+                int(stat.st_mtime) == fileinfo.modified)
+
+    def _block(self, device, folder, fileinfo, offset, index):
+        # NOTE(jkoelker) Blocks the store already has, from any file, are
+        #                not fetched again. Fetched ones are stored for
+        #                folders served from the store.
+        store = self.model.blocks
+        blocks = fileinfo.blocks
+        sha = blocks.sha(index)
+        size = blocks.size(index)
+
+        if store is not None and store.has(sha):
+            try:
+                return store.get(sha, size)
+
+            except (IOError, OSError) as e:
+                LOG.debug('Fetching block %s of %s again: %s', index,
+                          fileinfo.name, e)
+
+        data = device.fetch(folder, fileinfo.name, offset, size, sha)
+
+        if self.model.stores_blocks(folder):
+            store.put(data, sha)
+
+        return data
+
+    def _pull(self, folder, device, fileinfo, conflict=False):
+        assembler = self.assembler(folder)
+
+        if assembler is None:
+            return
+
+        try:
+            path = tpool.execute(assembler.path, fileinfo)
+
+            if tpool.execute(self._current, path, fileinfo):
+                self.model.pulled(folder, fileinfo)
+                return
+
+            partial = assembler.open(fileinfo)
+
+        except Exception:
+            LOG.exception('Can not pull %s into %s', fileinfo.name, folder)
+            return
+
+        try:
+            assembler.reuse(partial)
+
+            for index in sorted(partial.missing):
+                partial.write(index, self._block(device, folder, fileinfo,
+                                                 partial.offsets[index],
+                                                 index))
+
+        except Exception:
+            LOG.exception('Failed to pull %s from %s', fileinfo.name,
+                          device.name)
+            partial.abort()
+            return
+
+        if conflict:
+            try:
+                tpool.execute(_keep_conflict, partial.path)
+
+            except Exception:
+                LOG.exception('Can not keep the conflicting %s in %s',
+                              fileinfo.name, folder)
+                partial.abort()
+                return
+
+        # NOTE(jkoelker) Wait for the batch holding the file to commit, so a
+        #                newer version does not truncate it in the meantime.
+        done = event.Event()
+        assembler.commit(partial, lambda fileinfo, error: done.send(error))
+        error = done.wait()
+
+        if error is None:
+            self.model.pulled(folder, fileinfo)
+            LOG.debug('Pulled %s into %s', fileinfo.name, folder)
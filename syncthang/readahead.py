@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import logging
+import os
+
+from eventlet import patcher
+
+
+LOG = logging.getLogger(__name__)
+
+MAX_HANDLES = 256
+MAX_STREAMS = 256
+MAX_CURSORS = 8
+READAHEAD_SIZE = 2 * 1024 * 1024
+SEQUENTIAL_RUN = 2
+
+_threading = patcher.original('threading')
+
+
+class _Handle(object):
+    __slots__ = ('fd', 'users', 'evicted', 'lock')
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.users = 0
+        self.evicted = False
+
+        # NOTE(jkoelker) Without os.pread (py2) a seek and read on a shared
+        #                fd must not interleave.
+        self.lock = None
+
+        if not hasattr(os, 'pread'):
+            self.lock = _threading.Lock()
+
+    def pread(self, size, offset):
+        if self.lock is None:
+            return os.pread(self.fd, size, offset)
+
+        with self.lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            return os.read(self.fd, size)
+
+
+class HandlePool(object):
+    # NOTE(jkoelker) An LRU of read only fds by path, used from tpool
+    #                threads. An evicted fd is only closed once the reads
+    #                using it are done, so its number is never reused under
+    #                a read in flight.
+    def __init__(self, size=MAX_HANDLES):
+        self.size = size
+        self._handles = collections.OrderedDict()
+        self._lock = _threading.Lock()
+
+    def __len__(self):
+        return len(self._handles)
+
+    def _evict(self, handle):
+        handle.evicted = True
+
+        if not handle.users:
+            os.close(handle.fd)
+
+    def acquire(self, path):
+        with self._lock:
+            handle = self._handles.pop(path, None)
+
+            if handle is None:
+                handle = _Handle(os.open(path, os.O_RDONLY))
+
+                while self._handles and len(self._handles) >= self.size:
+                    self._evict(self._handles.popitem(last=False)[1])
+
+            self._handles[path] = handle
+            handle.users = handle.users + 1
+            return handle
+
+    def discard(self, path):
+        with self._lock:
+            handle = self._handles.pop(path, None)
+
+            if handle is not None:
+                self._evict(handle)
+
+    def release(self, handle):
+        with self._lock:
+            handle.users = handle.users - 1
+
+            if handle.evicted and not handle.users:
+                os.close(handle.fd)
+
+    def read(self, path, offset, size):
+        handle = self.acquire(path)
+
+        try:
+            return handle.pread(size, offset)
+
+        finally:
+            self.release(handle)
+
+    def close(self):
+        with self._lock:
+            for handle in self._handles.values():
+                self._evict(handle)
+
+            self._handles.clear()
+
+
+class _Stream(object):
+    __slots__ = ('cursors', 'buffer')
+
+    def __init__(self):
+        self.cursors = collections.OrderedDict()
+        self.buffer = {}
+
+
+class Readahead(object):
+    # NOTE(jkoelker) Tracks the blocks requested of each file. Once a reader
+    #                asks for SEQUENTIAL_RUN blocks in a row, the next miss
+    #                loads the following size bytes of blocks in the same
+    #                call and keeps them for the requests that follow, so a
+    #                pull of a large file costs one hop per window instead
+    #                of one per block. A few cursors are kept per file so
+    #                several peers pulling it at once do not reset each
+    #                other. Safe to share between green and real threads,
+    #                the lock is never held across load.
+    def __init__(self, size=READAHEAD_SIZE, streams=MAX_STREAMS):
+        self.size = size
+        self.streams = streams
+
+        self.hits = 0
+        self.misses = 0
+        self._streams = collections.OrderedDict()
+        self._lock = _threading.Lock()
+
+    def _stream(self, key):
+        stream = self._streams.pop(key, None)
+
+        if stream is None:
+            stream = _Stream()
+
+            while self._streams and len(self._streams) >= self.streams:
+                self._streams.popitem(last=False)
+
+        self._streams[key] = stream
+        return stream
+
+    def _advance(self, stream, index):
+        run = stream.cursors.pop(index, 0) + 1
+
+        while len(stream.cursors) >= MAX_CURSORS:
+            stream.cursors.popitem(last=False)
+
+        stream.cursors[index + 1] = run
+        return run
+
+    def forget(self, key):
+        with self._lock:
+            self._streams.pop(key, None)
+
+    def read(self, key, blocks, index, load):
+        # NOTE(jkoelker) load(blocks, indices) returns the data of those
+        #                blocks, in order.
+        sha = blocks.sha(index)
+        window = max(1, self.size // max(blocks.block_size, 1))
+
+        with self._lock:
+            stream = self._stream(key)
+            run = self._advance(stream, index)
+            cached = stream.buffer.pop(index, None)
+
+            if cached is not None and cached[0] == sha:
+                self.hits = self.hits + 1
+                return cached[1]
+
+            self.misses = self.misses + 1
+            indices = [index]
+
+            if self.size and run >= SEQUENTIAL_RUN:
+                end = min(len(blocks), index + window)
+                indices.extend(i for i in range(index + 1, end)
+                               if i not in stream.buffer)
+
+        datas = load(blocks, indices)
+
+        with self._lock:
+            # NOTE(jkoelker) Drop what the cursors have moved past.
+            lowest = min(stream.cursors) - 1
+            for stale in [i for i in stream.buffer if i < lowest]:
+                del stream.buffer[stale]
+
+            if len(stream.buffer) + len(indices) > window * MAX_CURSORS:
+                stream.buffer.clear()
+
+            for ahead, data in zip(indices[1:], datas[1:]):
+                stream.buffer[ahead] = (blocks.sha(ahead), data)
+
+        return datas[0]
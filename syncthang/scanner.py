@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+import heapq
+import itertools
+import logging
+import os
+
+import eventlet
+from eventlet import event
+from eventlet import tpool
+
+from . import fs
+from . import metrics
+
+
+LOG = logging.getLogger(__name__)
+
+# NOTE(jkoelker) Lower runs first. Hashing a file that just changed holds
+#                up an index update, a periodic rescan holds up nothing.
+CHANGE = 0
+RESCAN = 1
+
+ROTATIONAL_CONCURRENCY = 1
+SOLID_STATE_CONCURRENCY = 4
+DEFAULT_CONCURRENCY = 2
+
+
+def device_concurrency(dev):
+    # NOTE(jkoelker) A spinning disk gets one reader so its reads stay
+    #                sequential, an SSD several. Filesystems without a
+    #                block device behind them (NFS, FUSE) get the default.
+    path = '/sys/dev/block/%s:%s' % (os.major(dev), os.minor(dev))
+
+    # NOTE(jkoelker) Partitions have their disk's queue one level up.
+    for queue in (os.path.join(path, 'queue'),
+                  os.path.join(os.path.realpath(path), os.pardir, 'queue')):
+        try:
+            with open(os.path.join(queue, 'rotational')) as f:
+                rotational = f.read().strip()
+
+        except (IOError, OSError):
+            continue
+
+        if rotational == '1':
+            return ROTATIONAL_CONCURRENCY
+
+        return SOLID_STATE_CONCURRENCY
+
+    return DEFAULT_CONCURRENCY
+
+
+def _hash(path, large_blocks, drop_cache, next_path, on_block):
+    if next_path is not None:
+        fs.prefetch(next_path)
+
+    return fs.hash_path(path, large_blocks, drop_cache, on_block)
+
+
+class _Device(object):
+    def __init__(self, dev, concurrency):
+        self.dev = dev
+        self.concurrency = concurrency
+        self.queue = []
+        self.active = 0
+
+
+class Scheduler(object):
+    # NOTE(jkoelker) Hashing is queued per device (st_dev) with a limit on
+    #                how many files of each are read at once, so folders
+    #                sharing a disk take turns and folders on separate disks
+    #                run side by side. Each queue is ordered by priority and
+    #                then inode, which on most filesystems is close to the
+    #                on disk order. Rescans drop what they read from the page
+    #                cache so they do not push out the hot files.
+    def __init__(self, large_blocks=False, concurrency=None):
+        self.large_blocks = large_blocks
+        self.concurrency = concurrency or {}
+
+        self._devices = {}
+        self._counter = itertools.count()
+
+    def _device(self, dev):
+        device = self._devices.get(dev)
+
+        if device is None:
+            concurrency = self.concurrency.get(dev)
+
+            if concurrency is None:
+                concurrency = device_concurrency(dev)
+
+            LOG.debug('Hashing up to %s files at once on device %s',
+                      concurrency, dev)
+            device = self._devices[dev] = _Device(dev, concurrency)
+
+        return device
+
+    def submit(self, path, priority=CHANGE, large_blocks=None, stat=None,
+               on_block=None):
+        # NOTE(jkoelker) large_blocks is per folder, None uses the default.
+        #                Scans pass the stat they already have, otherwise it
+        #                is taken off the hub. on_block, see fs.hash_path,
+        #                runs in the hashing thread.
+        if large_blocks is None:
+            large_blocks = self.large_blocks
+
+        if stat is None:
+            stat = tpool.execute(os.stat, path)
+
+        device = self._device(stat.st_dev)
+        done = event.Event()
+
+        heapq.heappush(device.queue, (priority, stat.st_ino,
+                                      next(self._counter), path,
+                                      large_blocks, on_block, done))
+
+        if device.active < device.concurrency:
+            device.active = device.active + 1
+            eventlet.spawn_n(self._run, device)
+
+        return done
+
+    def hash(self, path, priority=CHANGE, large_blocks=None):
+        return self.submit(path, priority, large_blocks).wait()
+
+    def scan(self, paths, priority=RESCAN, large_blocks=None, stats=None,
+             on_block=None):
+        if stats is None:
+            stats = {}
+
+        pending = []
+
+        for path in paths:
+            try:
+                pending.append((path, self.submit(path, priority,
+                                                  large_blocks,
+                                                  stats.get(path),
+                                                  on_block)))
+
+            except OSError as e:
+                LOG.warning('Not hashing %s: %s', path, e)
+
+        for path, done in pending:
+            try:
+                yield path, done.wait()
+
+            except (IOError, OSError) as e:
+                LOG.warning('Failed to hash %s: %s', path, e)
+
+    def _run(self, device):
+        try:
+            while device.queue:
+                (priority, _, _, path, large_blocks, on_block,
+                 done) = heapq.heappop(device.queue)
+                next_path = device.queue[0][3] if device.queue else None
+                start = metrics.clock()
+
+                try:
+                    blocks = tpool.execute(_hash, path, large_blocks,
+                                           priority != CHANGE, next_path,
+                                           on_block)
+
+                except Exception as e:
+                    done.send_exception(e)
+                    continue
+
+                if metrics.ENABLED:
+                    metrics.hashed(blocks.total_size, metrics.clock() - start)
+
+                done.send(blocks)
+
+        finally:
+            device.active = device.active - 1
@@ -1,41 +1,186 @@
 # -*- coding: utf-8 -*-
 
-import functools
+import binascii
 import logging
+import os
+import tempfile
 
-from eventlet.green.OpenSSL import crypto
+from eventlet.green.OpenSSL import SSL
 import eventlet
 
-from .bep import messages
+from .bep import capture
 from .bep import protocol
+from . import admission
+from . import metrics
+from . import profiler
 
 
 LOG = logging.getLogger(__name__)
+BACKLOG = 1024
+TRANSPORTS = ('eventlet', 'asyncio')
+
+SESSION_ID = b'syncthang'
+SESSION_TIMEOUT = 60 * 60
 
 
 def cert_to_device_id(cert):
-    cert_bytes = crypto.dump_certificate(crypto.FILETYPE_ASN1, cert)
-    return messages.device_id_from_cert(cert_bytes)
+    # NOTE(jkoelker) The device id is the SHA-256 of the DER certificate,
+    #                which is exactly the fingerprint OpenSSL computes, so
+    #                skip dumping the certificate back into Python.
+    fingerprint = cert.digest('sha256')
+    return binascii.unhexlify(fingerprint.replace(b':', b''))
+
+
+def _verify(conn, cert, errno, depth, ok):
+    # NOTE(jkoelker) Devices use self-signed certificates; identity is the
+    #                device id derived from the certificate, not its chain.
+    return True
+
+
+def context(cert_file, key_file, session_cache=True):
+    ctx = SSL.Context(SSL.SSLv23_METHOD)
+    ctx.set_options(SSL.OP_NO_SSLv2 | SSL.OP_NO_SSLv3)
+    ctx.use_certificate_file(cert_file)
+    ctx.use_privatekey_file(key_file)
+    ctx.set_verify(SSL.VERIFY_PEER | SSL.VERIFY_FAIL_IF_NO_PEER_CERT, _verify)
+
+    if session_cache:
+        # NOTE(jkoelker) Let reconnecting devices resume with a session id
+        #                or ticket instead of a full handshake. Ticket keys
+        #                are created with the context, so workers forked
+        #                from it accept each other's tickets.
+        ctx.set_session_id(SESSION_ID)
+        ctx.set_session_cache_mode(SSL.SESS_CACHE_SERVER)
+        ctx.set_timeout(SESSION_TIMEOUT)
+
+    else:
+        ctx.set_session_cache_mode(SSL.SESS_CACHE_OFF)
+        ctx.set_options(SSL.OP_NO_TICKET)
+
+    return ctx
+
+
+def listen(address, ctx, reuse_port=False, backlog=BACKLOG):
+    sock = eventlet.listen(address, backlog=backlog, reuse_port=reuse_port)
+    return SSL.Connection(ctx, sock)
+
+
+def _capture(capture_dir, device_id):
+    if capture_dir is None:
+        return None
+
+    # NOTE(jkoelker) mkstemp picks a name no other connection has, even
+    #                for reconnects within the same second.
+    prefix = '%s-%s-' % (binascii.hexlify(device_id).decode(), os.getpid())
+    fd, path = tempfile.mkstemp(suffix='.bep', prefix=prefix,
+                                dir=capture_dir)
+    os.close(fd)
+    LOG.info('Capturing the traffic of %s to %s', device_id, path)
+    return capture.Capture(path, device_id)
+
+
+def start_remote(local_device_id, model, gate, sock, addr, capture_dir=None):
+    timeout = eventlet.Timeout(gate.handshake_timeout)
+
+    try:
+        sock.do_handshake()
+
+    except eventlet.Timeout as e:
+        if e is not timeout:
+            raise
+
+        LOG.info('TLS handshake with %s timed out', addr)
+        return
+
+    except SSL.Error:
+        LOG.info('TLS handshake with %s failed', addr)
+        return
 
+    finally:
+        timeout.cancel()
+        gate.handshaken()
 
-def start_remote(local_device_id, model, sock, addr):
     cert = sock.get_peer_certificate()
     device_id = cert_to_device_id(cert)
 
     if local_device_id == device_id:
         LOG.info('Connected to myself (%s) - should not happen', device_id)
         sock.shutdown()
-        sock.close()
+        return
+
+    if not gate.admit(model, device_id):
+        LOG.info('Not admitting device (%s)', device_id)
+        sock.shutdown()
+        return
 
-    if device_id in model.devices:
+    if not model.claim_device(device_id):
         LOG.info('Connected to already connected device (%s)', device_id)
         sock.shutdown()
+        return
+
+    recorder = _capture(capture_dir, device_id)
+
+    try:
+        remote_device = protocol.RemoteDevice(
+            device_id, sock, model, local_device_id=local_device_id,
+            capture=recorder, observer=metrics.observer(device_id))
+        model.devices[device_id] = remote_device
+        remote_device.start()
+
+    finally:
+        model.release_device(device_id)
+
+        if recorder is not None:
+            recorder.close()
+
+
+def _handle(local_device_id, model, gate, sock, addr, capture_dir=None):
+    try:
+        start_remote(local_device_id, model, gate, sock, addr, capture_dir)
+
+    except Exception:
+        LOG.exception('Connection from %s failed', addr)
+
+    finally:
         sock.close()
 
-    remote_device = protocol.RemoteDevice(device_id, sock, model)
-    model.devices[device_id] = remote_device
-    remote_device.start()
 
+def serve(sock, device_id, model, gate=None, capture_dir=None):
+    # NOTE(jkoelker) Unlike eventlet.serve, a failing connection must not
+    #                take the server down, and rejected connections are
+    #                closed before a green thread is spawned for them.
+    if gate is None:
+        gate = admission.Admission()
+
+    while True:
+        try:
+            conn, addr = sock.accept()
+
+        except EnvironmentError:
+            LOG.exception('Error accepting connection')
+            eventlet.sleep(0)
+            continue
+
+        if not gate.accept(addr):
+            conn.close()
+            continue
+
+        eventlet.spawn_n(_handle, device_id, model, gate, conn, addr,
+                         capture_dir)
+
+
+def run(address, ctx, device_id, model, transport='eventlet', gate=None,
+        capture_dir=None):
+    # NOTE(jkoelker) With a capture_dir every connection's frames are
+    #                recorded there for benchmarks/replay.py. Only the
+    #                eventlet transport supports it.
+    if transport not in TRANSPORTS:
+        raise ValueError('Unknown transport: %s' % transport)
+
+    profiler.install()
+
+    if transport == 'asyncio':
+        from . import aio
+        return aio.serve(address, ctx, device_id, model, gate=gate)
 
-def serve(sock, device_id, model):
-    eventlet.serve(sock, functools.partial(start_remote, device_id, model))
+    serve(listen(address, ctx), device_id, model, gate, capture_dir)
@@ -0,0 +1,631 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import logging
+import mmap
+import os
+import struct
+import time
+import xdrlib
+import zlib
+
+import eventlet
+from eventlet import tpool
+import six
+
+from .bep import messages
+from . import versions
+
+
+LOG = logging.getLogger(__name__)
+
+SNAPSHOT_NAME = 'index.snapshot'
+JOURNAL_PREFIX = 'index.journal.'
+SNAPSHOT_INTERVAL = 300.0
+JOURNAL_SIZE = 64 * 1024 * 1024
+SYNC_INTERVAL = 1.0
+
+MAGIC = b'SYNCTHNG'
+FORMAT = 2
+
+# NOTE(jkoelker) A snapshot is a header, the folder table, the folder
+#                membership table, one fixed width record per file sorted by
+#                folder then name, and the heap holding the names, version
+#                vectors and block sizes and digests the records point into.
+#                Nothing is decoded up front beyond the folder and member
+#                tables, a file is found by binary searching its folder's
+#                range of records. Folder ids stay bytes, as in BEP.
+_HEADER = struct.Struct('!8sIQIQQ')
+_FOLDER = struct.Struct('!QIQQQ')
+_MEMBER = struct.Struct('!I%ss' % versions.DEVICE_ID_SIZE)
+_RECORD = struct.Struct('!QIIQQQIQI')
+_COUNTER = struct.Struct('!QQ')
+_SIZE = struct.Struct('!I')
+
+# NOTE(jkoelker) Journal entries are length and crc32 prefixed XDR, a torn
+#                write at the tail is detected and truncated on replay.
+_ENTRY = struct.Struct('!II')
+
+_FILES = 1
+_ADD_MEMBER = 2
+_REMOVE_MEMBER = 3
+
+_datasync = getattr(os, 'fdatasync', os.fsync)
+
+
+def _encode(value):
+    if isinstance(value, six.text_type):
+        return value.encode('utf-8')
+
+    return value
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+
+    try:
+        os.fsync(fd)
+
+    finally:
+        os.close(fd)
+
+
+def _merge(base, changes):
+    # NOTE(jkoelker) Both are (name, fileinfo) sorted by name, changes win.
+    base = iter(base)
+    changes = iter(changes)
+    left = next(base, None)
+    right = next(changes, None)
+
+    while left is not None and right is not None:
+        if left[0] < right[0]:
+            yield left
+            left = next(base, None)
+
+        elif right[0] < left[0]:
+            yield right
+            right = next(changes, None)
+
+        else:
+            yield right
+            left = next(base, None)
+            right = next(changes, None)
+
+    while left is not None:
+        yield left
+        left = next(base, None)
+
+    while right is not None:
+        yield right
+        right = next(changes, None)
+
+
+class Snapshot(object):
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+            header = _HEADER.unpack_from(self._map, 0)
+
+        except Exception:
+            self._file.close()
+            raise
+
+        (magic, fmt, self.sequence, folder_count, member_count,
+         self.record_count) = header
+
+        if magic != MAGIC or fmt != FORMAT:
+            self.close()
+            raise ValueError('%s is not an index snapshot' % path)
+
+        offset = _HEADER.size
+        self._records = (offset + folder_count * _FOLDER.size +
+                         member_count * _MEMBER.size)
+        self._heap = self._records + self.record_count * _RECORD.size
+
+        self.folders = collections.OrderedDict()
+
+        for _ in six.moves.range(folder_count):
+            name_offset, name_size, first, count, version = \
+                _FOLDER.unpack_from(self._map, offset)
+            name = self._string(name_offset, name_size)
+            self.folders[name] = (first, count, version)
+            offset = offset + _FOLDER.size
+
+        names = list(self.folders)
+        self.members = []
+
+        for _ in six.moves.range(member_count):
+            index, device_id = _MEMBER.unpack_from(self._map, offset)
+            self.members.append((names[index], device_id))
+            offset = offset + _MEMBER.size
+
+    def __len__(self):
+        return self.record_count
+
+    def _string(self, offset, size):
+        offset = self._heap + offset
+        return self._map[offset:offset + size]
+
+    def _record(self, index):
+        return _RECORD.unpack_from(self._map,
+                                   self._records + index * _RECORD.size)
+
+    def _name(self, index):
+        record = self._record(index)
+        return self._string(record[0], record[1])
+
+    def _fileinfo(self, index):
+        (name_offset, name_size, flags, modified, local_version,
+         vector_offset, vector_count, blocks_offset,
+         block_count) = self._record(index)
+
+        version = messages.Vector()
+        offset = self._heap + vector_offset
+
+        for _ in six.moves.range(vector_count):
+            ident, value = _COUNTER.unpack_from(self._map, offset)
+            version[ident] = value
+            offset = offset + _COUNTER.size
+
+        blocks = messages.BlockList()
+        offset = self._heap + blocks_offset
+        shas = offset + block_count * _SIZE.size
+
+        for block in six.moves.range(block_count):
+            size, = _SIZE.unpack_from(self._map, offset + block * _SIZE.size)
+            sha = shas + block * messages.SHA_SIZE
+            blocks.add(size, self._map[sha:sha + messages.SHA_SIZE])
+
+        return messages.FileInfo(self._string(name_offset, name_size), flags,
+                                 modified, version, local_version, blocks)
+
+    def version(self, folder):
+        return self.folders.get(folder, (0, 0, 0))[2]
+
+    def find(self, folder, name):
+        if folder not in self.folders:
+            return None
+
+        first, count, _ = self.folders[folder]
+        low, high = first, first + count
+
+        while low < high:
+            middle = (low + high) // 2
+
+            if self._name(middle) < name:
+                low = middle + 1
+
+            else:
+                high = middle
+
+        if low < first + count and self._name(low) == name:
+            return self._fileinfo(low)
+
+    def fileinfos(self, folder):
+        if folder not in self.folders:
+            return
+
+        first, count, _ = self.folders[folder]
+
+        for index in six.moves.range(first, first + count):
+            fileinfo = self._fileinfo(index)
+            yield fileinfo.name, fileinfo
+
+    def changed(self, folder, min_local_version):
+        # NOTE(jkoelker) Only the records newer than min_local_version are
+        #                decoded.
+        if folder not in self.folders:
+            return
+
+        first, count, _ = self.folders[folder]
+
+        for index in six.moves.range(first, first + count):
+            if self._record(index)[4] > min_local_version:
+                yield self._fileinfo(index)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+        self._file.close()
+
+
+def _write_snapshot(path, sequence, snapshot, changes, members,
+                    local_versions):
+    folders = set(changes) | set(members) | set(local_versions)
+
+    if snapshot is not None:
+        folders.update(snapshot.folders)
+
+    heap = bytearray()
+    folder_table = bytearray()
+    member_table = bytearray()
+    records = bytearray()
+    member_count = 0
+    record_count = 0
+
+    def string(value):
+        offset = len(heap)
+        heap.extend(value)
+        return offset, len(value)
+
+    for index, folder in enumerate(sorted(folders)):
+        base = ()
+        version = local_versions.get(folder, 0)
+
+        if snapshot is not None:
+            base = snapshot.fileinfos(folder)
+            version = max(version, snapshot.version(folder))
+
+        first = record_count
+        folder_changes = sorted(six.iteritems(changes.get(folder, {})))
+
+        for name, fileinfo in _merge(base, folder_changes):
+            name_offset, name_size = string(name)
+            vector_offset = len(heap)
+
+            for counter in sorted(six.iteritems(fileinfo.version)):
+                heap.extend(_COUNTER.pack(*counter))
+
+            blocks_offset = len(heap)
+            blocks = fileinfo.blocks
+
+            for size in blocks.sizes:
+                heap.extend(_SIZE.pack(size))
+
+            heap.extend(blocks.shas)
+
+            records.extend(_RECORD.pack(name_offset, name_size,
+                                        fileinfo.flags, fileinfo.modified,
+                                        fileinfo.local_version,
+                                        vector_offset,
+                                        len(fileinfo.version),
+                                        blocks_offset, len(blocks)))
+            record_count = record_count + 1
+
+        name_offset, name_size = string(_encode(folder))
+        folder_table.extend(_FOLDER.pack(name_offset, name_size, first,
+                                         record_count - first, version))
+
+        for device_id in members.get(folder, ()):
+            member_table.extend(_MEMBER.pack(index, device_id))
+            member_count = member_count + 1
+
+    with open(path, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, FORMAT, sequence, len(folders),
+                             member_count, record_count))
+        f.write(folder_table)
+        f.write(member_table)
+        f.write(records)
+        f.write(heap)
+        f.flush()
+        _datasync(f.fileno())
+
+    return record_count
+
+
+class IndexStore(object):
+    # NOTE(jkoelker) Startup maps the last snapshot and replays the journal
+    #                written since, so it costs the number of folders plus
+    #                the size of the journal, not the size of the index.
+    #                maintain (spawn it) syncs the journal and folds it into
+    #                a new snapshot in a tpool thread every so often. Like
+    #                LevelDBVersions each worker needs its own path.
+    def __init__(self, path):
+        self.path = path
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.members = collections.defaultdict(list)
+        self.local_versions = collections.defaultdict(int)
+        self.journal_size = 0
+
+        self._snapshot = None
+        self._overlay = collections.defaultdict(dict)
+        self._frozen = None
+        self._compacting = False
+        self._dirty = False
+        self._closed = False
+
+        sequence = 0
+        snapshot_path = os.path.join(path, SNAPSHOT_NAME)
+
+        if os.path.exists(snapshot_path):
+            self._snapshot = Snapshot(snapshot_path)
+            sequence = self._snapshot.sequence
+
+            for folder, (_, _, version) in six.iteritems(
+                    self._snapshot.folders):
+                self.local_versions[folder] = version
+
+            for folder, device_id in self._snapshot.members:
+                self.members[folder].append(device_id)
+
+        segments = self._segments()
+
+        for segment in segments:
+            if segment < sequence:
+                # NOTE(jkoelker) Already folded into the snapshot.
+                os.unlink(self._journal_path(segment))
+                continue
+
+            self._replay(segment)
+
+        self.sequence = max([sequence] + segments)
+        self._journal = self._open_journal(self.sequence)
+        self.journal_size = os.fstat(self._journal).st_size
+
+    def _journal_path(self, sequence):
+        return os.path.join(self.path, '%s%016d' % (JOURNAL_PREFIX, sequence))
+
+    def _segments(self):
+        segments = []
+
+        for name in os.listdir(self.path):
+            if name.startswith(JOURNAL_PREFIX):
+                try:
+                    segments.append(int(name[len(JOURNAL_PREFIX):]))
+
+                except ValueError:
+                    continue
+
+        return sorted(segments)
+
+    def _open_journal(self, sequence):
+        return os.open(self._journal_path(sequence),
+                       os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def _replay(self, sequence):
+        path = self._journal_path(sequence)
+
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        offset = 0
+        entries = 0
+
+        while offset + _ENTRY.size <= len(data):
+            size, crc = _ENTRY.unpack_from(data, offset)
+            payload = data[offset + _ENTRY.size:offset + _ENTRY.size + size]
+
+            if len(payload) != size or zlib.crc32(payload) & 0xffffffff != crc:
+                break
+
+            self._apply(xdrlib.Unpacker(payload))
+            offset = offset + _ENTRY.size + size
+            entries = entries + 1
+
+        if offset != len(data):
+            LOG.warning('Truncating %s at %s bytes, %s bytes are torn',
+                        path, offset, len(data) - offset)
+
+            with open(path, 'r+b') as f:
+                f.truncate(offset)
+
+        LOG.debug('Replayed %s entries from %s', entries, path)
+
+    def _apply(self, unpacker):
+        kind = unpacker.unpack_uint()
+        folder = unpacker.unpack_string()
+
+        if kind == _FILES:
+            files = unpacker.unpack_array(
+                lambda: messages.FileInfo.unpack(unpacker))
+            self._update(folder, files)
+
+        elif kind == _ADD_MEMBER:
+            self._add_member(folder, unpacker.unpack_opaque())
+
+        elif kind == _REMOVE_MEMBER:
+            self._remove_member(folder, unpacker.unpack_opaque())
+
+    def _append(self, packer):
+        payload = packer.get_buffer()
+        entry = _ENTRY.pack(len(payload), zlib.crc32(payload) & 0xffffffff)
+        entry = entry + payload
+
+        os.write(self._journal, entry)
+        self.journal_size = self.journal_size + len(entry)
+        self._dirty = True
+
+    def _packer(self, kind, folder):
+        packer = xdrlib.Packer()
+        packer.pack_uint(kind)
+        packer.pack_string(_encode(folder))
+        return packer
+
+    def _update(self, folder, files):
+        overlay = self._overlay[folder]
+
+        for fileinfo in files:
+            overlay[fileinfo.name] = fileinfo
+
+            if fileinfo.local_version > self.local_versions[folder]:
+                self.local_versions[folder] = fileinfo.local_version
+
+    def update(self, folder, files):
+        files = [messages.FileInfo(_encode(f.name), f.flags, f.modified,
+                                   messages.Vector(f.version),
+                                   f.local_version, f.blocks)
+                 for f in files]
+
+        if not files:
+            return
+
+        packer = self._packer(_FILES, folder)
+        packer.pack_array(files, lambda f: f.pack(packer))
+        self._append(packer)
+        self._update(folder, files)
+
+    def _add_member(self, folder, device_id):
+        if device_id in self.members[folder]:
+            return False
+
+        self.members[folder].append(device_id)
+        return True
+
+    def add_member(self, folder, device_id):
+        if self._add_member(folder, device_id):
+            packer = self._packer(_ADD_MEMBER, folder)
+            packer.pack_opaque(device_id)
+            self._append(packer)
+
+    def _remove_member(self, folder, device_id):
+        if device_id not in self.members.get(folder, ()):
+            return False
+
+        self.members[folder].remove(device_id)
+        return True
+
+    def remove_member(self, folder, device_id):
+        if self._remove_member(folder, device_id):
+            packer = self._packer(_REMOVE_MEMBER, folder)
+            packer.pack_opaque(device_id)
+            self._append(packer)
+
+    def get(self, folder, name):
+        name = _encode(name)
+
+        for layer in (self._overlay, self._frozen):
+            if layer is not None and folder in layer:
+                fileinfo = layer[folder].get(name)
+
+                if fileinfo is not None:
+                    return fileinfo
+
+        if self._snapshot is not None:
+            return self._snapshot.find(folder, name)
+
+    def fileinfos(self, folder):
+        changes = {}
+
+        for layer in (self._frozen, self._overlay):
+            if layer is not None and folder in layer:
+                changes.update(layer[folder])
+
+        base = ()
+        if self._snapshot is not None:
+            base = self._snapshot.fileinfos(folder)
+
+        for _, fileinfo in _merge(base, sorted(six.iteritems(changes))):
+            yield fileinfo
+
+    def changed(self, folder, min_local_version):
+        # NOTE(jkoelker) Local versions only grow, so a file changed since
+        #                the snapshot is newer in the overlay than in it.
+        changes = {}
+
+        for layer in (self._frozen, self._overlay):
+            if layer is not None and folder in layer:
+                changes.update(layer[folder])
+
+        files = [fileinfo for fileinfo in six.itervalues(changes)
+                 if fileinfo.local_version > min_local_version]
+
+        if self._snapshot is not None:
+            files.extend(fileinfo for fileinfo in
+                         self._snapshot.changed(folder, min_local_version)
+                         if fileinfo.name not in changes)
+
+        return files
+
+    def sync(self):
+        if self._dirty:
+            self._dirty = False
+            tpool.execute(_datasync, self._journal)
+
+    def compact(self):
+        if self._compacting:
+            return False
+
+        self._compacting = True
+        start = time.time()
+
+        # NOTE(jkoelker) Freeze the changes so far and start a new journal
+        #                segment for the ones that arrive while the snapshot
+        #                is written. The frozen changes stay readable until
+        #                the new snapshot replaces the old one.
+        frozen, self._overlay = self._overlay, collections.defaultdict(dict)
+        self._frozen = frozen
+        members = dict((f, list(d)) for f, d in six.iteritems(self.members))
+        local_versions = dict(self.local_versions)
+
+        self.sync()
+        os.close(self._journal)
+        self.sequence = self.sequence + 1
+        self._journal = self._open_journal(self.sequence)
+        self.journal_size = 0
+
+        path = os.path.join(self.path, SNAPSHOT_NAME)
+        temp_path = path + '.tmp'
+
+        try:
+            count = tpool.execute(_write_snapshot, temp_path, self.sequence,
+                                  self._snapshot, frozen, members,
+                                  local_versions)
+            os.rename(temp_path, path)
+            tpool.execute(_fsync_dir, self.path)
+            snapshot = Snapshot(path)
+
+        except Exception:
+            # NOTE(jkoelker) The frozen changes are still in the previous
+            #                journal segment, keep them for the next try.
+            for folder, changes in six.iteritems(frozen):
+                overlay = self._overlay[folder]
+
+                for name, fileinfo in six.iteritems(changes):
+                    overlay.setdefault(name, fileinfo)
+
+            raise
+
+        finally:
+            self._frozen = None
+            self._compacting = False
+
+        if self._snapshot is not None:
+            self._snapshot.close()
+
+        self._snapshot = snapshot
+
+        for segment in self._segments():
+            if segment < self.sequence:
+                os.unlink(self._journal_path(segment))
+
+        LOG.info('Wrote an index snapshot of %s files in %.2fs', count,
+                 time.time() - start)
+        return True
+
+    def maintain(self, interval=SNAPSHOT_INTERVAL, journal_size=JOURNAL_SIZE):
+        last = time.time()
+
+        while not self._closed:
+            eventlet.sleep(SYNC_INTERVAL)
+
+            if self._closed:
+                break
+
+            try:
+                self.sync()
+
+                if (self.journal_size >= journal_size or
+                        (self.journal_size and
+                         time.time() - last >= interval)):
+                    self.compact()
+                    last = time.time()
+
+            except Exception:
+                LOG.exception('Failed to maintain the index at %s', self.path)
+
+    def close(self):
+        self._closed = True
+        self.sync()
+        os.close(self._journal)
+
+        if self._snapshot is not None:
+            self._snapshot.close()
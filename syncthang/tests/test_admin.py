@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+
+from syncthang.bep import messages
+from syncthang import admin
+from syncthang import model
+
+
+DEVICE = b'\xaa' * 32
+
+
+def _get(model_, path, query=''):
+    response = {}
+
+    def start_response(status, headers):
+        response['status'] = status
+
+    environ = {'PATH_INFO': path, 'QUERY_STRING': query,
+               'syncthang.model': model_}
+    body = b''.join(admin.application(environ, start_response))
+    return response['status'], body.decode('utf-8')
+
+
+def test_tree_looks_up_bytes_folders():
+    fileinfo = messages.FileInfo(b'dir/a', 0o644, 1234,
+                                 messages.Vector({1: 1}))
+    fileinfo.add_block(4, hashlib.sha256(b'a').digest())
+    model_ = model.Model(b'syncthang-test', b'0.1.0')
+    model_.update_index(DEVICE, b'default', [fileinfo])
+
+    status, body = _get(model_, '/tree', 'folder=default')
+    assert status == '200 OK'
+    assert body.splitlines()[1].endswith('  dir/')
+
+    status, body = _get(model_, '/tree', 'folder=default&path=dir')
+    assert body.splitlines()[1].endswith('  dir/a')
+
+    status, _ = _get(model_, '/tree', 'folder=other')
+    assert status == '404 Not Found'
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+from syncthang import admission
+from syncthang import metrics
+
+
+class Clock(object):
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class Model(object):
+    def __init__(self, *device_ids):
+        self.devices = dict((device_id, object())
+                            for device_id in device_ids)
+
+
+def _gate(clock, **kwargs):
+    options = dict(accept_rate=1000.0, accept_burst=1000,
+                   ip_accept_rate=1000.0, ip_accept_burst=1000,
+                   clock=clock)
+    options.update(kwargs)
+    return admission.Admission(**options)
+
+
+def test_token_bucket_refills_up_to_burst():
+    bucket = admission.TokenBucket(2.0, 3, 0.0)
+
+    assert [bucket.consume(0.0) for _ in range(4)] == [True] * 3 + [False]
+
+    # NOTE(jkoelker) Half a second at two tokens a second is one token.
+    assert bucket.consume(0.5)
+    assert not bucket.consume(0.5)
+
+    # NOTE(jkoelker) A long idle period refills no more than the burst.
+    assert [bucket.consume(100.0) for _ in range(4)] == [True] * 3 + [False]
+
+
+def test_accept_limits_the_global_rate():
+    clock = Clock()
+    gate = _gate(clock, accept_rate=1.0, accept_burst=2)
+    accepted = [gate.accept(('10.0.0.%d' % index, 22000))
+                for index in range(3)]
+
+    assert accepted == [True, True, False]
+    assert gate.pending == 2
+
+    clock.now = 1.0
+
+    assert gate.accept(('10.0.0.3', 22000))
+    assert not gate.accept(('10.0.0.4', 22000))
+
+
+def test_accept_limits_the_rate_per_ip():
+    clock = Clock()
+    gate = _gate(clock, ip_accept_rate=1.0, ip_accept_burst=2)
+    addr = ('10.0.0.1', 22000)
+
+    assert gate.accept(addr)
+    assert gate.accept(addr)
+    assert not gate.accept(addr)
+
+    # NOTE(jkoelker) Other addresses have their own bucket.
+    assert gate.accept(('10.0.0.2', 22000))
+
+    clock.now = 1.0
+
+    assert gate.accept(addr)
+    assert not gate.accept(addr)
+
+
+def test_accept_caps_pending_handshakes():
+    gate = _gate(Clock(), max_pending=2)
+
+    assert gate.accept(('10.0.0.1', 22000))
+    assert gate.accept(('10.0.0.2', 22000))
+    assert not gate.accept(('10.0.0.3', 22000))
+    assert gate.pending == 2
+
+    gate.handshaken()
+
+    assert gate.pending == 1
+    assert gate.accept(('10.0.0.3', 22000))
+    assert gate.pending == 2
+
+
+def test_ip_buckets_are_bounded(monkeypatch):
+    monkeypatch.setattr(admission, 'IP_CACHE_SIZE', 2)
+    gate = _gate(Clock(), ip_accept_rate=1.0, ip_accept_burst=1)
+
+    for host in ('10.0.0.1', '10.0.0.2', '10.0.0.3'):
+        assert gate.accept((host, 22000))
+
+    assert list(gate._ip_buckets) == ['10.0.0.2', '10.0.0.3']
+
+
+def test_admit_rejects_duplicates_and_max_devices():
+    gate = _gate(Clock(), max_devices=2)
+
+    assert gate.admit(Model(b'\x01' * 32), b'\x02' * 32)
+    assert not gate.admit(Model(b'\x01' * 32), b'\x01' * 32)
+    assert not gate.admit(Model(b'\x01' * 32, b'\x02' * 32), b'\x03' * 32)
+
+
+def test_rejections_are_counted_by_reason():
+    gate = _gate(Clock(), max_pending=0)
+    rejected = metrics.REJECTED.value(('pending', ))
+    metrics.enable()
+
+    try:
+        assert not gate.accept(('10.0.0.1', 22000))
+
+    finally:
+        metrics.disable()
+
+    assert metrics.REJECTED.value(('pending', )) == rejected + 1
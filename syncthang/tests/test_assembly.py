@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+
+import pytest
+
+from syncthang.bep import messages
+from syncthang import assembly
+
+
+def _fileinfo(name, data):
+    fileinfo = messages.FileInfo(name, 0o644, 1000000000,
+                                 messages.Vector({1: 1}))
+    fileinfo.add_block(len(data), hashlib.sha256(data).digest())
+    return fileinfo
+
+
+def test_open_rejects_paths_outside_root(tmpdir):
+    root = tmpdir.mkdir('root')
+    outside = tmpdir.mkdir('outside')
+    os.symlink(str(outside), str(root.join('link')))
+    assembler = assembly.Assembler(str(root))
+
+    with pytest.raises(ValueError):
+        assembler.open(_fileinfo('../escape', b'data'))
+
+    with pytest.raises(ValueError):
+        assembler.open(_fileinfo('link/escape', b'data'))
+
+    assert outside.listdir() == []
+
+
+def test_failed_rename_still_calls_back(tmpdir):
+    root = tmpdir.mkdir('root')
+    assembler = assembly.Assembler(str(root))
+    results = {}
+
+    partials = []
+    for name in ('a', 'b'):
+        partial = assembler.open(_fileinfo(name, name.encode() * 10))
+        partial.write(0, name.encode() * 10)
+        partials.append(partial)
+
+    # NOTE(jkoelker) A directory in the way makes the rename fail.
+    root.mkdir('a').join('keep').write('x')
+
+    for partial in partials:
+        assembler.commit(partial, lambda fileinfo, error: results.__setitem__(
+            fileinfo.name, error))
+
+    assembler.flush()
+
+    assert isinstance(results['a'], OSError)
+    assert results['b'] is None
+    assert root.join('b').read_binary() == b'b' * 10
+    assert not os.path.exists(partials[0].temp_path)
+
+
+def test_reuse_copies_aligned_blocks(tmpdir):
+    root = tmpdir.mkdir('root')
+    old = b'aaaabbbbcccc'
+    new = b'aaaaXXXXccccdd'
+    root.join('file').write_binary(old)
+
+    fileinfo = messages.FileInfo('file', 0o644, 1000000000,
+                                 messages.Vector({1: 2}))
+    for offset in range(0, len(new), 4):
+        block = new[offset:offset + 4]
+        fileinfo.add_block(len(block), hashlib.sha256(block).digest())
+
+    assembler = assembly.Assembler(str(root))
+    partial = assembler.open(fileinfo)
+
+    assert assembler.reuse(partial) == 2
+    assert sorted(partial.missing) == [1, 3]
+    partial.abort()
+
+
+def test_open_preallocates_off_the_hub(tmpdir, monkeypatch):
+    threads = []
+    preallocate = assembly._preallocate
+
+    def _preallocate(fd, size):
+        threads.append(assembly._threading.current_thread())
+        preallocate(fd, size)
+
+    monkeypatch.setattr(assembly, '_preallocate', _preallocate)
+    partial = assembly.Assembler(str(tmpdir)).open(_fileinfo('a', b'data'))
+    partial.abort()
+
+    assert threads
+    assert threads[0] is not assembly._threading.current_thread()
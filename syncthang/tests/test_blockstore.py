@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+
+import eventlet
+from eventlet.green import socket
+import pytest
+
+from syncthang.bep import messages
+from syncthang.bep import protocol
+from syncthang import blockstore
+from syncthang import model
+from syncthang import readahead
+
+from . import test_versions
+
+
+LOCAL = b'\x01' * 32
+PEER = b'\x02' * 32
+FOLDER = b'default'
+
+
+def _fileinfo(name, data, block_size=4):
+    fileinfo = messages.FileInfo(name, 0o644, 1000000000,
+                                 messages.Vector({1: 1}))
+
+    for offset in range(0, len(data), block_size):
+        block = data[offset:offset + block_size]
+        fileinfo.add_block(len(block), hashlib.sha256(block).digest())
+
+    if not data:
+        fileinfo.add_block(0, hashlib.sha256(b'').digest())
+
+    return fileinfo
+
+
+def test_read_empty_file(tmpdir):
+    store = blockstore.BlockStore(str(tmpdir))
+    store.add_file(FOLDER, _fileinfo(b'empty', b''))
+
+    assert store.read(FOLDER, b'empty', 0, 0) == b''
+
+
+def _serve_scanned(tmpdir, store_blocks):
+    # NOTE(jkoelker) Scans a folder and fetches its blocks from another
+    #                device over a socketpair.
+    data = b'0123456789'
+    tmpdir.mkdir('folder').join('a').write_binary(data)
+    tmpdir.join('folder', 'empty').write_binary(b'')
+    store = blockstore.BlockStore(str(tmpdir.join('blocks')))
+
+    local = model.Model(b'syncthang-test', b'0.1.0', block_store=store,
+                        local_device_id=LOCAL)
+    local.add_folder(FOLDER, [PEER], str(tmpdir.join('folder')),
+                     store_blocks=store_blocks)
+    local.scan(FOLDER)
+    fileinfo = local.get_file(FOLDER, b'a')
+    sha = fileinfo.blocks.sha(0)
+
+    peer = model.Model(b'syncthang-test', b'0.1.0', local_device_id=PEER)
+    peer.add_folder(FOLDER, [LOCAL])
+
+    left, right = socket.socketpair()
+    serving = protocol.RemoteDevice(PEER, left, local, local_device_id=LOCAL)
+    fetching = protocol.RemoteDevice(LOCAL, right, peer,
+                                     local_device_id=PEER)
+    threads = [eventlet.spawn(serving.start), eventlet.spawn(fetching.start)]
+
+    try:
+        assert fetching.fetch(FOLDER, b'a', 0, len(data), sha) == data
+        assert fetching.fetch(FOLDER, b'empty', 0, 0, b'') == b''
+
+        # NOTE(jkoelker) Names outside the index are not served.
+        with pytest.raises(IOError):
+            fetching.fetch(FOLDER, b'../blocks', 0, 1, b'')
+
+    finally:
+        fetching.stop()
+        serving.stop()
+
+        for thread in threads:
+            thread.kill()
+
+    return store.has(sha)
+
+
+def test_scan_serves_blocks_from_the_store(tmpdir):
+    assert _serve_scanned(tmpdir, store_blocks=True)
+
+
+def test_scan_serves_blocks_from_the_folder(tmpdir):
+    assert not _serve_scanned(tmpdir, store_blocks=False)
+
+
+def test_changed_files_are_not_served(tmpdir):
+    tmpdir.join('a').write_binary(b'0123')
+    local = model.Model(b'syncthang-test', b'0.1.0', local_device_id=LOCAL)
+    local.add_folder(FOLDER, path=str(tmpdir))
+    local.scan(FOLDER)
+    sha = local.get_file(FOLDER, b'a').blocks.sha(0)
+
+    assert local.request(FOLDER, b'a', 0, 4, sha, 0) == b'0123'
+
+    tmpdir.join('a').write_binary(b'3210')
+
+    with pytest.raises(IOError):
+        local.request(FOLDER, b'a', 0, 4, sha, 0)
+
+
+def test_collect_closes_handles(tmpdir):
+    now = [0.0]
+    store = blockstore.BlockStore(str(tmpdir), grace=1,
+                                  clock=lambda: now[0])
+    fileinfo = _fileinfo(b'a', b'0123')
+    store.put(b'0123')
+    store.add_file(FOLDER, fileinfo)
+
+    assert store.read(FOLDER, b'a', 0, 4) == b'0123'
+    assert len(store.handles) == 1
+
+    store.remove_file(FOLDER, b'a')
+    now[0] = 2.0
+
+    assert store.collect() == 1
+    assert len(store.handles) == 0
+
+
+def test_read_blocking_from_threads(tmpdir):
+    data = b'0123456789abcdef'
+    store = blockstore.BlockStore(str(tmpdir), readahead_size=8)
+    fileinfo = _fileinfo(b'a', data)
+
+    for index in range(len(fileinfo.blocks)):
+        store.put(data[index * 4:index * 4 + 4])
+
+    store.add_file(FOLDER, fileinfo)
+    results = []
+
+    def _reader():
+        results.append(b''.join(
+            store.read_blocking(FOLDER, b'a', offset, 4)
+            for offset in range(0, len(data), 4)))
+
+    threads = [readahead._threading.Thread(target=_reader)
+               for _ in range(4)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    assert results == [data] * 4
+
+
+def test_leveldb_blockstore_keeps_bytes_folders(tmpdir, monkeypatch):
+    monkeypatch.setattr(blockstore, 'plyvel', test_versions.FakePlyvel())
+    store = blockstore.LevelDBBlockStore(str(tmpdir), 'blocks')
+    fileinfo = _fileinfo(b'a', b'0123')
+    store.put(b'0123')
+    store.add_file(FOLDER, fileinfo)
+    store.add_file(b'other', fileinfo)
+    store.remove_file(b'other', b'a')
+    store.db = blockstore.plyvel.DB('blocks')
+
+    assert store.read(FOLDER, b'a', 0, 4) == b'0123'
+    assert store._refcount(fileinfo.blocks.sha(0)) == 1
+
+    with pytest.raises(IOError):
+        store.read(b'other', b'a', 0, 4)
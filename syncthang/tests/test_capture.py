@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+import eventlet
+from eventlet.green import socket
+import pytest
+
+from syncthang.bep import capture
+from syncthang.bep import protocol
+from syncthang import model
+
+
+LOCAL = b'\x01' * 32
+PEER = b'\x02' * 32
+FOLDER = b'default'
+DATA = b'0123456789'
+
+
+def _record(tmpdir, path):
+    # NOTE(jkoelker) The peer scans a file and announces it, we fetch it
+    #                back, every frame on our side of the socketpair is
+    #                captured.
+    tmpdir.mkdir('folder').join('a').write_binary(DATA)
+
+    local = model.Model(b'syncthang-test', b'0.1.0', local_device_id=LOCAL)
+    local.add_folder(FOLDER, [PEER])
+
+    peer = model.Model(b'syncthang-test', b'0.1.0', local_device_id=PEER)
+    peer.add_folder(FOLDER, [LOCAL], str(tmpdir.join('folder')))
+    peer.scan(FOLDER)
+
+    recorder = capture.Capture(path, PEER)
+    left, right = socket.socketpair()
+    recording = protocol.RemoteDevice(PEER, left, local,
+                                      local_device_id=LOCAL,
+                                      capture=recorder)
+    remote = protocol.RemoteDevice(LOCAL, right, peer, local_device_id=PEER)
+    threads = [eventlet.spawn(recording.start), eventlet.spawn(remote.start)]
+
+    try:
+        with eventlet.Timeout(10):
+            while local.get_file(FOLDER, b'a') is None:
+                eventlet.sleep(0.01)
+
+        sha = local.get_file(FOLDER, b'a').blocks.sha(0)
+        assert recording.fetch(FOLDER, b'a', 0, len(DATA), sha) == DATA
+
+    finally:
+        remote.stop()
+        recording.stop()
+
+        for thread in threads:
+            thread.kill()
+
+        recorder.close()
+
+    return recorder.frames
+
+
+def test_replay_recorded_frames(tmpdir):
+    path = str(tmpdir.join('peer.bepcap'))
+    recorded = _record(tmpdir, path)
+
+    reader = capture.Reader(path)
+    records = list(reader)
+    reader.close()
+
+    directions = [direction for _, direction, _ in records]
+    inbound = directions.count(capture.INBOUND)
+
+    assert len(records) == recorded
+    assert inbound and directions.count(capture.OUTBOUND)
+
+    # NOTE(jkoelker) Replaying the inbound frames into a fresh model takes
+    #                the peer's index again, our answers go nowhere.
+    replayed = model.Model(b'syncthang-test', b'0.1.0',
+                           local_device_id=LOCAL)
+    replayed.add_folder(FOLDER, [PEER])
+
+    reader = capture.Reader(path)
+    sock = capture.ReplaySocket(reader)
+    device = protocol.RemoteDevice(reader.device_id, sock, replayed,
+                                   local_device_id=LOCAL)
+    replayed.devices[reader.device_id] = device
+
+    try:
+        with eventlet.Timeout(10):
+            device.start()
+
+    finally:
+        replayed.release_device(reader.device_id)
+        reader.close()
+
+    assert reader.device_id == PEER
+    assert sock.closed
+    assert sock.frames == inbound
+    assert sock.received == sum(len(data) for _, direction, data in records
+                                if direction == capture.INBOUND)
+    assert sock.sent > 0
+    assert replayed.get_file(FOLDER, b'a').blocks.total_size == len(DATA)
+
+
+def test_reader_rejects_other_files(tmpdir):
+    path = tmpdir.join('other')
+    path.write_binary(b'\x00' * 64)
+
+    with pytest.raises(ValueError):
+        capture.Reader(str(path))
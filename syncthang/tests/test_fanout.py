@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+from syncthang.bep import messages
+from syncthang import fanout
+
+
+FOLDER = b'default'
+
+
+def _file(name, version):
+    return messages.FileInfo(name, 0o644, 0, messages.Vector({1: version}),
+                             version)
+
+
+def _names(frame):
+    msg = messages.IndexUpdate.unpack(0, frame.payload)
+    return [(f.name, f.local_version) for f in msg.files]
+
+
+def _drain(subscription):
+    frames = []
+    frame = subscription.get()
+
+    while frame is not None:
+        frames.append(frame)
+        frame = subscription.get()
+
+    return frames
+
+
+def test_publish_is_shared():
+    notified = []
+    fan = fanout.Fanout()
+    first = fan.subscribe(FOLDER, lambda: notified.append(1))
+    second = fan.subscribe(FOLDER, lambda: notified.append(2))
+
+    fan.publish(FOLDER, [_file(b'a', 1)])
+
+    assert sorted(notified) == [1, 2]
+    assert first.get() is second.get()
+    assert first.version == second.version == 1
+
+
+def test_origin_is_skipped():
+    fan = fanout.Fanout()
+    origin = fan.subscribe(FOLDER, lambda: None, b'origin')
+    other = fan.subscribe(FOLDER, lambda: None, b'other')
+
+    fan.publish(FOLDER, [_file(b'a', 1)], origin=b'origin')
+
+    assert len(origin) == 0
+    assert len(other) == 1
+
+
+def test_lagging_subscription_catches_up():
+    fan = fanout.Fanout()
+    subscription = fan.subscribe(FOLDER, lambda: None, max_pending=2)
+
+    for version in range(1, 6):
+        fan.publish(FOLDER, [_file(b'a' if version % 2 else b'b', version)])
+
+    frames = _drain(subscription)
+
+    assert len(frames) == 1
+    assert _names(frames[0]) == [(b'b', 4), (b'a', 5)]
+    assert subscription.version == 5
+
+
+def test_catch_up_is_cached():
+    fan = fanout.Fanout()
+    fan.publish(FOLDER, [_file(b'a', 1)])
+    fan.publish(FOLDER, [_file(b'b', 2)])
+
+    assert fan.catch_up(FOLDER, 0) is fan.catch_up(FOLDER, 0)
+
+    fan.publish(FOLDER, [_file(b'c', 3)])
+    version, frame = fan.catch_up(FOLDER, 0)
+
+    assert version == 3
+    assert _names(frame) == [(b'a', 1), (b'b', 2), (b'c', 3)]
+
+
+def test_catch_up_backfills_past_history():
+    calls = []
+
+    def backfill(folder, version):
+        calls.append((folder, version))
+        return [_file(b'old', 1)]
+
+    fan = fanout.Fanout(backfill)
+
+    for version in range(2, fanout.HISTORY + 10):
+        fan.publish(FOLDER, [_file(b'new', version)])
+
+    version, frame = fan.catch_up(FOLDER, 0)
+
+    assert calls == [(FOLDER, 0)]
+    assert version == fanout.HISTORY + 9
+    assert _names(frame) == [(b'old', 1), (b'new', fanout.HISTORY + 9)]
+
+
+def test_catch_up_without_backfill_keeps_version():
+    fan = fanout.Fanout(lambda folder, version: None)
+
+    for version in range(2, fanout.HISTORY + 10):
+        fan.publish(FOLDER, [_file(b'new', version)])
+
+    version, frame = fan.catch_up(FOLDER, 0)
+
+    assert version == 0
+    assert _names(frame) == [(b'new', fanout.HISTORY + 9)]
+
+
+def test_subscribe_behind_starts_lagging():
+    notified = []
+    fan = fanout.Fanout()
+    fan.publish(FOLDER, [_file(b'a', 1)])
+
+    subscription = fan.subscribe(FOLDER, lambda: notified.append(1),
+                                 version=0)
+
+    assert notified == [1]
+    assert _names(subscription.get()) == [(b'a', 1)]
+    assert subscription.get() is None
+    assert subscription.version == 1
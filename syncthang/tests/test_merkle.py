@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+
+from syncthang.bep import messages
+from syncthang import merkle
+
+
+def _file(name, version=1):
+    fileinfo = messages.FileInfo(name, 0o644, 1234,
+                                 messages.Vector({1: version}))
+    fileinfo.add_block(4, hashlib.sha256(name).digest())
+    return fileinfo
+
+
+def test_update_rehashes_only_changed_paths():
+    tree = merkle.Tree([_file(b'a/x'), _file(b'a/y'), _file(b'b/z')])
+    root = tree.digest
+    other = tree.get('b')
+
+    tree.update(_file(b'a/x', 2))
+
+    assert tree.digest != root
+    assert tree.root.directories['b']._digest == other
+    assert tree.get('a/x') == merkle.file_digest(_file(b'a/x', 2))
+
+    # NOTE(jkoelker) The same digest again changes nothing.
+    digest = tree.digest
+    tree.update(_file(b'a/x', 2))
+    assert tree.root._digest == digest
+
+
+def test_digest_does_not_depend_on_order():
+    files = [_file(b'a/x'), _file(b'a/y'), _file(b'b/z')]
+
+    assert merkle.Tree(files).digest == merkle.Tree(files[::-1]).digest
+
+
+def test_remove_prunes_empty_directories():
+    tree = merkle.Tree([_file(b'a'), _file(b'b/c/d')])
+    empty = merkle.Tree([_file(b'a')]).digest
+
+    tree.remove(b'b/c/d')
+
+    assert tree.directory('b') is None
+    assert tree.digest == empty
+
+    # NOTE(jkoelker) Missing names are ignored.
+    tree.remove(b'b/c/d')
+    tree.remove(b'missing/name')
+    assert tree.digest == empty
+
+
+def test_diff_descends_into_differing_directories():
+    left = merkle.Tree([_file(b'a/x'), _file(b'a/y'), _file(b'b/z')])
+    right = merkle.Tree([_file(b'a/x'), _file(b'a/y', 2), _file(b'c')])
+
+    assert list(merkle.diff(left, left)) == []
+    assert list(merkle.diff(left, right)) == ['c', 'a/y', 'b/z']
+    assert list(merkle.diff(left, right, 'a')) == ['a/y']
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import xdrlib
+
+import pytest
+
+from syncthang.bep import messages
+
+
+def _blocks(*datas):
+    blocks = messages.BlockList()
+
+    for data in datas:
+        blocks.add(len(data), hashlib.sha256(data).digest())
+
+    return blocks
+
+
+def _roundtrip(blocks):
+    packer = xdrlib.Packer()
+    blocks.pack(packer)
+    unpacker = xdrlib.Unpacker(packer.get_buffer())
+    unpacked = messages.BlockList.unpack(unpacker)
+    unpacker.done()
+    return unpacked
+
+
+def test_block_list_roundtrip():
+    blocks = _blocks(b'a' * 10, b'b' * 10, b'c' * 3)
+    unpacked = _roundtrip(blocks)
+
+    assert unpacked == blocks
+    assert len(unpacked) == 3
+    assert list(unpacked.sizes) == [10, 10, 3]
+    assert unpacked.sha(2) == hashlib.sha256(b'c' * 3).digest()
+    assert unpacked.total_size == 23
+    assert unpacked.block_size == 10
+    assert unpacked.offset(2) == 20
+
+
+def test_block_list_empty_roundtrip():
+    unpacked = _roundtrip(messages.BlockList())
+
+    assert len(unpacked) == 0
+    assert unpacked.block_size == 0
+
+
+def test_block_list_matches_block_info_encoding():
+    # NOTE(jkoelker) The packed form has to stay byte for byte what an
+    #                array of BlockInfo packs to, that is what peers read.
+    blocks = _blocks(b'x' * 5, b'y' * 7)
+    packer = xdrlib.Packer()
+    blocks.pack(packer)
+
+    expected = xdrlib.Packer()
+    expected.pack_array(list(blocks), lambda block: block.pack(expected))
+
+    assert packer.get_buffer() == expected.get_buffer()
+
+
+def test_block_list_views():
+    blocks = _blocks(b'a', b'bb')
+
+    assert [(b.size, b.sha) for b in blocks] == [
+        (1, hashlib.sha256(b'a').digest()),
+        (2, hashlib.sha256(b'bb').digest())]
+    assert blocks[-1].size == 2
+    assert _blocks(b'a', b'bb', b'ccc')[1:] == _blocks(b'bb', b'ccc')
+
+    with pytest.raises(IndexError):
+        blocks[2]
+
+
+def test_block_list_rejects_short_digest():
+    with pytest.raises(ValueError):
+        messages.BlockList().add(1, b'short')
+
+
+def test_index_roundtrip():
+    fileinfo = messages.FileInfo(b'dir/file', 0o644, 1234,
+                                 messages.Vector({1: 2}), 7)
+    fileinfo.add_block(5, hashlib.sha256(b'hello').digest())
+
+    payload = messages.Index(b'default', [fileinfo]).pack()
+    index = messages.Index.unpack(3, payload)
+
+    assert index.msg_id == 3
+    assert index.folder == b'default'
+    assert len(index.files) == 1
+
+    unpacked = index.files[0]
+    assert unpacked.name == b'dir/file'
+    assert unpacked.modified == 1234
+    assert unpacked.version == {1: 2}
+    assert unpacked.local_version == 7
+    assert unpacked.blocks == fileinfo.blocks
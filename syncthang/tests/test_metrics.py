@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+from syncthang.bep import messages
+from syncthang import metrics
+
+
+DEVICE = b'\x01' * 32
+
+
+def _roundtrip(observer, msg):
+    data = messages.encode(messages.Frame.from_message(msg), 1, None,
+                           observer)
+    header = messages.unpack_header(data)
+    return messages.decode(*(header[:4] + (data[messages.HEADER_SIZE:],
+                                           observer)))
+
+
+def test_observer_counts_frames_per_device():
+    observer = metrics.Observer(DEVICE)
+    key = (observer.device, 'in', 'request')
+    frames = metrics.FRAMES.value(key)
+    size = metrics.BYTES.value(key)
+    msg = messages.Request(b'default', b'name', 0, 10, b'')
+    wire_size = messages.HEADER_SIZE + len(msg.pack())
+
+    for _ in range(3):
+        assert _roundtrip(observer, msg).name == b'name'
+
+    assert observer.device == '01' * 32
+    assert metrics.FRAMES.value(key) == frames + 3
+    assert metrics.BYTES.value(key) == size + 3 * wire_size
+    assert metrics.FRAMES.value((observer.device, 'out', 'request')) >= 3
+
+
+def test_observer_handled_updates_histogram():
+    observer = metrics.Observer(DEVICE)
+    labels = ('ping', )
+    count = metrics.HANDLER_TIME.count(labels)
+
+    observer.handled(messages.PING, 0.002)
+    observer.handled(messages.PING, 0.2)
+
+    assert metrics.HANDLER_TIME.count(labels) == count + 2
+
+
+def test_observer_only_while_enabled():
+    metrics.disable()
+    assert metrics.observer(DEVICE) is None
+
+    metrics.enable()
+
+    try:
+        assert isinstance(metrics.observer(DEVICE), metrics.Observer)
+
+    finally:
+        metrics.disable()
+
+
+def test_observer_close_folds_device_series():
+    device = b'\x03' * 32
+    first = metrics.Observer(device)
+    second = metrics.Observer(device)
+    key = (first.device, 'in', 'ping')
+    total = ('', 'in', 'ping')
+    frames = metrics.FRAMES.value(total)
+
+    first.frame('in', messages.PING, 8)
+    second.frame('in', messages.PING, 8)
+    second.paused(0.5)
+    first.close()
+    first.close()
+
+    # NOTE(jkoelker) The device still has a connection open.
+    assert metrics.FRAMES.value(key) == 2
+
+    second.close()
+    second.frame('in', messages.PING, 8)
+
+    assert key not in metrics.FRAMES._values
+    assert key not in metrics.BYTES._values
+    assert (first.device, ) not in metrics.READ_PAUSED._values
+    assert metrics.FRAMES.value(total) == frames + 2
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+
+from syncthang.bep import messages
+from syncthang import model
+from syncthang import snapshot
+from syncthang import versions
+
+
+DEVICE_A = b'\xaa' * 32
+DEVICE_B = b'\xbb' * 32
+
+
+def _model():
+    return model.Model(b'syncthang-test', b'0.1.0')
+
+
+def _folders(model_, device_id):
+    payload = model_.cluster_config(device_id).pack()
+    msg = messages.ClusterConfig.unpack(0, payload)
+    return dict((folder.ident, [d.ident for d in folder.devices])
+                for folder in msg.folders)
+
+
+def test_configured_folder_in_cluster_config():
+    model_ = _model()
+    model_.add_folder(b'default', [DEVICE_A])
+
+    assert model_.device_folders(DEVICE_A) == [b'default']
+    assert _folders(model_, DEVICE_A) == {b'default': [DEVICE_A]}
+    assert _folders(model_, DEVICE_B) == {}
+
+
+def test_announced_folders_are_recorded():
+    model_ = _model()
+    model_.add_folder(b'default', [DEVICE_A])
+    assert _folders(model_, DEVICE_A) == {b'default': [DEVICE_A]}
+
+    model_.update_cluster_config(DEVICE_B, 'b', '0.1', [
+        messages.Folder(b'default'), messages.Folder(b'photos')], {})
+
+    assert model_.device_folders(DEVICE_B) == [b'default', b'photos']
+    assert _folders(model_, DEVICE_B) == {b'default': [DEVICE_A, DEVICE_B],
+                                          b'photos': [DEVICE_B]}
+
+    # NOTE(jkoelker) The cached payload of the other member is dropped.
+    assert _folders(model_, DEVICE_A) == {b'default': [DEVICE_A, DEVICE_B]}
+
+
+def test_unannounced_folders_are_removed():
+    model_ = _model()
+    model_.add_folder(b'default', [DEVICE_A])
+    model_.update_cluster_config(DEVICE_A, 'a', '0.1', [
+        messages.Folder(b'photos')], {})
+    model_.update_cluster_config(DEVICE_B, 'b', '0.1', [
+        messages.Folder(b'default'), messages.Folder(b'photos')], {})
+    model_.update_cluster_config(DEVICE_B, 'b', '0.1', [
+        messages.Folder(b'photos')], {})
+
+    # NOTE(jkoelker) Configured membership stays, announced membership
+    #                follows the announcements.
+    assert model_.device_folders(DEVICE_A) == [b'default', b'photos']
+    assert model_.device_folders(DEVICE_B) == [b'photos']
+
+
+def _file(name, version):
+    return messages.FileInfo(name, 0o644, 0, messages.Vector({1: version}))
+
+
+def _index(model_, folder, version):
+    return [(f.name, f.local_version)
+            for f in model_.folder_index(folder, version)]
+
+
+def test_folder_index():
+    model_ = _model()
+    model_.update_index(DEVICE_A, b'default', [_file(b'a', 1),
+                                               _file(b'b', 1)])
+    model_.update_index(DEVICE_A, b'default', [_file(b'a', 2)])
+
+    assert _index(model_, b'default', 0) == [(b'b', 2), (b'a', 3)]
+    assert _index(model_, b'default', 2) == [(b'a', 3)]
+    assert _index(model_, b'photos', 0) == []
+
+
+def test_restart_resumes_from_index_store(tmpdir):
+    store = snapshot.IndexStore(str(tmpdir))
+    files = [_file(b'a', 1), _file(b'b', 1)]
+    files[0].local_version, files[1].local_version = 1, 2
+    store.update(b'default', files)
+    store.add_member(b'default', DEVICE_B)
+    store.close()
+
+    store = snapshot.IndexStore(str(tmpdir))
+    model_ = model.Model(b'syncthang-test', b'0.1.0', index_store=store)
+
+    assert model_.device_folders(DEVICE_B) == [b'default']
+    assert _index(model_, b'default', 1) == [(b'b', 2)]
+
+    # NOTE(jkoelker) A device that is behind is caught up through the
+    #                backfill from the index.
+    subscription = model_.fanout.subscribe(b'default', lambda: None,
+                                           DEVICE_B, version=1)
+
+    assert subscription.lagging
+
+    # NOTE(jkoelker) Folders read back from the snapshot and the journal
+    #                must sort together.
+    store.update(b'other', [_file(b'c', 1)])
+    store.compact()
+    assert _index(model_, b'default', 0) == [(b'a', 1), (b'b', 2)]
+    store.close()
+
+
+def test_local_versions_carry_on_above_sent():
+    version_store = versions.Versions()
+    version_store.set_sent(DEVICE_B, b'default', 7)
+    model_ = model.Model(b'syncthang-test', b'0.1.0', version_store)
+
+    assert model_.resume_version(DEVICE_B, b'default', 7) == 7
+
+    model_.update_index(DEVICE_A, b'default', [_file(b'a', 1)])
+
+    assert _index(model_, b'default', 7) == [(b'a', 8)]
+
+
+def _scan_model(tmpdir):
+    model_ = model.Model(b'syncthang-test', b'0.1.0',
+                         local_device_id=DEVICE_A)
+    model_.add_folder(b'default', [DEVICE_B], str(tmpdir))
+    return model_
+
+
+def _announced(files):
+    return sorted((f.name, f.deleted, dict(f.version)) for f in files)
+
+
+def test_scan_announces_local_changes(tmpdir):
+    short = messages.Device(DEVICE_A).short
+    tmpdir.join('a').write_binary(b'a' * 10)
+    tmpdir.ensure_dir('dir').join('b').write_binary(b'b' * 10)
+    tmpdir.join('.syncthing.c.tmp').write_binary(b'partial')
+    model_ = _scan_model(tmpdir)
+
+    assert _announced(model_.scan(b'default')) == [
+        (b'a', False, {short: 1}), (b'dir/b', False, {short: 1})]
+    assert model_.scan(b'default') == []
+    assert _index(model_, b'default', 0) == [(b'a', 1), (b'dir/b', 2)]
+
+    tmpdir.join('a').write_binary(b'A' * 11)
+    tmpdir.join('dir', 'b').remove()
+
+    assert _announced(model_.scan(b'default')) == [
+        (b'a', False, {short: 2}), (b'dir/b', True, {short: 2})]
+    assert model_.get_file(b'default', b'a').blocks.total_size == 11
+    assert model_.scan(b'default') == []
+
+
+def test_scan_leaves_files_matching_the_index(tmpdir):
+    short = messages.Device(DEVICE_A).short
+    tmpdir.join('a').write_binary(b'a' * 10)
+    tmpdir.join('a').setmtime(1000000000)
+    model_ = _scan_model(tmpdir)
+
+    remote = messages.FileInfo(b'a', 0o644, 1000000000,
+                               messages.Vector({1: 1}))
+    remote.add_block(10, hashlib.sha256(b'a' * 10).digest())
+    model_.update_index(DEVICE_B, b'default', [remote])
+
+    assert model_.scan(b'default') == []
+
+    # NOTE(jkoelker) Same content, only the mtime moved.
+    tmpdir.join('a').setmtime(1500000000)
+    assert model_.scan(b'default') == []
+
+    tmpdir.join('a').write_binary(b'b' * 10)
+    tmpdir.join('a').setmtime(2000000000)
+
+    assert _announced(model_.scan(b'default', [b'a'])) == [
+        (b'a', False, {1: 1, short: 1})]
+
+
+def test_device_db_only_when_given():
+    class Device(object):
+        ident = None
+        introducer = False
+        saved = []
+
+        @classmethod
+        def get(cls, query):
+            return cls()
+
+        def save(self):
+            self.saved.append((self.name, self.version))
+
+    class DeviceDB(object):
+        pass
+
+    DeviceDB.Device = Device
+
+    _model().update_cluster_config(DEVICE_B, 'b', '0.1', [], None)
+    assert Device.saved == []
+
+    model_ = model.Model(b'syncthang-test', b'0.1.0', device_db=DeviceDB)
+    model_.update_cluster_config(DEVICE_B, 'b', '0.1', [], None)
+    assert Device.saved == [('b', '0.1')]
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from syncthang.bep import protocol
+
+
+class Device(protocol.Device):
+    def __init__(self, *args, **kwargs):
+        super(Device, self).__init__(*args, **kwargs)
+        self.sent = []
+        self.stopped = False
+
+    def send(self, msg):
+        self.sent.append(msg)
+
+    def send_frame(self, frame):
+        self.sent.append(frame)
+
+    def stop(self):
+        self.stopped = True
+
+    def notify_update(self):
+        pass
+
+
+def test_device_requires_transport_methods():
+    class Partial(protocol.Device):
+        def send(self, msg):
+            pass
+
+        def send_frame(self, frame):
+            pass
+
+        def stop(self):
+            pass
+
+    with pytest.raises(TypeError):
+        Partial(b'\0' * 32, None)
+
+    Device(b'\0' * 32, None)
+
+
+def _flow(events, observer=None):
+    return protocol.FlowControl(lambda: events.append('pause'),
+                                lambda: events.append('resume'),
+                                high=10, low=4, observer=observer)
+
+
+def test_flow_control_pauses_at_high_watermark():
+    events = []
+    flow = _flow(events)
+
+    flow.add(6)
+    assert events == [] and not flow.paused
+
+    flow.add(4)
+    assert events == ['pause'] and flow.paused
+
+    # NOTE(jkoelker) Only the first crossing pauses.
+    flow.add(5)
+    assert events == ['pause']
+
+
+def test_flow_control_resumes_at_low_watermark():
+    paused = []
+
+    class Observer(object):
+        def paused(self, seconds):
+            paused.append(seconds)
+
+    events = []
+    flow = _flow(events, Observer())
+
+    flow.add(12)
+    flow.done(7)
+    assert events == ['pause'] and flow.paused
+
+    flow.done(1)
+    assert events == ['pause', 'resume'] and not flow.paused
+    assert len(paused) == 1 and paused[0] >= 0
+
+    flow.done(4)
+    assert events == ['pause', 'resume']
+    assert flow.size == 0
+
+
+def test_block_size_scales_only_when_asked():
+    size = 10 * 1024 ** 3
+
+    assert protocol.block_size(size) == protocol.BLOCK_SIZE
+    assert protocol.block_size(size, True) == 8 * 1024 * 1024
+    assert protocol.block_size(1024, True) == protocol.BLOCK_SIZE
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+
+import eventlet
+
+from syncthang.bep import messages
+from syncthang import blockstore
+from syncthang import model
+
+
+DEVICE = b'\xaa' * 32
+FOLDER = b'default'
+
+
+class Device(object):
+    def __init__(self, data):
+        self.name = 'peer'
+        self.data = data
+        self.fetched = []
+
+    def fetch(self, folder, name, offset, size, sha=None):
+        self.fetched.append((name, offset, size))
+        eventlet.sleep(0)
+        return self.data[name][offset:offset + size]
+
+
+def _fileinfo(name, data, block_size=4, version=None, modified=1000000000):
+    fileinfo = messages.FileInfo(name, 0o644, modified,
+                                 messages.Vector(version or {1: 1}))
+
+    for offset in range(0, len(data), block_size):
+        block = data[offset:offset + block_size]
+        fileinfo.add_block(len(block), hashlib.sha256(block).digest())
+
+    return fileinfo
+
+
+def _wait(model_):
+    while model_.puller._pulling:
+        eventlet.sleep(0.01)
+
+
+def test_index_update_pulls_files(tmpdir):
+    data = {b'a': b'0123456789', b'dir/b': b'abcdefgh'}
+    device = Device(data)
+    model_ = model.Model(b'syncthang-test', b'0.1.0')
+    model_.add_folder(FOLDER, [DEVICE], str(tmpdir))
+    model_.devices[DEVICE] = device
+
+    model_.update_index(DEVICE, FOLDER, [_fileinfo(name, value)
+                                         for name, value in data.items()])
+    _wait(model_)
+
+    assert tmpdir.join('a').read_binary() == data[b'a']
+    assert tmpdir.join('dir', 'b').read_binary() == data[b'dir/b']
+    assert sorted(device.fetched) == [
+        (b'a', 0, 4), (b'a', 4, 4), (b'a', 8, 2), (b'dir/b', 0, 4),
+        (b'dir/b', 4, 4)]
+
+    # NOTE(jkoelker) Files already in place are not pulled again.
+    del device.fetched[:]
+    model_.update_index(DEVICE, FOLDER, [_fileinfo(b'a', data[b'a'])])
+    _wait(model_)
+
+    assert device.fetched == []
+
+
+def test_folders_without_path_are_not_pulled(tmpdir):
+    device = Device({b'a': b'0123'})
+    model_ = model.Model(b'syncthang-test', b'0.1.0')
+    model_.add_folder(FOLDER, [DEVICE])
+    model_.devices[DEVICE] = device
+
+    model_.update_index(DEVICE, FOLDER, [_fileinfo(b'a', b'0123')])
+    _wait(model_)
+
+    assert device.fetched == []
+
+
+def test_pulled_blocks_are_stored_and_reused(tmpdir):
+    data = {b'a': b'01234567', b'b': b'01234567'}
+    device = Device(data)
+    store = blockstore.BlockStore(str(tmpdir.join('blocks')))
+    model_ = model.Model(b'syncthang-test', b'0.1.0', block_store=store)
+    model_.add_folder(FOLDER, [DEVICE], str(tmpdir.join('folder')),
+                      store_blocks=True)
+    model_.devices[DEVICE] = device
+
+    fileinfo = _fileinfo(b'a', data[b'a'])
+    model_.update_index(DEVICE, FOLDER, [fileinfo])
+    _wait(model_)
+
+    assert store.has(fileinfo.blocks.sha(0))
+    assert store.has(fileinfo.blocks.sha(1))
+
+    # NOTE(jkoelker) Same blocks, another file, nothing left to fetch.
+    del device.fetched[:]
+    model_.update_index(DEVICE, FOLDER, [_fileinfo(b'b', data[b'b'])])
+    _wait(model_)
+
+    assert tmpdir.join('folder', 'b').read_binary() == data[b'b']
+    assert device.fetched == []
+
+
+def test_stale_versions_are_not_pulled(tmpdir):
+    data = {b'a': b'new content'}
+    device = Device(data)
+    model_ = model.Model(b'syncthang-test', b'0.1.0')
+    model_.add_folder(FOLDER, [DEVICE], str(tmpdir))
+    model_.devices[DEVICE] = device
+
+    model_.update_index(DEVICE, FOLDER, [
+        _fileinfo(b'a', data[b'a'], version={1: 2})])
+    _wait(model_)
+
+    # NOTE(jkoelker) The device reconnects with its old index.
+    data[b'a'] = b'old content'
+    model_.update_index(DEVICE, FOLDER, [
+        _fileinfo(b'a', data[b'a'], version={1: 1})])
+    _wait(model_)
+
+    assert model_.get_file(FOLDER, b'a').version == {1: 2}
+    assert tmpdir.join('a').read_binary() == b'new content'
+
+
+def test_concurrent_versions_keep_a_conflict_copy(tmpdir):
+    data = {b'a': b'theirs'}
+    device = Device(data)
+    model_ = model.Model(b'syncthang-test', b'0.1.0')
+    model_.add_folder(FOLDER, [DEVICE], str(tmpdir))
+    model_.devices[DEVICE] = device
+
+    tmpdir.join('a').write_binary(b'ours')
+    model_.apply_index(None, FOLDER, [
+        _fileinfo(b'a', b'ours', version={2: 1})], 0)
+
+    # NOTE(jkoelker) Concurrent but modified earlier, ours stays.
+    model_.update_index(DEVICE, FOLDER, [
+        _fileinfo(b'a', data[b'a'], version={1: 1}, modified=1)])
+    _wait(model_)
+
+    assert model_.get_file(FOLDER, b'a').version == {2: 1}
+    assert tmpdir.join('a').read_binary() == b'ours'
+
+    model_.update_index(DEVICE, FOLDER, [
+        _fileinfo(b'a', data[b'a'], version={1: 1},
+                  modified=2000000000)])
+    _wait(model_)
+
+    conflicts = [path for path in tmpdir.listdir()
+                 if '.sync-conflict-' in path.basename]
+
+    assert model_.get_file(FOLDER, b'a').version == {1: 1}
+    assert tmpdir.join('a').read_binary() == b'theirs'
+    assert [path.read_binary() for path in conflicts] == [b'ours']
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+
+from syncthang.bep import messages
+from syncthang import readahead
+
+
+def _blocks(count, size=4):
+    blocks = messages.BlockList()
+
+    for index in range(count):
+        data = (b'%04d' % index)[:size]
+        blocks.add(len(data), hashlib.sha256(data).digest())
+
+    return blocks
+
+
+def _load(blocks, indices):
+    return [b'%04d' % index for index in indices]
+
+
+def test_sequential_reads_are_read_ahead():
+    cache = readahead.Readahead(size=16)
+    blocks = _blocks(8)
+
+    for index in range(8):
+        assert cache.read('a', blocks, index, _load) == b'%04d' % index
+
+    assert cache.hits > 0
+    assert cache.hits + cache.misses == 8
+
+
+def test_reads_from_threads():
+    cache = readahead.Readahead(size=16)
+    blocks = _blocks(64)
+    errors = []
+
+    def _reader(key):
+        try:
+            for index in range(64):
+                assert cache.read(key, blocks, index, _load) == (
+                    b'%04d' % index)
+
+        except Exception as e:
+            errors.append(e)
+
+    threads = [readahead._threading.Thread(target=_reader, args=(i % 2, ))
+               for i in range(4)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert cache.hits + cache.misses == 4 * 64
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+
+import eventlet
+
+from syncthang import scanner
+
+
+def test_changes_hash_before_rescans(tmpdir):
+    paths = []
+
+    for index in range(5):
+        path = tmpdir.join('%s' % index)
+        path.write_binary(b'%d' % index * 100)
+        paths.append(str(path))
+
+    dev = os.stat(str(tmpdir)).st_dev
+    scheduler = scanner.Scheduler(concurrency={dev: 1})
+    order = []
+
+    def _submit(path, priority):
+        done = scheduler.submit(path, priority, stat=os.stat(path))
+        eventlet.spawn(lambda: order.append((path, done.wait())))
+
+    # NOTE(jkoelker) Nothing runs until the test yields, so the change is
+    #                queued with the rescans and still goes first.
+    for path in paths[:4]:
+        _submit(path, scanner.RESCAN)
+
+    _submit(paths[4], scanner.CHANGE)
+
+    while len(order) < len(paths):
+        eventlet.sleep(0.01)
+
+    assert [path for path, _ in order] == paths[4:] + paths[:4]
+    assert order[0][1].sha(0) == hashlib.sha256(b'4' * 100).digest()
+
+
+def test_scan_uses_given_stats(tmpdir):
+    path = tmpdir.join('a')
+    path.write_binary(b'a' * 10)
+    scheduler = scanner.Scheduler()
+
+    results = list(scheduler.scan([str(path)],
+                                  stats={str(path): os.stat(str(path))}))
+
+    assert [(p, b.total_size) for p, b in results] == [(str(path), 10)]
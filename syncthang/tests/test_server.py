@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+
+from OpenSSL import crypto
+
+from syncthang import server
+
+
+def test_cert_to_device_id():
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 1024)
+
+    cert = crypto.X509()
+    cert.get_subject().CN = 'syncthing'
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(60)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(key, 'sha256')
+
+    der = crypto.dump_certificate(crypto.FILETYPE_ASN1, cert)
+    assert server.cert_to_device_id(cert) == hashlib.sha256(der).digest()
+
+
+def test_captures_do_not_collide(tmpdir):
+    device_id = b'\x01' * 32
+    captures = [server._capture(str(tmpdir), device_id) for _ in range(3)]
+
+    for recorder in captures:
+        recorder.close()
+
+    assert len(set(recorder.path for recorder in captures)) == 3
+    assert len(tmpdir.listdir()) == 3
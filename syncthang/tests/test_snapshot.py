@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+
+from syncthang.bep import messages
+from syncthang import snapshot
+
+
+FOLDER = b'default'
+DEVICE = b'\xaa' * 32
+
+
+def _file(name, local_version):
+    fileinfo = messages.FileInfo(name, 0o644, 1234,
+                                 messages.Vector({1: local_version}),
+                                 local_version)
+    fileinfo.add_block(10, hashlib.sha256(name).digest())
+    fileinfo.add_block(3, hashlib.sha256(name + b'2').digest())
+    return fileinfo
+
+
+def _names(store):
+    return [(f.name, f.local_version) for f in store.fileinfos(FOLDER)]
+
+
+def test_journal_replay(tmpdir):
+    path = str(tmpdir)
+    store = snapshot.IndexStore(path)
+    store.update(FOLDER, [_file(b'b', 1), _file(b'a', 2)])
+    store.update(FOLDER, [_file(b'b', 3)])
+    store.add_member(FOLDER, DEVICE)
+    store.close()
+
+    store = snapshot.IndexStore(path)
+
+    assert _names(store) == [(b'a', 2), (b'b', 3)]
+    assert store.local_versions[FOLDER] == 3
+    assert store.members[FOLDER] == [DEVICE]
+    assert store.get(FOLDER, b'b').version == {1: 3}
+    assert store.get(FOLDER, b'b').blocks == _file(b'b', 3).blocks
+    store.close()
+
+
+def test_journal_replay_truncates_torn_entry(tmpdir):
+    path = str(tmpdir)
+    store = snapshot.IndexStore(path)
+    store.update(FOLDER, [_file(b'a', 1)])
+    journal = store._journal_path(store.sequence)
+    size = store.journal_size
+    store.update(FOLDER, [_file(b'b', 2)])
+    store.close()
+
+    with open(journal, 'r+b') as f:
+        f.truncate(os.path.getsize(journal) - 3)
+
+    store = snapshot.IndexStore(path)
+
+    assert _names(store) == [(b'a', 1)]
+    assert os.path.getsize(journal) == size
+    store.close()
+
+
+def test_compact_then_replay(tmpdir):
+    path = str(tmpdir)
+    store = snapshot.IndexStore(path)
+    store.update(FOLDER, [_file(b'a', 1), _file(b'c', 2)])
+    assert store.compact()
+    store.update(FOLDER, [_file(b'b', 3)])
+    store.close()
+
+    store = snapshot.IndexStore(path)
+
+    assert _names(store) == [(b'a', 1), (b'b', 3), (b'c', 2)]
+    assert store.local_versions[FOLDER] == 3
+    assert store.get(FOLDER, b'c').blocks == _file(b'c', 2).blocks
+    store.close()
+
+
+def test_changed_since_version(tmpdir):
+    store = snapshot.IndexStore(str(tmpdir))
+    store.update(FOLDER, [_file(b'a', 1), _file(b'b', 2), _file(b'c', 3)])
+    store.compact()
+    store.update(FOLDER, [_file(b'a', 4)])
+
+    changed = sorted((f.name, f.local_version)
+                     for f in store.changed(FOLDER, 2))
+
+    assert changed == [(b'a', 4), (b'c', 3)]
+    assert list(store.changed(FOLDER, 4)) == []
+    assert list(store.changed('other', 0)) == []
+    store.close()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+from syncthang import versions
+
+
+DEVICE = b'\xaa' * 32
+
+
+class FakePlyvel(object):
+    # NOTE(jkoelker) A dict per path stands in for LevelDB, kept across
+    #                opens like the files would be.
+    def __init__(self):
+        self.dbs = {}
+
+    def DB(self, path, create_if_missing=False):
+        return FakeDB(self.dbs.setdefault(path, {}))
+
+
+class FakeDB(object):
+    def __init__(self, data):
+        self.data = data
+
+    def __iter__(self):
+        return iter(sorted(self.data.items()))
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def put(self, key, value):
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def iterator(self, prefix=b''):
+        return iter([(key, value) for key, value in self
+                     if key.startswith(prefix)])
+
+    def close(self):
+        pass
+
+
+def test_leveldb_versions_keep_bytes_folders(monkeypatch):
+    monkeypatch.setattr(versions, 'plyvel', FakePlyvel())
+    store = versions.LevelDBVersions('versions')
+    store.set_sent(DEVICE, b'default', 3)
+    store.set_received(DEVICE, b'default', 5)
+    store.set_sent(DEVICE, b'other', 1)
+    store.forget(DEVICE, b'other')
+    store.close()
+
+    store = versions.LevelDBVersions('versions')
+
+    assert store.get(DEVICE, b'default') == (3, 5)
+    assert store.get(DEVICE, b'other') == (0, 0)
+    assert store.sent_versions() == {b'default': 3}
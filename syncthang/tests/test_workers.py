@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+
+import eventlet
+from eventlet.green import socket
+
+from syncthang.bep import messages
+from syncthang import model
+from syncthang import versions
+from syncthang import workers
+
+
+DEVICE = b'\xaa' * 32
+FOLDER = b'default'
+
+
+def _file(name):
+    fileinfo = messages.FileInfo(name, 0o644, 1234, messages.Vector({1: 1}))
+    fileinfo.add_block(4, hashlib.sha256(name).digest())
+    return fileinfo
+
+
+def test_versions_roundtrip():
+    versions_ = {b'a': 1, b'b': 2 ** 40}
+    assert workers.unpack_versions(workers.pack_versions(versions_)) == (
+        versions_)
+
+
+def test_hub_carries_on_from_restored_versions():
+    restored = versions.Versions()
+    restored.set_sent(DEVICE, FOLDER, 9)
+    models = [model.Model(b'syncthang-test', b'0.1.0', restored),
+              model.Model(b'syncthang-test', b'0.1.0')]
+    channels = []
+    coordinators = []
+
+    for model_ in models:
+        parent, child = socket.socketpair()
+        channels.append(parent)
+        coordinators.append(workers.Coordinator(model_, child))
+
+    hub = eventlet.spawn(workers.Hub(channels).run)
+
+    try:
+        for coordinator in coordinators:
+            coordinator.start()
+
+        models[1].update_index(DEVICE, FOLDER, [_file(b'a')])
+
+        with eventlet.Timeout(5):
+            while not all(model_.get_file(FOLDER, b'a')
+                          for model_ in models):
+                eventlet.sleep(0.01)
+
+        assert [model_.get_file(FOLDER, b'a').local_version
+                for model_ in models] == [10, 10]
+
+    finally:
+        for coordinator in coordinators:
+            coordinator.stop()
+
+        hub.kill()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import struct
+
+import six
+
+try:
+    import plyvel
+except ImportError:
+    plyvel = None
+
+
+LOG = logging.getLogger(__name__)
+
+_VERSIONS = struct.Struct('!QQ')
+DEVICE_ID_SIZE = 32
+
+
+class Versions(object):
+    # NOTE(jkoelker) Per (device, folder), the highest local version of our
+    #                index we have sent the device and the highest local
+    #                version of its index we have received from it.
+    def __init__(self):
+        self._versions = {}
+
+    def get(self, device_id, folder):
+        return self._versions.get((device_id, folder), (0, 0))
+
+    def sent(self, device_id, folder):
+        return self.get(device_id, folder)[0]
+
+    def received(self, device_id, folder):
+        return self.get(device_id, folder)[1]
+
+    def set_sent(self, device_id, folder, version):
+        sent, received = self.get(device_id, folder)
+
+        if version != sent:
+            self._set(device_id, folder, version, received)
+
+    def set_received(self, device_id, folder, version):
+        sent, received = self.get(device_id, folder)
+
+        if version > received:
+            self._set(device_id, folder, sent, version)
+
+    def forget(self, device_id, folder):
+        self._versions.pop((device_id, folder), None)
+
+    def sent_versions(self):
+        # NOTE(jkoelker) Per folder, the highest version sent to any device.
+        #                Our local versions must not restart below it.
+        folders = {}
+
+        for (_, folder), (sent, _) in self._versions.items():
+            folders[folder] = max(folders.get(folder, 0), sent)
+
+        return folders
+
+    def _set(self, device_id, folder, sent, received):
+        self._versions[(device_id, folder)] = (sent, received)
+
+    def close(self):
+        pass
+
+
+def _key(device_id, folder):
+    # NOTE(jkoelker) Folder ids are bytes, as in BEP.
+    if isinstance(folder, six.text_type):
+        folder = folder.encode('utf-8')
+
+    return device_id + folder
+
+
+class LevelDBVersions(Versions):
+    # NOTE(jkoelker) LevelDB allows one process per database, so workers
+    #                need one each. A device that reconnects to another
+    #                worker gets a full index, which is slower but correct.
+    def __init__(self, path):
+        if plyvel is None:
+            raise RuntimeError('plyvel is required to persist versions')
+
+        super(LevelDBVersions, self).__init__()
+        self.db = plyvel.DB(path, create_if_missing=True)
+
+        for key, value in self.db:
+            device_id = key[:DEVICE_ID_SIZE]
+            folder = key[DEVICE_ID_SIZE:]
+            self._versions[(device_id, folder)] = _VERSIONS.unpack(value)
+
+    def _set(self, device_id, folder, sent, received):
+        super(LevelDBVersions, self)._set(device_id, folder, sent, received)
+        self.db.put(_key(device_id, folder), _VERSIONS.pack(sent, received))
+
+    def forget(self, device_id, folder):
+        super(LevelDBVersions, self).forget(device_id, folder)
+        self.db.delete(_key(device_id, folder))
+
+    def close(self):
+        self.db.close()
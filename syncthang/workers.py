@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import struct
+import xdrlib
+
+import eventlet
+from eventlet import event
+from eventlet import greenio
+from eventlet import semaphore
+
+from .bep import messages
+from . import profiler
+from . import server
+
+
+LOG = logging.getLogger(__name__)
+
+CLAIM = 0
+RELEASE = 1
+GRANT = 2
+DENY = 3
+INDEX = 4
+VERSIONS = 5
+
+_IPC_HEADER = struct.Struct('!BQI')
+_ORIGIN = struct.Struct('!H')
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+
+    while size > 0:
+        data = sock.recv(size)
+
+        if not data:
+            raise EOFError()
+
+        chunks.append(data)
+        size = size - len(data)
+
+    return b''.join(chunks)
+
+
+def recv(sock):
+    kind, version, length = _IPC_HEADER.unpack(
+        _recv_exactly(sock, _IPC_HEADER.size))
+    return kind, version, _recv_exactly(sock, length)
+
+
+def send(sock, kind, payload=b'', version=0):
+    sock.sendall(_IPC_HEADER.pack(kind, version, len(payload)) + payload)
+
+
+def pack_index(origin, folder, files):
+    if origin is None:
+        origin = b''
+
+    body = messages.IndexUpdate(folder, files).pack()
+    return _ORIGIN.pack(len(origin)) + origin + body
+
+
+def unpack_index(payload):
+    (length, ) = _ORIGIN.unpack_from(payload)
+    start = _ORIGIN.size
+    origin = payload[start:start + length] or None
+    return origin, messages.IndexUpdate.unpack(None, payload[start + length:])
+
+
+def pack_versions(versions):
+    packer = xdrlib.Packer()
+    packer.pack_array(sorted(versions.items()),
+                      lambda item: (packer.pack_string(item[0]),
+                                    packer.pack_uhyper(item[1])))
+    return packer.get_buffer()
+
+
+def unpack_versions(payload):
+    unpacker = xdrlib.Unpacker(payload)
+    return dict(unpacker.unpack_array(lambda: (unpacker.unpack_string(),
+                                               unpacker.unpack_uhyper())))
+
+
+def _index_header(payload):
+    (length, ) = _ORIGIN.unpack_from(payload)
+    unpacker = xdrlib.Unpacker(payload[_ORIGIN.size + length:])
+    folder = unpacker.unpack_string()
+    count = unpacker.unpack_uint()
+    return folder, count
+
+
+class Hub(object):
+    # NOTE(jkoelker) Runs in the supervising process. It owns the device
+    #                registry, so each device is connected to at most one
+    #                worker, and sequences local versions for every folder
+    #                before relaying index updates to all workers. Numbering
+    #                carries on from the highest version any worker restored,
+    #                so nothing is sequenced until every worker reported.
+    def __init__(self, channels):
+        self.channels = channels
+        self.owners = {}
+        self.versions = collections.defaultdict(int)
+        self._locks = [semaphore.Semaphore() for _ in channels]
+
+    def _send(self, shard, kind, payload=b'', version=0):
+        try:
+            with self._locks[shard]:
+                send(self.channels[shard], kind, payload, version)
+
+        except socket.error:
+            LOG.exception('Could not send to worker %s', shard)
+
+    def _restore(self, shard):
+        try:
+            kind, _, payload = recv(self.channels[shard])
+
+        except (EOFError, socket.error):
+            LOG.info('Worker %s went away before reporting', shard)
+            return
+
+        if kind != VERSIONS:
+            LOG.error('Worker %s did not report its versions first', shard)
+            return
+
+        for folder, version in unpack_versions(payload).items():
+            if version > self.versions[folder]:
+                self.versions[folder] = version
+
+    def run(self):
+        restoring = [eventlet.spawn(self._restore, shard)
+                     for shard in range(len(self.channels))]
+
+        for thread in restoring:
+            thread.wait()
+
+        threads = [eventlet.spawn(self._serve, shard)
+                   for shard in range(len(self.channels))]
+
+        for thread in threads:
+            thread.wait()
+
+    def _serve(self, shard):
+        channel = self.channels[shard]
+
+        while True:
+            try:
+                kind, _, payload = recv(channel)
+
+            except (EOFError, socket.error):
+                LOG.info('Worker %s went away', shard)
+                break
+
+            if kind == CLAIM:
+                owner = self.owners.setdefault(payload, shard)
+                self._send(shard, GRANT if owner == shard else DENY, payload)
+
+            elif kind == RELEASE:
+                if self.owners.get(payload) == shard:
+                    del self.owners[payload]
+
+            elif kind == INDEX:
+                folder, count = _index_header(payload)
+                base = self.versions[folder]
+                self.versions[folder] = base + count
+
+                for other in range(len(self.channels)):
+                    self._send(other, INDEX, payload, base)
+
+        for device_id, owner in list(self.owners.items()):
+            if owner == shard:
+                del self.owners[device_id]
+
+
+class Coordinator(object):
+    def __init__(self, model, channel):
+        self.model = model
+        self.channel = channel
+
+        self._claims = {}
+        self._lock = semaphore.Semaphore()
+        self._reader = None
+
+    def _send(self, kind, payload=b''):
+        with self._lock:
+            send(self.channel, kind, payload)
+
+    def start(self):
+        # NOTE(jkoelker) The Hub waits for the versions the model restored
+        #                before sequencing anything.
+        self._send(VERSIONS, pack_versions(self.model.local_versions()))
+        self.model.coordinator = self
+        self._reader = eventlet.spawn(self._read)
+
+    def stop(self):
+        if self._reader is not None:
+            self._reader.kill()
+
+        self.model.coordinator = None
+
+    def wait(self):
+        if self._reader is not None:
+            self._reader.wait()
+
+    def claim(self, device_id):
+        if device_id in self._claims:
+            return False
+
+        claim = event.Event()
+        self._claims[device_id] = claim
+        self._send(CLAIM, device_id)
+        return claim.wait()
+
+    def release(self, device_id):
+        self._send(RELEASE, device_id)
+
+    def update_index(self, device_id, folder, files):
+        self._send(INDEX, pack_index(device_id, folder, files))
+
+    def _read(self):
+        while True:
+            try:
+                kind, version, payload = recv(self.channel)
+
+            except (EOFError, socket.error):
+                LOG.error('Lost the connection to the supervisor')
+                break
+
+            if kind in (GRANT, DENY):
+                claim = self._claims.pop(payload, None)
+
+                if claim is not None:
+                    claim.send(kind == GRANT)
+
+            elif kind == INDEX:
+                origin, msg = unpack_index(payload)
+                self.model.apply_index(origin, msg.folder, msg.files, version)
+
+
+def _worker(shard, channel, address, ctx, device_id, model_factory,
+            gate=None, capture_dir=None):
+    profiler.install()
+
+    model = model_factory()
+    coordinator = Coordinator(model, greenio.GreenSocket(channel))
+    coordinator.start()
+
+    sock = server.listen(address, ctx, reuse_port=True)
+    LOG.info('Worker %s (pid %s) listening on %s', shard, os.getpid(),
+             address)
+    serving = eventlet.spawn(server.serve, sock, device_id, model, gate,
+                             capture_dir)
+
+    # NOTE(jkoelker) Without the supervisor there is nobody to arbitrate
+    #                device ownership, so stop serving with it.
+    coordinator.wait()
+    serving.kill()
+
+
+def run(address, ctx, device_id, model_factory, workers=None, gate=None,
+        capture_dir=None):
+    # NOTE(jkoelker) Every worker gets its own copy of gate, so its limits
+    #                apply per worker rather than to the whole master.
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    channels = []
+    pids = []
+
+    for shard in range(workers):
+        parent, child = socket.socketpair()
+        pid = os.fork()
+
+        if pid == 0:
+            parent.close()
+
+            for channel in channels:
+                channel.close()
+
+            try:
+                _worker(shard, child, address, ctx, device_id, model_factory,
+                        gate, capture_dir)
+
+            finally:
+                os._exit(0)
+
+        child.close()
+        channels.append(greenio.GreenSocket(parent))
+        pids.append(pid)
+
+    try:
+        Hub(channels).run()
+
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+
+            except OSError:
+                pass
+
+        for pid in pids:
+            os.waitpid(pid, 0)